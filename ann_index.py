@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+import numpy as np
+from emb_store import text_hash, write_json_atomic
+
+# bump whenever the on-disk layout or the clustering changes, old indexes are then rebuilt
+IVF_INDEX_VERSION = 1
+
+
+def normalize_rows(emb):
+    emb = np.asarray(emb, dtype=np.float32)
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return emb / norms
+
+
+def corpus_fingerprint(texts):
+    h = hashlib.sha1()
+    for t in texts:
+        h.update(text_hash(t))
+    return h.hexdigest()
+
+
+def default_nlist(num_docs):
+    return int(min(max(1, 4 * np.sqrt(num_docs)), num_docs))
+
+
+def assign_to_centroids(emb, centroids, block_size=65536):
+    assign = np.empty(len(emb), dtype=np.int64)
+    for start in range(0, len(emb), block_size):
+        block = normalize_rows(emb[start:start + block_size])
+        assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+def train_spherical_kmeans(emb, nlist, niter=10, sample_size=None, seed=0):
+    # k-means on the unit sphere (cosine) over a sample of the rows
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(emb), sample_size or nlist * 256)
+    sample_rows = np.sort(rng.choice(len(emb), sample_size, replace=False))
+    sample = normalize_rows(emb[sample_rows])
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)]
+    for _ in range(niter):
+        assign = assign_to_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        # empty clusters are re-seeded with random sample rows
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    # Inverted file over normalized document embeddings: docs are bucketed by their nearest k-means
+    # centroid, a query scores only the docs of its nprobe nearest centroids. Raising nprobe trades
+    # speed for recall, nprobe == nlist is exact search.
+    def __init__(self, centroids, list_offsets, list_rows, fingerprint=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.fingerprint = fingerprint
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, doc_emb, nlist=None, niter=10, seed=0, fingerprint=None):
+        nlist = nlist or default_nlist(len(doc_emb))
+        centroids = train_spherical_kmeans(doc_emb, nlist, niter=niter, seed=seed)
+        assign = assign_to_centroids(doc_emb, centroids)
+        list_rows = np.argsort(assign, kind='stable')
+        list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=nlist))))
+        return cls(centroids, list_offsets, list_rows, fingerprint=fingerprint)
+
+    def candidates(self, query_emb, nprobe):
+        # sorted doc rows of the nprobe nearest lists of every query
+        centroid_scores = normalize_rows(query_emb) @ self.centroids.T
+        nprobe = min(nprobe, self.nlist)
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        return [np.sort(np.concatenate([self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in row]))
+                for row in probes]
+
+    def search(self, query_emb, doc_emb, nprobe=32, scale=1):
+        # per query: (candidate rows, cosine scores x scale); doc_emb may be the store memmap,
+        # only candidate rows are read
+        query_emb = normalize_rows(query_emb)
+        out = []
+        for q, rows in zip(query_emb, self.candidates(query_emb, nprobe)):
+            scores = normalize_rows(doc_emb[rows]) @ q
+            if scale != 1:
+                scores *= scale
+            out.append((rows, scores))
+        return out
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(index_dir, 'list_offsets.npy'), self.list_offsets)
+        np.save(os.path.join(index_dir, 'list_rows.npy'), self.list_rows)
+        # meta.json is written last and marks the index as complete
+        write_json_atomic(os.path.join(index_dir, 'meta.json'), {
+            'version': IVF_INDEX_VERSION,
+            'nlist': self.nlist,
+            'num_docs': len(self.list_rows),
+            'corpus_sha1': self.fingerprint,
+        })
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != IVF_INDEX_VERSION:
+            raise ValueError(f"IVF index version {meta['version']} != {IVF_INDEX_VERSION}")
+        return cls(np.load(os.path.join(index_dir, 'centroids.npy')),
+                   np.load(os.path.join(index_dir, 'list_offsets.npy')),
+                   np.load(os.path.join(index_dir, 'list_rows.npy'), mmap_mode=mmap_mode),
+                   fingerprint=meta['corpus_sha1'])
+
+
+def load_or_build_ivf(store, documents, doc_emb, nlist=None, ignore_cache=False):
+    # the index lives next to the embeddings in the store and is keyed by the corpus texts and their order
+    fingerprint = corpus_fingerprint(documents)
+    nlist = nlist or default_nlist(len(documents))
+    index_dir = os.path.join(store.store_dir, 'ann', f"ivf_v{IVF_INDEX_VERSION}_{nlist}_{fingerprint[:16]}")
+    if os.path.isfile(os.path.join(index_dir, 'meta.json')) and not ignore_cache:
+        index = IVFIndex.load(index_dir)
+        if index.fingerprint == fingerprint:
+            print('load ivf index from', index_dir)
+            return index
+    print(f"build ivf index with {nlist} lists over {len(documents)} docs")
+    index = IVFIndex.build(doc_emb, nlist=nlist, fingerprint=fingerprint)
+    index.save(index_dir)
+    return IVFIndex.load(index_dir)
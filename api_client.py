@@ -0,0 +1,111 @@
+import json
+import time
+import random
+import asyncio
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+
+class TokenBucket:
+    # refills `rate` units per second up to `capacity`; acquire() waits until `amount` units are available
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class EmbeddingClient:
+    # Shared request layer of the API backends (openai, cohere, voyage, google). embed_fn(texts) -> list
+    # of vectors is a blocking SDK or HTTP call; up to `concurrency` batches are in flight, requests and
+    # tokens per minute are held under the given limits, a failed batch is retried with exponential
+    # backoff and, when truncate_fn(texts, attempt) is given, re-sent with shorter texts. encode()
+    # returns the embeddings in input order.
+    def __init__(self, embed_fn, concurrency=4, requests_per_minute=None, tokens_per_minute=None,
+                 count_tokens=None, truncate_fn=None, max_retries=5, base_delay=1.0, max_delay=60.0, name='api'):
+        self.embed_fn = embed_fn
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4 + 1)
+        self.truncate_fn = truncate_fn
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.name = name
+
+    async def _embed_batch(self, texts, executor, semaphore, request_bucket, token_bucket):
+        loop = asyncio.get_running_loop()
+        cur_texts = texts
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                if request_bucket is not None:
+                    await request_bucket.acquire(1)
+                if token_bucket is not None:
+                    await token_bucket.acquire(sum(self.count_tokens(t) for t in cur_texts))
+                try:
+                    embs = await loop.run_in_executor(executor, self.embed_fn, cur_texts)
+                    assert len(embs) == len(texts), f"{len(embs)}, {len(texts)}"
+                    return embs
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        raise RuntimeError(f"{self.name}: a batch of {len(texts)} texts failed "
+                                           f"{self.max_retries + 1} times") from e
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1)
+                    print(f"{self.name}: {e!r}, retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                    if self.truncate_fn is not None:
+                        cur_texts = self.truncate_fn(texts, attempt + 1)
+                    await asyncio.sleep(delay)
+
+    async def _encode(self, texts, batch_size, show_progress):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        request_bucket = TokenBucket(self.requests_per_minute / 60, max(1, self.requests_per_minute // 60)) \
+            if self.requests_per_minute else None
+        token_bucket = TokenBucket(self.tokens_per_minute / 60, self.tokens_per_minute) \
+            if self.tokens_per_minute else None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            tasks = [asyncio.ensure_future(self._embed_batch(texts[i:i + batch_size], executor, semaphore,
+                                                             request_bucket, token_bucket))
+                     for i in range(0, len(texts), batch_size)]
+            out = []
+            try:
+                for task in tqdm(tasks, desc=self.name, disable=not show_progress):
+                    out.extend(await task)
+            finally:
+                for task in tasks:
+                    task.cancel()
+        return out
+
+    def encode(self, texts, batch_size, show_progress=True):
+        if len(texts) == 0:
+            return []
+        return asyncio.run(self._encode(list(texts), batch_size, show_progress))
+
+
+def http_embed_fn(url, model, api_key=None, timeout=600):
+    # embed_fn for an OpenAI-compatible /embeddings endpoint over plain urllib, used by the stub
+    # server benchmark and usable with self-hosted embedding servers
+    def embed(texts):
+        headers = {'Content-Type': 'application/json'}
+        if api_key:
+            headers['Authorization'] = f"Bearer {api_key}"
+        request = urllib.request.Request(url, data=json.dumps({'input': texts, 'model': model}).encode('utf-8'),
+                                         headers=headers, method='POST')
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = json.loads(response.read())['data']
+        return [d['embedding'] for d in sorted(data, key=lambda d: d['index'])]
+    return embed
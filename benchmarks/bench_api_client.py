@@ -0,0 +1,71 @@
+# Throughput of api_client.EmbeddingClient against a local stub of an OpenAI-style /embeddings
+# endpoint (fixed latency, random 429s), no network access needed.
+# python benchmarks/bench_api_client.py [--num_texts 2000] [--latency 0.2] [--concurrency 1 4 16]
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api_client import EmbeddingClient, http_embed_fn
+
+
+def fake_embedding(text, dim):
+    seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:4], 'little')
+    return np.random.default_rng(seed).normal(size=dim).round(6).tolist()
+
+
+def make_handler(latency, error_rate, dim):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            time.sleep(latency)
+            if random.random() < error_rate:
+                self.send_response(429)
+                self.end_headers()
+                return
+            data = [{'index': i, 'embedding': fake_embedding(t, dim)} for i, t in enumerate(body['input'])]
+            out = json.dumps({'data': data}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_texts', type=int, default=2000)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--error_rate', type=float, default=0.05)
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--rpm', type=int, default=None)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(args.latency, args.error_rate, args.dim))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/embeddings"
+    texts = [f"document {i} " + 'lorem ipsum ' * (i % 50) for i in range(args.num_texts)]
+    expected = [fake_embedding(t, args.dim) for t in texts]
+
+    for concurrency in args.concurrency:
+        client = EmbeddingClient(http_embed_fn(url, 'stub'), concurrency=concurrency, requests_per_minute=args.rpm,
+                                 base_delay=0.05, max_delay=1.0, max_retries=8, name=f"stub x{concurrency}")
+        start = time.perf_counter()
+        embs = client.encode(texts, args.batch_size, show_progress=False)
+        seconds = time.perf_counter() - start
+        assert embs == expected, 'embeddings came back out of order'
+        print(f"concurrency {concurrency:3d}: {len(texts) / seconds:8.1f} texts/s ({seconds:.2f}s)")
+    server.shutdown()
@@ -0,0 +1,72 @@
+# Client-side latency of a running serve.py: the queries of a reasoning file are sent in batches of
+# each size, p50/p99 per request and queries per second are printed next to the server's /stats.
+# python benchmarks/bench_serve.py --reasoning_file ReDI_dense_reason/bright-biology.arrow
+#     [--url http://127.0.0.1:8000 | --unix_socket /tmp/redi.sock] [--retriever dense] [--batch_sizes 1 8 32]
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import http.client
+import numpy as np
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from unit_table import read_queries
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def request(conn, method, path, body=None):
+    conn.request(method, path, json.dumps(body) if body is not None else None, {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    out = json.loads(response.read())
+    if response.status != 200:
+        raise SystemExit(f"{response.status}: {out}")
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reasoning_file', type=str, required=True)
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--unix_socket', type=str, default=None)
+    parser.add_argument('--retriever', type=str, default=None, choices=['bm25', 'dense', 'hybrid'])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.unix_socket is not None:
+        conn = UnixHTTPConnection(args.unix_socket)
+    else:
+        url = urlparse(args.url)
+        conn = http.client.HTTPConnection(url.hostname, url.port)
+    print(request(conn, 'GET', '/health'))
+    query_ids, queries = read_queries(args.reasoning_file)
+    queries = [{'id': qid, 'query': query} for qid, query in zip(query_ids, queries)]
+    for batch_size in args.batch_sizes:
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for i in range(0, len(queries), batch_size):
+                body = {'queries': queries[i:i + batch_size], 'k': args.k}
+                if args.retriever is not None:
+                    body['retriever'] = args.retriever
+                request_start = time.perf_counter()
+                request(conn, 'POST', '/search', body)
+                latencies.append(time.perf_counter() - request_start)
+        seconds = time.perf_counter() - start
+        ms = np.array(latencies) * 1000
+        print(f"batch {batch_size}: {len(latencies)} requests, p50 {np.percentile(ms, 50):.1f}ms, "
+              f"p99 {np.percentile(ms, 99):.1f}ms, {len(queries) * args.repeat / seconds:.1f} queries/s")
+    print(request(conn, 'GET', '/stats'))
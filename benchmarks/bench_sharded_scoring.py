@@ -0,0 +1,72 @@
+# Speedup of sharded exact scoring (retrievers.sharded_topk) by worker count on a synthetic
+# BM25-like sparse index and dense embeddings, saved to .npy files and memory-mapped the way the persisted
+# BM25 index and the embedding store are, so spawned workers map them by path instead of receiving a copy;
+# every run is checked against the single-process top-k. Workers are capped at the number of cores, a
+# speedup needs more than one. Pin BLAS to one thread per worker to avoid oversubscription:
+#   OMP_NUM_THREADS=1 OPENBLAS_NUM_THREADS=1 python benchmarks/bench_sharded_scoring.py --workers 1 2 4 8
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from retrievers import get_topk, sharded_topk, BM25ShardScorer, DenseShardScorer
+
+
+def random_csr(rng, num_rows, num_cols, nnz_per_row):
+    indices = np.sort(rng.integers(0, num_cols, size=(num_rows, nnz_per_row)), axis=1)
+    data = rng.integers(1, 5, size=num_rows * nnz_per_row).astype(np.float32)
+    indptr = np.arange(num_rows + 1, dtype=np.int64) * nnz_per_row
+    matrix = sp.csr_matrix((data, indices.ravel(), indptr), shape=(num_rows, num_cols))
+    matrix.sum_duplicates()
+    return matrix
+
+
+def timed(fn):
+    start = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - start
+
+
+def mapped(tmp_dir, name, arr):
+    np.save(os.path.join(tmp_dir, name), arr)
+    return np.load(os.path.join(tmp_dir, name), mmap_mode='r')
+
+
+def bench(name, score_fn, num_docs, excluded, workers, k):
+    (ref_idx, ref_scores), base = timed(lambda: get_topk(score_fn(0, num_docs), k=k, excluded=excluded))
+    print(f"{name}: single process {base:.2f}s")
+    for num_workers in workers:
+        (idx, scores), seconds = timed(lambda: sharded_topk(score_fn, num_docs, k=k, excluded=excluded,
+                                                             num_workers=num_workers))
+        assert (idx == ref_idx).all() and (scores == ref_scores).all(), f"{name}: {num_workers} workers differ"
+        print(f"  {num_workers:3d} workers: {seconds:6.2f}s  speedup {base / seconds:5.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_docs', type=int, default=500000)
+    parser.add_argument('--num_queries', type=int, default=100)
+    parser.add_argument('--num_terms', type=int, default=200000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--k', type=int, default=1000)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    excluded = [rng.choice(args.num_docs, 5, replace=False) for _ in range(args.num_queries)]
+
+    print(f"{os.cpu_count()} cores")
+    tmp_dir = tempfile.mkdtemp()
+    # integer-valued weights produce many tied scores, which exercises the tie rule of the merge
+    matrix = random_csr(rng, args.num_docs, args.num_terms, 100)
+    doc_matrix = sp.csr_matrix((mapped(tmp_dir, 'data.npy', matrix.data), mapped(tmp_dir, 'indices.npy', matrix.indices),
+                                mapped(tmp_dir, 'indptr.npy', matrix.indptr)), shape=matrix.shape, copy=False)
+    query_matrix = random_csr(rng, args.num_queries, args.num_terms, 20)
+    bench('bm25', BM25ShardScorer(doc_matrix, query_matrix), args.num_docs, excluded, args.workers, args.k)
+
+    doc_emb = mapped(tmp_dir, 'emb.npy', rng.normal(size=(args.num_docs, args.dim)).astype(np.float32))
+    query_emb = rng.normal(size=(args.num_queries, args.dim)).astype(np.float32)
+    bench('dense', DenseShardScorer(query_emb, doc_emb), args.num_docs, excluded, args.workers, args.k)
@@ -0,0 +1,83 @@
+# Startup time of run.py (`import run` and the wall time of `python run.py --help`, both in a fresh
+# interpreter) against the one second target, and a check that neither startup nor the BM25 path loads
+# a model stack or datasets.
+# python benchmarks/bench_startup.py [--repeat 5] [--skip_bm25]
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['torch', 'transformers', 'sentence_transformers', 'gritlm', 'InstructorEmbedding', 'cohere',
+                 'voyageai', 'openai', 'vertexai', 'tiktoken', 'sklearn', 'torchmetrics', 'pytrec_eval', 'datasets']
+STARTUP_TARGET_SECONDS = 1.0
+
+# runs in a fresh interpreter: import, optionally retrieve with BM25 on a toy corpus, report loaded modules
+CHILD = r'''
+import sys, time, json
+start = time.perf_counter()
+import run
+import retrievers
+import_seconds = time.perf_counter() - start
+bm25_seconds = None
+if sys.argv[1] == '1':
+    documents = ['the cat sat on the mat', 'dogs chase cats', 'a mat for the dog', 'unrelated text']
+    doc_ids = [f'd{i}' for i in range(len(documents))]
+    start = time.perf_counter()
+    retrievers.RETRIEVAL_FUNCS['bm25'](queries=['cat on a mat'], query_ids=['q0'], documents=documents,
+                                       doc_ids=doc_ids, excluded_ids={'q0': ['N/A']}, long_context=False)
+    retrievers.RETRIEVAL_FUNCS['bm25_fusion_desc'](
+        queries=['Sub_Query_1: "<begin_of_query>cat<end_of_query>" Desc1: "<begin_of_desc>mat<end_of_desc>"'],
+        query_ids=['q0'], documents=documents, doc_ids=doc_ids, excluded_ids={'q0': ['N/A']}, long_context=False,
+        ground_truth={'q0': {'d0'}})
+    bm25_seconds = time.perf_counter() - start
+print(json.dumps({'import_seconds': import_seconds, 'bm25_seconds': bm25_seconds, 'modules': sorted(sys.modules)}))
+'''
+
+
+def run_child(with_bm25):
+    out = subprocess.run([sys.executable, '-c', CHILD, '1' if with_bm25 else '0'], cwd=ROOT,
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        raise SystemExit(out.stderr)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def time_help():
+    # wall time of the whole command, interpreter startup included
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, 'run.py', '--help'], cwd=ROOT, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise SystemExit(out.stderr)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--skip_bm25', action='store_true', help='only time the startup, e.g. without pyserini/Java')
+    args = parser.parse_args()
+
+    times, help_times = [], []
+    for _ in range(args.repeat):
+        result = run_child(False)
+        times.append(result['import_seconds'])
+        help_times.append(time_help())
+    times.sort()
+    help_times.sort()
+    print(f"import run: median {times[len(times) // 2]:.3f}s, min {times[0]:.3f}s over {args.repeat} runs")
+    help_seconds = help_times[len(help_times) // 2]
+    print(f"python run.py --help: median {help_seconds:.3f}s, min {help_times[0]:.3f}s "
+          f"(target {STARTUP_TARGET_SECONDS:.1f}s)")
+    loaded = [m for m in HEAVY_MODULES if m in result['modules']]
+    assert not loaded, f"importing run loaded {loaded}"
+    assert help_seconds < STARTUP_TARGET_SECONDS, f"run.py --help took {help_seconds:.3f}s"
+
+    if not args.skip_bm25:
+        result = run_child(True)
+        print(f"bm25 + bm25_fusion_desc on a toy corpus: {result['bm25_seconds']:.3f}s")
+        loaded = [m for m in HEAVY_MODULES if m in result['modules']]
+        assert not loaded, f"the BM25 path loaded {loaded}"
+    print('ok, no model stack was imported')
@@ -0,0 +1,97 @@
+# Parity of fast_eval with pytrec_eval on random runs: tied scores, short runs, graded and
+# unretrievable gold docs, empty runs, queries without relevant docs or not in the qrels.
+# Every per-query value must agree to 1e-9 and every averaged metric exactly after rounding;
+# also times both evaluators on a batch of runs.
+# python benchmarks/check_fast_eval.py [--num_runs 200] [--seeds 20]
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pytrec_eval
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fast_eval import QrelsIndex, evaluate_topk
+from retrievers import calculate_retrieval_metrics
+
+K_VALUES = [1, 5, 10, 25, 50, 100]
+TREC_NAMES = {'NDCG': 'ndcg_cut_', 'MAP': 'map_cut_', 'Recall': 'recall_', 'P': 'P_'}
+
+
+def random_case(rng, num_docs, num_queries, k):
+    doc_ids = [f"doc{i}" for i in rng.permutation(num_docs)]
+    query_ids = [f"q{i}" for i in range(num_queries)]
+    qrels = {}
+    for qid in query_ids[2:]:
+        gold = rng.choice(num_docs, rng.integers(0, 12), replace=False)
+        qrels[qid] = {doc_ids[i]: int(rng.choice([1, 1, 2])) for i in gold}
+        if rng.random() < 0.3:
+            qrels[qid][f"missing{qid}"] = 1
+        if rng.random() < 0.1:
+            qrels[qid][doc_ids[rng.integers(num_docs)]] = 0
+    qrels['extra'] = {doc_ids[0]: 1}
+    topk_idx = np.full((num_queries, k), -1, dtype=np.int64)
+    topk_scores = np.full((num_queries, k), -np.inf)
+    for row in range(num_queries):
+        n = k if rng.random() < 0.8 else int(rng.integers(0, k))
+        topk_idx[row, :n] = rng.choice(num_docs, n, replace=False)
+        # few distinct values, so many ties
+        topk_scores[row, :n] = np.sort(rng.integers(0, 20, n).astype(np.float64))[::-1] / 4
+    return doc_ids, query_ids, qrels, topk_idx, topk_scores
+
+
+def to_results(doc_ids, query_ids, topk_idx, topk_scores):
+    return {qid: {doc_ids[i]: float(s) for i, s in zip(idx, scores) if i >= 0}
+            for qid, idx, scores in zip(query_ids, topk_idx.tolist(), topk_scores.tolist())}
+
+
+def check(seed, num_docs=400, num_queries=30, k=120):
+    rng = np.random.default_rng(seed)
+    doc_ids, query_ids, qrels, topk_idx, topk_scores = random_case(rng, num_docs, num_queries, k)
+    results = to_results(doc_ids, query_ids, topk_idx, topk_scores)
+    measures = {"map_cut." + ",".join(map(str, K_VALUES)), "ndcg_cut." + ",".join(map(str, K_VALUES)),
+                "recall." + ",".join(map(str, K_VALUES)), "P." + ",".join(map(str, K_VALUES)), "recip_rank"}
+    expected = pytrec_eval.RelevanceEvaluator(qrels, measures).evaluate(results)
+    qrels_index = QrelsIndex(qrels, query_ids, doc_ids)
+    values, evaluated = evaluate_topk(topk_idx, topk_scores, qrels_index, K_VALUES, per_query=True)
+    assert set(np.array(query_ids)[evaluated]) == set(expected), f"seed {seed}: evaluated queries differ"
+    for row, qid in enumerate(query_ids):
+        if qid not in expected:
+            continue
+        for name, trec_name in TREC_NAMES.items():
+            for k_value in K_VALUES:
+                got, want = values[f"{name}@{k_value}"][row], expected[qid][f"{trec_name}{k_value}"]
+                assert abs(got - want) < 1e-9, f"seed {seed} {qid} {name}@{k_value}: {got} != {want}"
+        assert abs(values["MRR"][row] - expected[qid]["recip_rank"]) < 1e-9, f"seed {seed} {qid} MRR"
+    means = evaluate_topk(topk_idx, topk_scores, qrels_index, K_VALUES)
+    assert means == calculate_retrieval_metrics(results, qrels, K_VALUES), f"seed {seed}: averages differ"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeds', type=int, default=20)
+    parser.add_argument('--num_runs', type=int, default=200)
+    parser.add_argument('--num_queries', type=int, default=100)
+    parser.add_argument('--num_docs', type=int, default=50000)
+    args = parser.parse_args()
+    sys.stdout = open(os.devnull, 'w')  # calculate_retrieval_metrics prints every result
+    for seed in range(args.seeds):
+        check(seed)
+    sys.stdout = sys.__stdout__
+    print(f"{args.seeds} random cases agree with pytrec_eval")
+
+    rng = np.random.default_rng(0)
+    doc_ids, query_ids, qrels, topk_idx, topk_scores = random_case(rng, args.num_docs, args.num_queries, 1000)
+    topk_idx = np.stack([rng.permuted(topk_idx, axis=1) for _ in range(args.num_runs)])
+    topk_scores = np.broadcast_to(topk_scores, topk_idx.shape)
+    start = time.perf_counter()
+    evaluate_topk(topk_idx, topk_scores, QrelsIndex(qrels, query_ids, doc_ids), K_VALUES)
+    fast = time.perf_counter() - start
+    sys.stdout = open(os.devnull, 'w')
+    start = time.perf_counter()
+    for run_idx in topk_idx[:10]:
+        calculate_retrieval_metrics(to_results(doc_ids, query_ids, run_idx, topk_scores[0]), qrels, K_VALUES)
+    slow = (time.perf_counter() - start) / 10 * args.num_runs
+    sys.stdout = sys.__stdout__
+    print(f"{args.num_runs} runs x {args.num_queries} queries x 1000: fast_eval {fast:.2f}s, "
+          f"dicts + pytrec_eval {slow:.2f}s (extrapolated from 10 runs)")
@@ -0,0 +1,270 @@
+import os
+import json
+import hashlib
+import functools
+import numpy as np
+import scipy.sparse as sp
+from emb_store import text_hash, text_hashes, split_hashes, write_json_atomic
+
+# bump whenever the on-disk layout or the weighting changes, old indexes are then rebuilt
+BM25_INDEX_VERSION = 1
+DEFAULT_ANALYZER = 'lucene_default'
+
+
+@functools.lru_cache(maxsize=None)
+def get_analyzer(analyzer_name=DEFAULT_ANALYZER):
+    from pyserini import analysis
+    if analyzer_name != DEFAULT_ANALYZER:
+        raise ValueError(f"The analyzer {analyzer_name} is not supported")
+    return analysis.Analyzer(analysis.get_lucene_analyzer())
+
+
+def analyze_chunk(args):
+    # runs in a spawned worker with its own JVM and analyzer, see analyze_parallel
+    analyzer_name, texts = args
+    analyzer = get_analyzer(analyzer_name)
+    return [analyzer.analyze(x) for x in texts]
+
+
+def analyze_parallel(texts, analyzer_name=DEFAULT_ANALYZER, num_workers=4, chunk_size=256):
+    # spawn rather than fork: the parent may already run a JVM, which does not survive a fork
+    import multiprocessing
+    from tqdm import tqdm
+    chunks = [(analyzer_name, texts[i:i + chunk_size]) for i in range(0, len(texts), chunk_size)]
+    out = []
+    with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+        for tokens in tqdm(pool.imap(analyze_chunk, chunks), total=len(chunks), desc='analyze'):
+            out.extend(tokens)
+    return out
+
+
+class TokenCache:
+    # Analyzed documents keyed by the sha1 of their text, shared by every task, BM25 variant and
+    # k1/b setting that uses the same analyzer. Each run that analyzes new documents adds a shard
+    # (keys.npy, offsets.npy, token ids in tokens.npy); vocab.json maps token ids to strings and only
+    # grows; manifest.json, written last, lists the complete shards.
+    def __init__(self, cache_dir, analyzer_name=DEFAULT_ANALYZER):
+        self.cache_dir = os.path.join(cache_dir, 'bm25_tokens', f"v{BM25_INDEX_VERSION}", analyzer_name)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.vocab = []
+        self.shards = []
+        self.index = {}
+        manifest_path = os.path.join(self.cache_dir, 'manifest.json')
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            with open(os.path.join(self.cache_dir, 'vocab.json')) as f:
+                self.vocab = json.load(f)
+            for name in manifest['shards']:
+                self._open_shard(name)
+        self.token2id = {t: i for i, t in enumerate(self.vocab)}
+
+    def _open_shard(self, name):
+        shard_dir = os.path.join(self.cache_dir, name)
+        keys = np.load(os.path.join(shard_dir, 'keys.npy'))
+        self.shards.append((np.load(os.path.join(shard_dir, 'offsets.npy'), mmap_mode='r'),
+                            np.load(os.path.join(shard_dir, 'tokens.npy'), mmap_mode='r')))
+        for row, key in enumerate(split_hashes(keys)):
+            self.index[key] = (len(self.shards) - 1, row)
+
+    def get(self, text_key):
+        shard_no, row = self.index[text_key]
+        offsets, tokens = self.shards[shard_no]
+        return [self.vocab[t] for t in tokens[offsets[row]:offsets[row + 1]].tolist()]
+
+    def add(self, texts, token_lists):
+        # texts the cache already holds are skipped, so analyzing again (ignore_cache) adds no shard
+        new = [(x, tokens) for x, tokens in zip(texts, token_lists) if text_hash(x) not in self.index]
+        if not new:
+            return
+        texts, token_lists = zip(*new)
+        name = f"{len(self.shards):06d}"
+        shard_dir = os.path.join(self.cache_dir, name)
+        os.makedirs(shard_dir, exist_ok=True)
+        ids = []
+        for tokens in token_lists:
+            for t in tokens:
+                if t not in self.token2id:
+                    self.token2id[t] = len(self.vocab)
+                    self.vocab.append(t)
+                ids.append(self.token2id[t])
+        np.save(os.path.join(shard_dir, 'keys.npy'), text_hashes(texts))
+        np.save(os.path.join(shard_dir, 'offsets.npy'),
+                np.concatenate(([0], np.cumsum([len(tokens) for tokens in token_lists]))).astype(np.int64))
+        np.save(os.path.join(shard_dir, 'tokens.npy'), np.array(ids, dtype=np.int32))
+        write_json_atomic(os.path.join(self.cache_dir, 'vocab.json'), self.vocab)
+        write_json_atomic(os.path.join(self.cache_dir, 'manifest.json'),
+                          {'version': BM25_INDEX_VERSION, 'shards': [f"{i:06d}" for i in range(len(self.shards) + 1)]})
+        self._open_shard(name)
+
+
+def analyze_corpus(documents, analyzer, analyzer_name=DEFAULT_ANALYZER, cache_dir=None, num_workers=1,
+                   ignore_cache=False):
+    # tokens of every document; with a cache_dir, only documents the token cache has not seen are
+    # analyzed (in num_workers processes when > 1) and then added to it
+    cache = TokenCache(cache_dir, analyzer_name) if cache_dir is not None else None
+    keys = [text_hash(x) for x in documents]
+    missing = {}
+    for key, x in zip(keys, documents):
+        if (cache is None or ignore_cache or key not in cache.index) and key not in missing:
+            missing[key] = x
+    if missing:
+        print(f"analyze {len(missing)} of {len(documents)} documents")
+        texts = list(missing.values())
+        if num_workers > 1:
+            token_lists = analyze_parallel(texts, analyzer_name, num_workers=num_workers)
+        else:
+            token_lists = [analyzer.analyze(x) for x in texts]
+        analyzed = dict(zip(missing, token_lists))
+        if cache is None:
+            return [analyzed[key] for key in keys]
+        cache.add(texts, token_lists)
+        # with ignore_cache the fresh tokens are used even where the cache kept the old ones
+        return [analyzed[key] if key in analyzed else cache.get(key) for key in keys]
+    return [cache.get(key) for key in keys]
+
+
+def doc_ids_fingerprint(doc_ids):
+    h = hashlib.sha1()
+    for did in doc_ids:
+        h.update(str(did).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def bm25_index_dir(cache_dir, task, long_context, k1, b, analyzer_name=DEFAULT_ANALYZER):
+    return os.path.join(cache_dir, 'bm25_index', f"v{BM25_INDEX_VERSION}", task,
+                        f"long_{long_context}_k1_{k1}_b_{b}_{analyzer_name}")
+
+
+class BM25Index:
+    # Lucene BM25 document weights as a (num_docs x num_terms) CSR matrix; queries are weighted
+    # exactly like gensim's LuceneBM25Model does it, so scores match SparseMatrixSimilarity.
+    def __init__(self, matrix, vocab, idfs, avgdl, k1, b, doc_ids, analyzer_name=DEFAULT_ANALYZER):
+        self.matrix = matrix
+        self.vocab = vocab
+        self.token2id = {t: i for i, t in enumerate(vocab)}
+        self.idfs = idfs
+        self.avgdl = avgdl
+        self.k1 = k1
+        self.b = b
+        self.doc_ids = doc_ids
+        self.analyzer_name = analyzer_name
+
+    @property
+    def num_docs(self):
+        return self.matrix.shape[0]
+
+    @property
+    def num_terms(self):
+        return self.matrix.shape[1]
+
+    def query_vector(self, tokens):
+        counts = {}
+        for t in tokens:
+            tid = self.token2id.get(t)
+            if tid is not None:
+                counts[tid] = counts.get(tid, 0) + 1
+        term_ids = np.array(sorted(counts), dtype=np.int64)
+        tfs = np.array([counts[t] for t in term_ids], dtype=np.int64)
+        num_tokens = int(tfs.sum())
+        weights = self.idfs[term_ids] * (tfs / (tfs + self.k1 * (1 - self.b + self.b * num_tokens / self.avgdl)))
+        return term_ids, weights.astype(np.float32)
+
+    def query_matrix(self, token_lists):
+        rows, cols, vals = [], [], []
+        for row, tokens in enumerate(token_lists):
+            term_ids, weights = self.query_vector(tokens)
+            rows.append(np.full(len(term_ids), row, dtype=np.int64))
+            cols.append(term_ids)
+            vals.append(weights)
+        if not token_lists:
+            return sp.csr_matrix((0, self.num_terms), dtype=np.float32)
+        return sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(len(token_lists), self.num_terms), dtype=np.float32)
+
+    def score(self, tokens):
+        term_ids, weights = self.query_vector(tokens)
+        query = sp.csc_matrix((weights, (term_ids, np.zeros(len(term_ids), dtype=np.int64))),
+                              shape=(self.num_terms, 1), dtype=np.float32)
+        return (self.matrix @ query).toarray().ravel()
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, 'data.npy'), self.matrix.data)
+        np.save(os.path.join(index_dir, 'indices.npy'), self.matrix.indices)
+        np.save(os.path.join(index_dir, 'indptr.npy'), self.matrix.indptr)
+        np.save(os.path.join(index_dir, 'idfs.npy'), self.idfs)
+        with open(os.path.join(index_dir, 'vocab.json'), 'w') as f:
+            json.dump(self.vocab, f)
+        with open(os.path.join(index_dir, 'doc_ids.json'), 'w') as f:
+            json.dump(self.doc_ids, f)
+        # meta.json is written last and marks the index as complete
+        meta = {
+            'version': BM25_INDEX_VERSION,
+            'analyzer': self.analyzer_name,
+            'k1': self.k1,
+            'b': self.b,
+            'avgdl': self.avgdl,
+            'num_docs': self.num_docs,
+            'num_terms': self.num_terms,
+            'doc_ids_sha1': doc_ids_fingerprint(self.doc_ids),
+        }
+        tmp_path = os.path.join(index_dir, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, os.path.join(index_dir, 'meta.json'))
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != BM25_INDEX_VERSION:
+            raise ValueError(f"BM25 index version {meta['version']} != {BM25_INDEX_VERSION}")
+        data = np.load(os.path.join(index_dir, 'data.npy'), mmap_mode=mmap_mode)
+        indices = np.load(os.path.join(index_dir, 'indices.npy'), mmap_mode=mmap_mode)
+        indptr = np.load(os.path.join(index_dir, 'indptr.npy'), mmap_mode=mmap_mode)
+        matrix = sp.csr_matrix((data, indices, indptr), shape=(meta['num_docs'], meta['num_terms']), copy=False)
+        idfs = np.load(os.path.join(index_dir, 'idfs.npy'))
+        with open(os.path.join(index_dir, 'vocab.json')) as f:
+            vocab = json.load(f)
+        with open(os.path.join(index_dir, 'doc_ids.json')) as f:
+            doc_ids = json.load(f)
+        return cls(matrix=matrix, vocab=vocab, idfs=idfs, avgdl=meta['avgdl'], k1=meta['k1'], b=meta['b'],
+                   doc_ids=doc_ids, analyzer_name=meta['analyzer'])
+
+
+def build_bm25_index(corpus, doc_ids, k1=0.9, b=0.4, analyzer_name=DEFAULT_ANALYZER):
+    from gensim.corpora import Dictionary
+    from gensim.models import LuceneBM25Model
+    from gensim.matutils import corpus2csc
+    dictionary = Dictionary(corpus)
+    model = LuceneBM25Model(dictionary=dictionary, k1=k1, b=b)
+    bm25_corpus = model[[dictionary.doc2bow(doc) for doc in corpus]]
+    matrix = corpus2csc(bm25_corpus, num_terms=len(dictionary), num_docs=len(corpus), dtype=np.float32).T.tocsr()
+    vocab = [dictionary[i] for i in range(len(dictionary))]
+    idfs = np.array([model.idfs.get(i) or 0.0 for i in range(len(dictionary))], dtype=np.float64)
+    return BM25Index(matrix=matrix, vocab=vocab, idfs=idfs, avgdl=model.avgdl, k1=k1, b=b,
+                     doc_ids=list(doc_ids), analyzer_name=analyzer_name)
+
+
+def load_or_build_bm25_index(documents, doc_ids, analyzer, cache_dir=None, task=None, long_context=False,
+                             k1=0.9, b=0.4, analyzer_name=DEFAULT_ANALYZER, ignore_cache=False, num_workers=1):
+    index_dir = None
+    if cache_dir is not None and task is not None:
+        index_dir = bm25_index_dir(cache_dir, task, long_context, k1, b, analyzer_name)
+        meta_path = os.path.join(index_dir, 'meta.json')
+        if os.path.isfile(meta_path) and not ignore_cache:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('version') == BM25_INDEX_VERSION and meta.get('doc_ids_sha1') == doc_ids_fingerprint(doc_ids):
+                print('load bm25 index from', index_dir)
+                return BM25Index.load(index_dir)
+            print('bm25 index at', index_dir, 'is stale, rebuilding')
+    corpus = analyze_corpus(documents, analyzer, analyzer_name=analyzer_name, cache_dir=cache_dir,
+                            num_workers=num_workers, ignore_cache=ignore_cache)
+    index = build_bm25_index(corpus, doc_ids, k1=k1, b=b, analyzer_name=analyzer_name)
+    if index_dir is not None:
+        index.save(index_dir)
+        index = BM25Index.load(index_dir)
+    return index
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+from tqdm import trange
+from emb_store import text_hashes, split_hashes, write_json_atomic, encode_with_store
+from ann_index import corpus_fingerprint
+
+# Long documents as overlapping token windows instead of one truncated text. Chunks are ordinary
+# texts of the embedding store (a document that fits in one window is its own single chunk, so it
+# shares the embedding of the unchunked run); the chunk -> doc map and the chunk text hashes are
+# kept under the store in chunks/, so later runs read the chunk embeddings without tokenizing the
+# corpus again. Scores of the chunks of a document are pooled with a segment max or mean.
+DOC_CHUNKS_VERSION = 1
+
+
+def window_spans(num_tokens, window, overlap=0):
+    # [(start, end)] windows of `window` tokens, consecutive windows share `overlap` tokens
+    assert 0 <= overlap < window, f"overlap {overlap} must be smaller than the window {window}"
+    step = window - overlap
+    return [(start, min(start + window, num_tokens)) for start in range(0, max(num_tokens - overlap, 1), step)]
+
+
+def chunk_documents(documents, tokenize, detokenize, window, overlap=0, batch_size=1024):
+    # tokenize(list of texts) -> list of token id lists, detokenize(token ids) -> text
+    # -> (chunk texts, chunk_doc) with the chunks of every document contiguous and in order
+    texts, chunk_doc = [], []
+    for start in trange(0, len(documents), batch_size, desc='chunk'):
+        for row, ids in enumerate(tokenize(documents[start:start + batch_size]), start=start):
+            if len(ids) <= window:
+                texts.append(documents[row])
+                chunk_doc.append(row)
+                continue
+            for span_start, span_end in window_spans(len(ids), window, overlap):
+                texts.append(detokenize(ids[span_start:span_end]))
+                chunk_doc.append(row)
+    return texts, np.array(chunk_doc, dtype=np.int64)
+
+
+def doc_chunks_dir(store, documents, window, overlap):
+    return os.path.join(store.store_dir, 'chunks',
+                        f"v{DOC_CHUNKS_VERSION}_{corpus_fingerprint(documents)[:16]}_w{window}_o{overlap}")
+
+
+def encode_chunks_with_store(store, documents, encode_fn, tokenize, detokenize, window, overlap=0,
+                             ignore_cache=False, **encode_kwargs):
+    # -> (chunk embeddings, chunk_doc); encode_kwargs go to encode_with_store
+    chunks_dir = doc_chunks_dir(store, documents, window, overlap)
+    if os.path.isfile(os.path.join(chunks_dir, 'meta.json')) and not ignore_cache:
+        chunk_doc = np.load(os.path.join(chunks_dir, 'chunk_doc.npy'))
+        keys = np.load(os.path.join(chunks_dir, 'keys.npy'))
+        try:
+            chunk_emb = store.get_hashes(split_hashes(keys))
+            print(f"load {len(chunk_doc)} chunks of {len(documents)} docs from {chunks_dir}")
+            return chunk_emb, chunk_doc
+        except KeyError:
+            print('chunk embeddings are missing from the store, chunking again')
+    texts, chunk_doc = chunk_documents(documents, tokenize, detokenize, window, overlap)
+    print(f"{len(documents)} docs -> {len(texts)} chunks of up to {window} tokens, {overlap} overlapping")
+    chunk_emb = encode_with_store(store, texts, encode_fn, **encode_kwargs)
+    os.makedirs(chunks_dir, exist_ok=True)
+    np.save(os.path.join(chunks_dir, 'chunk_doc.npy'), chunk_doc)
+    np.save(os.path.join(chunks_dir, 'keys.npy'), text_hashes(texts))
+    # meta.json is written last and marks the map as complete
+    write_json_atomic(os.path.join(chunks_dir, 'meta.json'), {
+        'version': DOC_CHUNKS_VERSION, 'num_docs': len(documents), 'num_chunks': len(texts),
+        'window': window, 'overlap': overlap})
+    return chunk_emb, chunk_doc
+
+
+def pool_chunk_scores(chunk_scores, chunk_doc, num_docs, pooling='max'):
+    # (queries x chunks) -> (queries x docs); every doc has at least one chunk and its chunks are contiguous
+    offsets = np.searchsorted(chunk_doc, np.arange(num_docs))
+    if pooling == 'max':
+        return np.maximum.reduceat(chunk_scores, offsets, axis=1)
+    assert pooling == 'mean', f"unsupported pooling {pooling}"
+    return np.add.reduceat(chunk_scores, offsets, axis=1) / np.bincount(chunk_doc, minlength=num_docs)
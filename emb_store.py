@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from tqdm import trange
+
+# bump whenever the on-disk layout changes
+EMB_STORE_VERSION = 2
+HASH_SIZE = 20
+# spread-out lookups below VIEW_MIN_BYTES are gathered in RAM; larger ones are written to views/,
+# of which the MAX_VIEWS most recently used are kept
+VIEW_MIN_BYTES = 256 << 20
+MAX_VIEWS = 4
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+
+def text_hashes(texts):
+    # (n, 20) uint8 rather than an 'S20' array, numpy strips trailing zero bytes of 'S' items
+    return np.frombuffer(b''.join(text_hash(t) for t in texts), dtype=np.uint8).reshape(-1, HASH_SIZE)
+
+
+def split_hashes(keys):
+    buf = np.ascontiguousarray(keys).tobytes()
+    return [buf[i:i + HASH_SIZE] for i in range(0, len(buf), HASH_SIZE)]
+
+
+def write_json_atomic(path, obj, indent=2):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=indent)
+    os.replace(tmp_path, path)
+
+
+class EmbeddingStore:
+    # Embeddings keyed by (model id, instruction, max_length) and the sha1 of the text, so they
+    # survive batch size changes and are shared by identical documents across tasks and views.
+    # Each shard is a preallocated keys.npy/emb.npy pair written in place through a memmap;
+    # header.json holds the number of committed rows, anything past it is ignored and overwritten
+    # when an interrupted run resumes. manifest.json lists the shards. get() returns a memmap, of the
+    # shard itself or, when the rows are spread out, of a copy in request order under views/ (small
+    # lookups are gathered in RAM instead).
+    def __init__(self, cache_dir, model_id, instruction='', max_length=-1, dtype='float32'):
+        self.spec = {'version': EMB_STORE_VERSION, 'model_id': model_id,
+                     'instruction': instruction or '', 'max_length': max_length}
+        spec_key = hashlib.sha1(json.dumps(self.spec, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.store_dir = os.path.join(cache_dir, 'emb_store', model_id.replace('/', '_'), spec_key)
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in (np.float16, np.float32), f"unsupported embedding dtype {dtype}"
+        os.makedirs(self.store_dir, exist_ok=True)
+        spec_path = os.path.join(self.store_dir, 'spec.json')
+        if not os.path.isfile(spec_path):
+            write_json_atomic(spec_path, self.spec)
+        self.shards = []
+        self.index = {}
+        self._load()
+        other_rows = sum(shard['rows'] for shard in self.shards if shard['emb'].dtype != self.dtype)
+        if other_rows:
+            print(f"warning: {other_rows} embeddings in {self.store_dir} are stored in another dtype than "
+                  f"{self.dtype.name}, which only applies to newly encoded texts; remove the store to re-encode them")
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.store_dir, 'manifest.json')
+
+    def _load(self):
+        if not os.path.isfile(self.manifest_path):
+            return
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        for name in manifest['shards']:
+            self._open_shard(name)
+
+    def _open_shard(self, name):
+        shard_dir = os.path.join(self.store_dir, name)
+        with open(os.path.join(shard_dir, 'header.json')) as f:
+            header = json.load(f)
+        shard = {
+            'name': name,
+            'dir': shard_dir,
+            'rows': 0,
+            'capacity': header['capacity'],
+            'emb': np.load(os.path.join(shard_dir, 'emb.npy'), mmap_mode='r'),
+        }
+        self.shards.append(shard)
+        self._register(len(self.shards) - 1, header['rows'])
+
+    def _register(self, shard_no, rows):
+        # make the rows up to `rows` of a shard visible to lookups
+        shard = self.shards[shard_no]
+        keys = np.load(os.path.join(shard['dir'], 'keys.npy'), mmap_mode='r')
+        for row, key in enumerate(split_hashes(keys[shard['rows']:rows]), start=shard['rows']):
+            self.index[key] = (shard_no, row)
+        shard['rows'] = rows
+
+    def _new_shard(self, capacity, dim):
+        name = f"{len(self.shards):06d}"
+        shard_dir = os.path.join(self.store_dir, name)
+        os.makedirs(shard_dir, exist_ok=True)
+        np.lib.format.open_memmap(os.path.join(shard_dir, 'emb.npy'), mode='w+', dtype=self.dtype,
+                                  shape=(capacity, dim)).flush()
+        np.lib.format.open_memmap(os.path.join(shard_dir, 'keys.npy'), mode='w+', dtype=np.uint8,
+                                  shape=(capacity, HASH_SIZE)).flush()
+        write_json_atomic(os.path.join(shard_dir, 'header.json'),
+                          {'rows': 0, 'capacity': capacity, 'dim': dim, 'dtype': self.dtype.name})
+        write_json_atomic(self.manifest_path, {'version': EMB_STORE_VERSION,
+                                               'shards': [s['name'] for s in self.shards] + [name]})
+        self._open_shard(name)
+        return len(self.shards) - 1
+
+    def _shard_for(self, capacity, dim):
+        # an interrupted run left the last shard partly filled: continue right after its committed rows
+        if self.shards:
+            shard = self.shards[-1]
+            emb = shard['emb']
+            if shard['capacity'] - shard['rows'] >= capacity and emb.shape[1] == dim and emb.dtype == self.dtype:
+                return len(self.shards) - 1
+        return self._new_shard(capacity, dim)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, text):
+        return text_hash(text) in self.index
+
+    @property
+    def dim(self):
+        return self.shards[0]['emb'].shape[1] if self.shards else None
+
+    def missing(self, texts):
+        # unique texts without an embedding, in first-occurrence order
+        seen = set()
+        out = []
+        for t in texts:
+            h = text_hash(t)
+            if h not in self.index and h not in seen:
+                seen.add(h)
+                out.append(t)
+        return out
+
+    def writer(self, capacity, commit_rows=1000, commit_seconds=300):
+        return ShardWriter(self, capacity, commit_rows=commit_rows, commit_seconds=commit_seconds)
+
+    def add(self, texts, embs):
+        if len(texts) == 0:
+            return
+        writer = self.writer(len(texts))
+        writer.append(texts, embs)
+        writer.close()
+
+    def get(self, texts):
+        return self.get_hashes([text_hash(t) for t in texts], texts=texts)
+
+    def get_hashes(self, hashes, texts=None):
+        # embeddings by sha1 of the text, for callers that keep the hashes rather than the texts
+        locs = []
+        for i, h in enumerate(hashes):
+            loc = self.index.get(h)
+            if loc is None:
+                raise KeyError(f"no embedding stored for text {texts[i][:50]!r}" if texts is not None else
+                               f"no embedding stored for text sha1 {h.hex()}")
+            locs.append(loc)
+        if not locs:
+            return np.zeros((0, self.dim or 0), dtype=self.dtype)
+        shard_nos = np.array([s for s, _ in locs])
+        rows = np.array([r for _, r in locs])
+        # the common case, a corpus encoded in order into one shard, is returned as a memmap view
+        if (shard_nos == shard_nos[0]).all() and (np.diff(rows) == 1).all():
+            return self.shards[shard_nos[0]]['emb'][rows[0]:rows[-1] + 1]
+        dtype = np.result_type(*[self.shards[shard_no]['emb'].dtype for shard_no in np.unique(shard_nos)])
+        if len(rows) * self.dim * dtype.itemsize < VIEW_MIN_BYTES:
+            out = np.empty((len(rows), self.dim), dtype=dtype)
+            self._gather(out, shard_nos, rows)
+            return out
+        return self._ordered_view(hashes, shard_nos, rows, dtype)
+
+    def _gather(self, out, shard_nos, rows, block_size=65536):
+        # out[i] = row rows[i] of shard shard_nos[i], block by block
+        for start in range(0, len(rows), block_size):
+            block_shards, block_rows = shard_nos[start:start + block_size], rows[start:start + block_size]
+            for shard_no in np.unique(block_shards):
+                mask = block_shards == shard_no
+                out[start:start + len(block_rows)][mask] = self.shards[shard_no]['emb'][block_rows[mask]]
+
+    def _ordered_view(self, hashes, shard_nos, rows, dtype):
+        # large lookups of rows spread over shards (incremental runs, legacy imports, duplicate texts,
+        # chunks) are copied once into views/{sha1 of the key list}.npy in request order and
+        # memory-mapped from there; the same corpus finds the view on later runs, and only the
+        # MAX_VIEWS most recently used views are kept
+        digest = hashlib.sha1(b''.join(hashes)).hexdigest()
+        view_dir = os.path.join(self.store_dir, 'views')
+        path = os.path.join(view_dir, f"{digest}.npy")
+        if os.path.isfile(path):
+            os.utime(path)
+        else:
+            os.makedirs(view_dir, exist_ok=True)
+            tmp_path = path + '.tmp'
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', shape=(len(rows), self.dim), dtype=dtype)
+            self._gather(out, shard_nos, rows)
+            out.flush()
+            del out
+            os.replace(tmp_path, path)
+            views = sorted((os.path.join(view_dir, name) for name in os.listdir(view_dir) if name.endswith('.npy')),
+                           key=os.path.getmtime)
+            for old_path in views[:-MAX_VIEWS]:
+                os.remove(old_path)
+        return np.load(path, mmap_mode='r')
+
+
+class ShardWriter:
+    # appends rows in place into a preallocated shard; rows become visible (and survive a crash)
+    # at commit(), which happens every commit_rows rows or commit_seconds seconds and on close()
+    def __init__(self, store, capacity, commit_rows=1000, commit_seconds=300):
+        self.store = store
+        self.capacity = capacity
+        self.commit_rows = commit_rows
+        self.commit_seconds = commit_seconds
+        self.shard_no = None
+
+    def _open(self, dim):
+        self.shard_no = self.store._shard_for(self.capacity, dim)
+        shard = self.store.shards[self.shard_no]
+        self.emb = np.load(os.path.join(shard['dir'], 'emb.npy'), mmap_mode='r+')
+        self.keys = np.load(os.path.join(shard['dir'], 'keys.npy'), mmap_mode='r+')
+        self.rows = shard['rows']
+        self.last_commit = time.time()
+
+    def append(self, texts, embs):
+        embs = np.asarray(embs)
+        assert len(texts) == len(embs), f"{len(texts)}, {len(embs)}"
+        if len(texts) == 0:
+            return
+        if self.shard_no is None:
+            self._open(embs.shape[1])
+        assert self.rows + len(texts) <= len(self.emb), f"shard is full, {self.rows} + {len(texts)} > {len(self.emb)}"
+        self.emb[self.rows:self.rows + len(texts)] = embs
+        self.keys[self.rows:self.rows + len(texts)] = text_hashes(texts)
+        self.rows += len(texts)
+        committed = self.store.shards[self.shard_no]['rows']
+        if self.rows - committed >= self.commit_rows or time.time() - self.last_commit >= self.commit_seconds:
+            self.commit()
+
+    def commit(self):
+        if self.shard_no is None:
+            return
+        shard = self.store.shards[self.shard_no]
+        if self.rows == shard['rows']:
+            return
+        self.emb.flush()
+        self.keys.flush()
+        write_json_atomic(os.path.join(shard['dir'], 'header.json'),
+                          {'rows': self.rows, 'capacity': shard['capacity'], 'dim': self.emb.shape[1],
+                           'dtype': self.emb.dtype.name})
+        self.store._register(self.shard_no, self.rows)
+        self.last_commit = time.time()
+
+    def close(self):
+        self.commit()
+        self.emb = self.keys = None
+
+
+def import_legacy_npy(store, texts, legacy_path):
+    # rows of a .npy cache from before the store are the first len(legacy) texts in corpus order
+    legacy = np.load(legacy_path, mmap_mode='r')
+    if store.missing(texts[:len(legacy)]):
+        print('import', len(legacy), 'embeddings from', legacy_path)
+        store.add(texts[:len(legacy)], np.asarray(legacy))
+
+
+def import_legacy_json_batches(store, texts, legacy_dir):
+    # openai/cohere caches from before the store: {start}.json holds the embeddings of
+    # texts[start:start + batch_size] as a list of float lists. A file is parsed only while some of
+    # its texts are missing, so after the first run the JSON is never read again. A file spans the
+    # texts up to the start of the next one, the last file those up to the end of the corpus.
+    files = sorted((int(name[:-len('.json')]), name) for name in os.listdir(legacy_dir)
+                   if name.endswith('.json') and name[:-len('.json')].isdigit())
+    if not files:
+        return
+    ends = [start for start, _ in files[1:]] + [len(texts)]
+    writer = None
+    imported = 0
+    for (start, name), end in zip(files, ends):
+        if not store.missing(texts[start:end]):
+            continue
+        with open(os.path.join(legacy_dir, name)) as f:
+            embs = json.load(f)
+        cur_texts = texts[start:start + len(embs)]
+        if len(cur_texts) != len(embs):
+            print(f"skip {name} in {legacy_dir}: {len(embs)} embeddings for {len(cur_texts)} texts")
+            continue
+        if not store.missing(cur_texts):
+            continue
+        if writer is None:
+            writer = store.writer(len(texts))
+        writer.append(cur_texts, np.asarray(embs, dtype=store.dtype))
+        imported += len(cur_texts)
+    if writer is not None:
+        writer.close()
+        print('import', imported, 'embeddings from', legacy_dir)
+
+
+def encode_with_store(store, texts, encode_fn, chunk_size=None, legacy_path=None, commit_rows=1000, commit_seconds=300):
+    # only the texts the store does not have are passed to encode_fn(list_of_texts) -> (n, dim),
+    # chunk_size texts at a time; results are appended in place and committed every commit_rows
+    # rows or commit_seconds seconds, so an interrupted run resumes at the last committed row.
+    # legacy_path, a .npy file or a directory of {start}.json batches, is imported first
+    if legacy_path is not None and os.path.isfile(legacy_path):
+        import_legacy_npy(store, texts, legacy_path)
+    elif legacy_path is not None and os.path.isdir(legacy_path):
+        import_legacy_json_batches(store, texts, legacy_path)
+    missing = store.missing(texts)
+    if missing:
+        print(f"encode {len(missing)} of {len(texts)} texts missing from {store.store_dir}")
+        chunk_size = chunk_size or len(missing)
+        writer = store.writer(len(missing), commit_rows=commit_rows, commit_seconds=commit_seconds)
+        for start in trange(0, len(missing), chunk_size, desc='encode', disable=len(missing) <= chunk_size):
+            cur_texts = missing[start:start + chunk_size]
+            writer.append(cur_texts, np.asarray(encode_fn(cur_texts), dtype=store.dtype))
+        writer.close()
+    return store.get(texts)
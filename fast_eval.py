@@ -0,0 +1,138 @@
+import numpy as np
+
+# In-process evaluator with the trec_eval semantics pytrec_eval applies in
+# retrievers.calculate_retrieval_metrics, working on top-k arrays (rows into the corpus doc_ids,
+# -1 / -inf past the last hit, the layout of get_topk and run_io) of many runs at once:
+#   - a run is ranked by score, ties by doc id in reverse string order, as trec_eval does
+#   - relevant means rel > 0; ndcg_cut uses the rel value as gain, the ideal ranking is built from
+#     every relevant qrels entry, retrievable or not
+#   - map_cut, recall and ndcg divide by the number of relevant docs (0 when there is none), P@k by k,
+#     recip_rank looks at the whole run
+#   - every query of the run with a non-empty qrels entry is averaged, an empty run included;
+#     results are rounded to 5 digits
+# benchmarks/check_fast_eval.py compares it with pytrec_eval.
+
+
+def doc_id_ranks(doc_ids):
+    # position of every doc id in string order, the trec_eval tie-break is the reverse of it
+    order = np.argsort(np.array([str(d) for d in doc_ids], dtype=object), kind='stable')
+    ranks = np.empty(len(doc_ids), dtype=np.int64)
+    ranks[order] = np.arange(len(doc_ids))
+    return ranks
+
+
+class QrelsIndex:
+    # qrels {qid: {doc_id: rel}} of the queries query_ids as sorted (query row * num_docs + doc row)
+    # keys for vectorized lookups, plus the per-query number of relevant docs and ideal gains
+    # (doc_index and doc_ranks can be shared by the indexes of many query batches)
+    def __init__(self, qrels, query_ids, doc_ids, doc_index=None, doc_ranks=None):
+        doc_index = doc_index if doc_index is not None else {did: i for i, did in enumerate(doc_ids)}
+        self.query_ids = [str(qid) for qid in query_ids]
+        self.num_docs = len(doc_ids)
+        self.doc_ranks = doc_ranks if doc_ranks is not None else doc_id_ranks(doc_ids)
+        self.judged = np.array([len(qrels.get(qid, {})) > 0 for qid in self.query_ids])
+        keys, gains, ideal = [], [], []
+        for row, qid in enumerate(self.query_ids):
+            rels = {did: rel for did, rel in qrels.get(qid, {}).items() if rel > 0}
+            ideal.append(sorted(rels.values(), reverse=True))
+            for did, rel in rels.items():
+                if did in doc_index:
+                    keys.append(row * self.num_docs + doc_index[did])
+                    gains.append(rel)
+        order = np.argsort(np.array(keys, dtype=np.int64), kind='stable')
+        self.keys = np.array(keys, dtype=np.int64)[order]
+        self.gains = np.array(gains, dtype=np.float64)[order]
+        self.any_relevant = np.zeros(self.num_docs, dtype=bool)
+        self.any_relevant[self.keys % max(self.num_docs, 1)] = True
+        self.num_rel = np.array([len(g) for g in ideal], dtype=np.float64)
+        self.ideal_gains = np.zeros((len(ideal), max([len(g) for g in ideal], default=0)))
+        for row, g in enumerate(ideal):
+            self.ideal_gains[row, :len(g)] = g
+
+    def lookup(self, topk_idx):
+        # (..., num_queries, k) corpus rows -> rel of every hit, 0 for non-relevant and padding;
+        # only hits on a doc that is relevant to some query are looked up
+        gains = np.zeros(topk_idx.shape)
+        candidates = np.nonzero((topk_idx >= 0) & self.any_relevant[np.maximum(topk_idx, 0)])
+        keys = candidates[-2] * self.num_docs + topk_idx[candidates]
+        pos = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        found = self.keys[pos] == keys
+        gains[tuple(c[found] for c in candidates)] = self.gains[pos[found]]
+        return gains
+
+
+def rank_topk(topk_idx, topk_scores, doc_ranks):
+    # trec_eval order: score descending, ties by doc id descending, padding (-inf) last; only rows
+    # that are not in that order already (unsorted or with tied scores) are sorted
+    shape = np.shape(topk_idx)
+    topk_idx = np.array(topk_idx, dtype=np.int64).reshape(-1, shape[-1])
+    topk_scores = np.where(topk_idx >= 0, np.asarray(topk_scores, dtype=np.float64).reshape(topk_idx.shape), -np.inf)
+    head, tail = topk_scores[:, :-1], topk_scores[:, 1:]
+    rows = np.flatnonzero(((head < tail) | ((head == tail) & (tail > -np.inf))).any(axis=1))
+    if len(rows):
+        idx, scores = topk_idx[rows], topk_scores[rows]
+        order = np.lexsort((-doc_ranks[np.maximum(idx, 0)], -scores), axis=-1)
+        topk_idx[rows] = np.take_along_axis(idx, order, -1)
+        topk_scores[rows] = np.take_along_axis(scores, order, -1)
+    return topk_idx.reshape(shape), topk_scores.reshape(shape)
+
+
+def evaluate_topk(topk_idx, topk_scores, qrels_index, k_values=[1, 5, 10, 25, 50, 100], per_query=False):
+    # topk_idx/topk_scores (num_runs, num_queries, k) or (num_queries, k) in qrels_index.query_ids order;
+    # returns {metric: (num_runs,) or scalar} named as in calculate_retrieval_metrics, or the
+    # per-query values when per_query is set
+    single = np.ndim(topk_idx) == 2
+    if single:
+        topk_idx, topk_scores = np.asarray(topk_idx)[None], np.asarray(topk_scores)[None]
+    topk_idx, topk_scores = rank_topk(topk_idx, topk_scores, qrels_index.doc_ranks)
+    gains = qrels_index.lookup(topk_idx) * (topk_scores > -np.inf)
+    # MRR looks at the whole run, everything else at the first max(k_values) ranks
+    first_hit = np.argmax(gains > 0, axis=-1)
+    reciprocal_rank = np.where((gains > 0).any(axis=-1), 1.0 / (first_hit + 1), 0.0)
+    gains = gains[..., :max(k_values)]
+    relevant = gains > 0
+    num_rel = qrels_index.num_rel
+    safe_num_rel = np.maximum(num_rel, 1)
+    ranks = np.arange(1, gains.shape[-1] + 1)
+    hits = np.cumsum(relevant, axis=-1)
+    precision_at_hit = np.where(relevant, hits / ranks, 0.0)
+    discounted = gains / np.log2(ranks + 1)
+    ideal = qrels_index.ideal_gains / np.log2(np.arange(1, qrels_index.ideal_gains.shape[1] + 1) + 1)
+
+    out = {}
+    for k in k_values:
+        dcg = discounted[..., :k].sum(axis=-1)
+        idcg = ideal[:, :k].sum(axis=-1)
+        out[f"NDCG@{k}"] = np.where(idcg > 0, dcg / np.where(idcg > 0, idcg, 1), 0.0)
+    for k in k_values:
+        out[f"MAP@{k}"] = np.where(num_rel > 0, precision_at_hit[..., :k].sum(axis=-1) / safe_num_rel, 0.0)
+    for k in k_values:
+        out[f"Recall@{k}"] = np.where(num_rel > 0, relevant[..., :k].sum(axis=-1) / safe_num_rel, 0.0)
+    for k in k_values:
+        out[f"P@{k}"] = relevant[..., :k].sum(axis=-1) / k
+    out["MRR"] = reciprocal_rank
+
+    evaluated = np.broadcast_to(qrels_index.judged, relevant.shape[:-1])
+    if per_query:
+        if single:
+            return {name: values[0] for name, values in out.items()}, evaluated[0]
+        return out, evaluated
+    num_evaluated = np.maximum(evaluated.sum(axis=-1), 1)
+    means = {name: np.round((values * evaluated).sum(axis=-1) / num_evaluated, 5) for name, values in out.items()}
+    if single:
+        return {name: float(values[0]) for name, values in means.items()}
+    return means
+
+
+def calculate_retrieval_metrics_np(results, qrels, doc_ids, k_values=[1, 5, 10, 25, 50, 100], doc_index=None):
+    # drop-in for calculate_retrieval_metrics on {qid: {doc_id: score}} runs
+    doc_index = doc_index if doc_index is not None else {did: i for i, did in enumerate(doc_ids)}
+    query_ids = list(results)
+    k = max([len(r) for r in results.values()], default=0)
+    topk_idx = np.full((len(query_ids), max(k, 1)), -1, dtype=np.int64)
+    topk_scores = np.full((len(query_ids), max(k, 1)), -np.inf)
+    for row, qid in enumerate(query_ids):
+        topk_idx[row, :len(results[qid])] = [doc_index[did] for did in results[qid]]
+        topk_scores[row, :len(results[qid])] = list(results[qid].values())
+    return evaluate_topk(topk_idx, topk_scores, QrelsIndex(qrels, query_ids, doc_ids, doc_index=doc_index),
+                         k_values=k_values)
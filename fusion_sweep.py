@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+from tqdm import trange
+from numpy.lib.format import open_memmap
+from ann_index import normalize_rows, corpus_fingerprint
+from emb_store import write_json_atomic
+from unit_table import UnitTable, load_or_build_unit_table
+from retrievers import (no_grad, fusion_model_path, load_fusion_encoder, encode_fusion_units, get_excluded_index,
+                        dense_scores, fuse_unit_scores, get_topk)
+from fast_eval import QrelsIndex, evaluate_topk
+
+# Sweep of the separate-embedding settings of retrieval_sbert_bge_fusion_desc. The unit embedding
+# there is normalize(w*d + (1-w)*q) of the normalized sub-query q and description d, so its cosine
+# with a document is
+#     (w*Sd + (1-w)*Sq) / sqrt(w^2 + (1-w)^2 + 2w(1-w) q.d)
+# with Sq, Sd the cosines of q and d with the document. Sq and Sd of every unit are computed once
+# and kept as memmaps under --cache_dir/unit_sims/, every (desc_weight, fusion_method) setting is
+# then an elementwise combination plus top-k, without encoding or a corpus GEMM, and all settings
+# are evaluated in one batch by fast_eval. The results equal separate runs up to float rounding.
+# embed_method joint encodes "q d" as one text and has no such decomposition, run it through run.py.
+UNIT_SIMS_VERSION = 1
+
+
+def unit_sims_dir(cache_dir, model_id, documents, q_texts, d_texts):
+    digest = hashlib.sha1(corpus_fingerprint(documents).encode('utf-8'))
+    for q_text, d_text in zip(q_texts, d_texts):
+        digest.update(hashlib.sha1(q_text.encode('utf-8')).digest())
+        digest.update(hashlib.sha1(d_text.encode('utf-8')).digest())
+    return os.path.join(cache_dir, 'unit_sims', fusion_model_path(model_id).replace('/', '_'),
+                        f"v{UNIT_SIMS_VERSION}_{digest.hexdigest()[:16]}")
+
+
+@no_grad
+def build_unit_sims(sims_dir, q_texts, d_texts, model_id, cache_dir, task, documents, long_context,
+                    unit_block_size=256, **kwargs):
+    model, doc_emb, batch_size = load_fusion_encoder(model_id, cache_dir, task, documents, long_context, **kwargs)
+    _, q_embs, d_embs = encode_fusion_units(model, q_texts, d_texts, batch_size=batch_size)
+    q_embs, d_embs = normalize_rows(q_embs), normalize_rows(d_embs)
+    os.makedirs(sims_dir, exist_ok=True)
+    print(f"unit sims: {2 * len(q_texts) * len(documents) * 4 / 2 ** 30:.2f} GiB in {sims_dir}")
+    np.save(os.path.join(sims_dir, 'qd.npy'), np.sum(q_embs * d_embs, axis=1))
+    for name, embs in (('sims_q.npy', q_embs), ('sims_d.npy', d_embs)):
+        sims = open_memmap(os.path.join(sims_dir, name), mode='w+', dtype=np.float32,
+                           shape=(len(embs), len(documents)))
+        for start in trange(0, len(embs), unit_block_size, desc=name):
+            sims[start:start + unit_block_size] = dense_scores(embs[start:start + unit_block_size], doc_emb,
+                                                                      normalize=False)
+        sims.flush()
+        del sims
+    # meta.json is written last and marks the sims as complete
+    write_json_atomic(os.path.join(sims_dir, 'meta.json'), {
+        'version': UNIT_SIMS_VERSION, 'num_units': len(q_texts), 'num_docs': len(documents)})
+
+
+def load_or_build_unit_sims(q_texts, d_texts, model_id, cache_dir, task, documents, long_context,
+                            ignore_cache=False, **kwargs):
+    sims_dir = unit_sims_dir(cache_dir, model_id, documents, q_texts, d_texts)
+    if not os.path.isfile(os.path.join(sims_dir, 'meta.json')) or ignore_cache:
+        build_unit_sims(sims_dir, q_texts, d_texts, model_id, cache_dir, task, documents, long_context, **kwargs)
+    else:
+        print('load unit sims from', sims_dir)
+    return (np.load(os.path.join(sims_dir, 'sims_q.npy'), mmap_mode='r'),
+            np.load(os.path.join(sims_dir, 'sims_d.npy'), mmap_mode='r'),
+            np.load(os.path.join(sims_dir, 'qd.npy')))
+
+
+def sweep_fusion_desc(queries, query_ids, documents, doc_ids, task, model_id, cache_dir, excluded_ids,
+                      long_context, qrels, desc_weights, fusion_methods=("sum", "max"), unit_table=None, k=1000,
+                      **kwargs):
+    # -> [{'desc_weight', 'fusion_method', 'seconds', metrics...}] in grid order
+    if unit_table is None:
+        unit_table = UnitTable.from_queries(query_ids, queries)
+    unit_offsets, unit_columns = unit_table.select(query_ids, columns=("sub_query", "desc"))
+    start_time = time.time()
+    sims_q, sims_d, qd = load_or_build_unit_sims(unit_columns["sub_query"], unit_columns["desc"], model_id,
+                                                 cache_dir, task, documents, long_context, **kwargs)
+    print(f"unit sims ready in {time.time() - start_time:.1f}s")
+
+    excluded_rows = kwargs.get("excluded_rows")
+    if excluded_rows is None:
+        excluded_rows = get_excluded_index(doc_ids, excluded_ids)
+    settings = [(w, m) for w in desc_weights for m in fusion_methods]
+    topk_idx = np.full((len(settings), len(query_ids), k), -1, dtype=np.int64)
+    topk_scores = np.full((len(settings), len(query_ids), k), -np.inf, dtype=np.float32)
+    seconds = np.zeros(len(settings))
+    query_block_size = kwargs.get("query_block_size", 16)
+    for start in trange(0, len(query_ids), query_block_size, desc="Fusion sweep"):
+        block_qids = query_ids[start:start + query_block_size]
+        block_offsets = unit_offsets[start:start + len(block_qids) + 1]
+        rows = slice(block_offsets[0], block_offsets[-1])
+        block_q, block_d, block_qd = np.asarray(sims_q[rows]), np.asarray(sims_d[rows]), qd[rows]
+        excluded = [excluded_rows.get(str(qid), np.zeros(0, dtype=np.int64)) for qid in block_qids]
+        for si, (w, fusion_method) in enumerate(settings):
+            setting_start = time.time()
+            norm = np.sqrt(np.maximum(w * w + (1 - w) * (1 - w) + 2 * w * (1 - w) * block_qd, 1e-12))
+            block_sims = (w * block_d + (1 - w) * block_q) / norm[:, None].astype(np.float32)
+            fusion_block = fuse_unit_scores(block_sims, block_offsets - block_offsets[0], fusion_method)
+            idx, scores = get_topk(fusion_block, k=k, excluded=excluded)
+            topk_idx[si, start:start + len(block_qids), :idx.shape[1]] = idx
+            topk_scores[si, start:start + len(block_qids), :idx.shape[1]] = scores
+            seconds[si] += time.time() - setting_start
+
+    # all settings are evaluated in one batch on the top-k arrays
+    metrics = evaluate_topk(topk_idx, topk_scores, QrelsIndex(qrels, query_ids, doc_ids))
+    out = []
+    for si, (w, fusion_method) in enumerate(settings):
+        out.append({"desc_weight": w, "fusion_method": fusion_method, "seconds": round(float(seconds[si]), 2),
+                    **{name: float(values[si]) for name, values in metrics.items()}})
+    return out
+
+
+def write_sweep_table(rows, output_dir, columns=("NDCG@10", "Recall@10", "Recall@100", "MAP@100", "MRR")):
+    with open(os.path.join(output_dir, 'fusion_sweep.json'), 'w') as f:
+        json.dump(rows, f, indent=2)
+    header = ["desc_weight", "fusion_method", *columns, "seconds"]
+    lines = ["\t".join(header)] + ["\t".join(str(row[c]) for c in header) for row in rows]
+    with open(os.path.join(output_dir, 'fusion_sweep.tsv'), 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n".join(lines))
+
+
+if __name__ == '__main__':
+    from run import TASKS, add_common_args, get_output_dir, get_reasoning_path, load_examples, load_corpus
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, required=True, choices=TASKS)
+    parser.add_argument('--reasoning', type=str, default=None)
+    parser.add_argument('--desc_weights', type=float, nargs='+', default=[round(0.1 * i, 1) for i in range(11)])
+    parser.add_argument('--fusion_methods', type=str, nargs='+', default=['sum', 'max'], choices=['sum', 'max'])
+    add_common_args(parser)
+    args = parser.parse_args()
+
+    examples = load_examples(args.task, args.cache_dir, input_file=args.input_file, reasoning=args.reasoning)
+    doc_ids, documents, doc_index = load_corpus(args.task, args.long_context, args.cache_dir)
+    unit_table = None
+    if args.reasoning is not None and args.input_file is None:
+        unit_table = load_or_build_unit_table(get_reasoning_path(args.task, args.reasoning),
+                                              ignore_cache=args.ignore_cache)
+    key = 'gold_ids_long' if args.long_context else 'gold_ids'
+    query_ids = [e['id'] for e in examples]
+    excluded_ids = {e['id']: e['excluded_ids'] for e in examples}
+    qrels = {e['id']: {gid: 1 for gid in e[key]} for e in examples}
+    kwargs = {'emb_dtype': args.emb_dtype, 'ignore_cache': args.ignore_cache}
+    if args.encode_batch_size > 0:
+        kwargs['batch_size'] = args.encode_batch_size
+    rows = sweep_fusion_desc(
+        [e['query'] for e in examples], query_ids, documents, doc_ids, args.task, 'sbert_fusion_desc', args.cache_dir,
+        excluded_ids, args.long_context, qrels, args.desc_weights, args.fusion_methods, unit_table=unit_table,
+        excluded_rows=get_excluded_index(doc_ids, excluded_ids, doc_index=doc_index), **kwargs)
+    output_dir = get_output_dir(args.output_dir, args.task, 'sbert_fusion_desc', args.long_context)
+    os.makedirs(output_dir, exist_ok=True)
+    write_sweep_table(rows, output_dir)
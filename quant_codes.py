@@ -0,0 +1,125 @@
+import os
+import json
+import numpy as np
+from emb_store import write_json_atomic
+from ann_index import normalize_rows, corpus_fingerprint
+
+# bump whenever the on-disk layout or the quantization changes, old codes are then rebuilt
+QUANT_CODES_VERSION = 1
+QUANT_KINDS = ('int8', 'binary')
+
+
+class QuantizedCodes:
+    # Compact codes of the normalized document embeddings for a two-stage search: the codes
+    # shortlist candidates for every query, the full-precision vectors of the store (read through
+    # the memmap, shortlisted rows only) rescore them.
+    #   int8    per-dimension symmetric scale, 4x smaller than float32
+    #   binary  sign bits packed 8 per byte, 32x smaller; scored asymmetrically against the float query
+    def __init__(self, kind, codes, scale=None, dim=None, fingerprint=None):
+        assert kind in QUANT_KINDS, f"unsupported quantization {kind}"
+        self.kind = kind
+        self.codes = codes
+        self.scale = scale
+        self.dim = dim
+        self.fingerprint = fingerprint
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    @classmethod
+    def build(cls, kind, doc_emb, fingerprint=None, block_size=65536):
+        dim = doc_emb.shape[1]
+        scale = None
+        if kind == 'int8':
+            max_abs = np.zeros(dim, dtype=np.float32)
+            for start in range(0, len(doc_emb), block_size):
+                max_abs = np.maximum(max_abs, np.abs(normalize_rows(doc_emb[start:start + block_size])).max(axis=0))
+            scale = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+            codes = np.empty((len(doc_emb), dim), dtype=np.int8)
+        else:
+            codes = np.empty((len(doc_emb), (dim + 7) // 8), dtype=np.uint8)
+        for start in range(0, len(doc_emb), block_size):
+            block = normalize_rows(doc_emb[start:start + block_size])
+            if kind == 'int8':
+                codes[start:start + len(block)] = np.clip(np.rint(block / scale), -127, 127)
+            else:
+                codes[start:start + len(block)] = np.packbits(block > 0, axis=1)
+        return cls(kind, codes, scale=scale, dim=dim, fingerprint=fingerprint)
+
+    def approx_scores(self, query_emb, block_size=65536):
+        query_emb = normalize_rows(query_emb)
+        if self.kind == 'int8':
+            query_emb = query_emb * self.scale
+        scores = np.empty((len(query_emb), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), block_size):
+            block = np.asarray(self.codes[start:start + block_size])
+            if self.kind == 'int8':
+                block = block.astype(np.float32)
+            else:
+                block = np.unpackbits(block, axis=1, count=self.dim).astype(np.float32) * 2 - 1
+            scores[:, start:start + len(block)] = query_emb @ block.T
+        return scores
+
+    def search(self, query_emb, doc_emb, shortlist=4000, scale=1):
+        # per query: (shortlisted rows in ascending order, full-precision cosine scores x scale)
+        approx = self.approx_scores(query_emb)
+        shortlist = min(shortlist, approx.shape[1])
+        if shortlist < approx.shape[1]:
+            rows = np.sort(np.argpartition(-approx, shortlist - 1, axis=1)[:, :shortlist], axis=1)
+        else:
+            rows = np.tile(np.arange(approx.shape[1]), (len(approx), 1))
+        query_emb = normalize_rows(query_emb)
+        out = []
+        for q, cur_rows in zip(query_emb, rows):
+            scores = normalize_rows(doc_emb[cur_rows]) @ q
+            if scale != 1:
+                scores *= scale
+            out.append((cur_rows, scores))
+        return out
+
+    def save(self, codes_dir):
+        os.makedirs(codes_dir, exist_ok=True)
+        np.save(os.path.join(codes_dir, 'codes.npy'), self.codes)
+        if self.scale is not None:
+            np.save(os.path.join(codes_dir, 'scale.npy'), self.scale)
+        # meta.json is written last and marks the codes as complete
+        write_json_atomic(os.path.join(codes_dir, 'meta.json'), {
+            'version': QUANT_CODES_VERSION,
+            'kind': self.kind,
+            'dim': self.dim,
+            'num_docs': len(self.codes),
+            'corpus_sha1': self.fingerprint,
+        })
+
+    @classmethod
+    def load(cls, codes_dir, mmap_mode='r'):
+        with open(os.path.join(codes_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != QUANT_CODES_VERSION:
+            raise ValueError(f"quantized codes version {meta['version']} != {QUANT_CODES_VERSION}")
+        scale_path = os.path.join(codes_dir, 'scale.npy')
+        return cls(meta['kind'], np.load(os.path.join(codes_dir, 'codes.npy'), mmap_mode=mmap_mode),
+                   scale=np.load(scale_path) if os.path.isfile(scale_path) else None,
+                   dim=meta['dim'], fingerprint=meta['corpus_sha1'])
+
+
+def load_or_build_codes(store, documents, doc_emb, kind, ignore_cache=False):
+    # codes live next to the embeddings in the store and are keyed by the corpus texts and their order
+    fingerprint = corpus_fingerprint(documents)
+    codes_dir = os.path.join(store.store_dir, 'codes', f"{kind}_v{QUANT_CODES_VERSION}_{fingerprint[:16]}")
+    codes = None
+    if os.path.isfile(os.path.join(codes_dir, 'meta.json')) and not ignore_cache:
+        codes = QuantizedCodes.load(codes_dir)
+        if codes.fingerprint == fingerprint:
+            print('load', kind, 'codes from', codes_dir)
+        else:
+            codes = None
+    if codes is None:
+        print(f"build {kind} codes for {len(documents)} docs")
+        QuantizedCodes.build(kind, doc_emb, fingerprint=fingerprint).save(codes_dir)
+        codes = QuantizedCodes.load(codes_dir)
+    full_bytes = len(doc_emb) * doc_emb.shape[1] * 4
+    print(f"{kind} codes: {codes.nbytes / 2 ** 20:.1f} MiB resident instead of {full_bytes / 2 ** 20:.1f} MiB "
+          f"of float32 embeddings ({full_bytes / max(codes.nbytes, 1):.1f}x smaller)")
+    return codes
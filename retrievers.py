@@ -1,25 +1,41 @@
 import os.path
-import re
-import time
-import torch
+import gc
+import sys
 import json
-import cohere
+import functools
 import numpy as np
-import vertexai
-import pytrec_eval
-import tiktoken
-import voyageai
 from tqdm import tqdm,trange
-import torch.nn.functional as F
-from gritlm import GritLM
-from openai import OpenAI
-from transformers import AutoTokenizer, AutoModel
-from InstructorEmbedding import INSTRUCTOR
-
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-# from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
-from torchmetrics.functional.pairwise import pairwise_cosine_similarity
+from bm25_index import get_analyzer, load_or_build_bm25_index
+from emb_store import EmbeddingStore, encode_with_store
+from api_client import EmbeddingClient
+from ann_index import normalize_rows, load_or_build_ivf
+from quant_codes import load_or_build_codes
+from unit_table import UnitTable
+from doc_chunks import encode_chunks_with_store, pool_chunk_scores
+
+# backend dependencies (torch, transformers, API SDKs) are imported inside the retrieval functions
+# that need them, so importing this module, and running BM25, pulls in none of them
+
+def no_grad(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        import torch
+        with torch.no_grad():
+            return func(*args, **kwargs)
+    return wrapper
+
+# the last loaded model stays resident, so run_batch.py loads it once for all tasks;
+# loading a different one drops it first to free GPU memory
+MODEL_CACHE = {}
+
+def get_model(key, load_fn):
+    if key not in MODEL_CACHE:
+        MODEL_CACHE.clear()
+        gc.collect()
+        if 'torch' in sys.modules and sys.modules['torch'].cuda.is_available():
+            sys.modules['torch'].cuda.empty_cache()
+        MODEL_CACHE[key] = load_fn()
+    return MODEL_CACHE[key]
 
 def cut_text(text,tokenizer,threshold):
     text_ids = tokenizer(text)['input_ids']
@@ -34,55 +50,24 @@ def cut_text_openai(text,tokenizer,threshold=6000):
     return text
 
 def get_embedding_google(texts,task,model,dimensionality=768):
-    success = False
-    while not success:
-        try:
-            new_texts = []
-            for t in texts:
-                if t.strip()=='':
-                    print('empty content')
-                    new_texts.append('empty')
-                else:
-                    new_texts.append(t)
-            texts = new_texts
-            inputs = [TextEmbeddingInput(text, task) for text in texts]
-            kwargs = dict(output_dimensionality=dimensionality) if dimensionality else {}
-            embeddings = model.get_embeddings(inputs, **kwargs)
-            success = True
-        except Exception as e:
-            print(e)
+    from vertexai.language_models import TextEmbeddingInput
+    new_texts = []
+    for t in texts:
+        if t.strip()=='':
+            print('empty content')
+            new_texts.append('empty')
+        else:
+            new_texts.append(t)
+    inputs = [TextEmbeddingInput(text, task) for text in new_texts]
+    kwargs = dict(output_dimensionality=dimensionality) if dimensionality else {}
+    embeddings = model.get_embeddings(inputs, **kwargs)
     return [embedding.values for embedding in embeddings]
 
-def get_embedding_openai(texts, openai_client,tokenizer,model="text-embedding-3-large"):
-    texts =[json.dumps(text.replace("\n", " ")) for text in texts]
-    success = False
-    threshold = 6000
-    count = 0
-    cur_emb = None
-    exec_count = 0
-    while not success:
-        exec_count += 1
-        if exec_count>5:
-            print('execute too many times')
-            exit(0)
-        try:
-            emb_obj = openai_client.embeddings.create(input=texts, model=model).data
-            cur_emb = [e.embedding for e in emb_obj]
-            success = True
-        except Exception as e:
-            print(e)
-            count += 1
-            threshold -= 500
-            if count>4:
-                print('openai cut',count)
-                exit(0)
-            new_texts = []
-            for t in texts:
-                new_texts.append(cut_text_openai(text=t, tokenizer=tokenizer,threshold=threshold))
-            texts = new_texts
-    if cur_emb is None:
-        raise ValueError("Fail to embed, openai")
-    return cur_emb
+def get_api_client(embed_fn, name, truncate_fn=None, **kwargs):
+    # retries, backoff, rate limits and concurrency of the API backends, see api_client.EmbeddingClient
+    return EmbeddingClient(embed_fn, concurrency=kwargs.get('api_concurrency',4),
+                           requests_per_minute=kwargs.get('api_rpm'), tokens_per_minute=kwargs.get('api_tpm'),
+                           truncate_fn=truncate_fn, name=name)
 
 TASK_MAP = {
     'biology': 'Biology',
@@ -101,6 +86,7 @@ def add_instruct_list(texts,task,instruction):
     return [[instruction.format(task=task),t] for t in texts]
 
 def last_token_pool(last_hidden_states,attention_mask):
+    import torch
     left_padding = (attention_mask[:, -1].sum() == attention_mask.shape[0])
     if left_padding:
         return last_hidden_states[:, -1]
@@ -109,113 +95,430 @@ def last_token_pool(last_hidden_states,attention_mask):
         batch_size = last_hidden_states.shape[0]
         return last_hidden_states[torch.arange(batch_size, device=last_hidden_states.device), sequence_lengths]
 
-def get_scores(query_ids,doc_ids,scores,excluded_ids):
+def get_excluded_rows(doc_index,excluded):
+    return np.array(sorted({doc_index[did] for did in excluded if did!="N/A" and did in doc_index}),dtype=np.int64)
+
+def topk_to_dict(doc_ids,topk_idx,topk_scores):
+    # excluded docs are masked with -inf and never reported
+    return {str(doc_ids[i]): s for i,s in zip(topk_idx.tolist(),topk_scores.tolist()) if s!=-np.inf}
+
+def get_excluded_index(doc_ids,excluded_ids,doc_index=None):
+    # qid -> int array of the excluded rows, built once per run and shared by all retrievers
+    if doc_index is None:
+        doc_index = {did:i for i,did in enumerate(doc_ids)}
+    for query_id in excluded_ids:
+        assert len(excluded_ids[query_id])==0 or (isinstance(excluded_ids[query_id][0], str) and isinstance(excluded_ids[query_id], list))
+    return {str(query_id):get_excluded_rows(doc_index,ids) for query_id,ids in excluded_ids.items()}
+
+def get_scores(query_ids,doc_ids,scores,excluded_ids,excluded_rows=None,k=1000,query_block_size=256):
     assert len(scores)==len(query_ids),f"{len(scores)}, {len(query_ids)}"
     assert len(scores[0])==len(doc_ids),f"{len(scores[0])}, {len(doc_ids)}"
+    if excluded_rows is None:
+        excluded_rows = get_excluded_index(doc_ids,{query_id:excluded_ids[query_id] for query_id in query_ids})
     emb_scores = {}
-    for query_id,doc_scores in zip(query_ids,scores):
-        cur_scores = {}
-        assert len(excluded_ids[query_id])==0 or (isinstance(excluded_ids[query_id][0], str) and isinstance(excluded_ids[query_id], list))
-        for did,s in zip(doc_ids,doc_scores):
-            cur_scores[str(did)] = s
-        for did in set(excluded_ids[str(query_id)]):
-            if did!="N/A":
-                cur_scores.pop(did)
-        cur_scores = sorted(cur_scores.items(),key=lambda x:x[1],reverse=True)[:1000]
-        emb_scores[str(query_id)] = {}
-        for pair in cur_scores:
-            emb_scores[str(query_id)][pair[0]] = pair[1]
+    for start in range(0,len(query_ids),query_block_size):
+        block_qids = query_ids[start:start+query_block_size]
+        excluded = [excluded_rows[str(query_id)] for query_id in block_qids]
+        topk_idx,topk_scores = get_topk(scores[start:start+query_block_size],k=k,excluded=excluded)
+        for query_id,idx,vals in zip(block_qids,topk_idx,topk_scores):
+            emb_scores[str(query_id)] = topk_to_dict(doc_ids,idx,vals)
+    return emb_scores
+
+def dense_scores(query_emb, doc_emb, normalize=True, scale=1, doc_block_size=65536):
+    # (queries x docs) float32 scores; doc_emb may be a memmap of the embedding store, it is read
+    # one block of rows at a time and never loaded into RAM as a whole
+    query_emb = np.asarray(query_emb, dtype=np.float32)
+    if normalize:
+        query_emb = normalize_rows(query_emb)
+    scores = np.empty((len(query_emb), len(doc_emb)), dtype=np.float32)
+    for start in range(0, len(doc_emb), doc_block_size):
+        block = np.asarray(doc_emb[start:start + doc_block_size], dtype=np.float32)
+        if normalize:
+            block = normalize_rows(block)
+        scores[:, start:start + len(block)] = query_emb @ block.T
+    if scale != 1:
+        scores *= scale
+    return scores
+
+def get_ann_scores(query_ids, doc_ids, candidates, excluded_rows, k=1000):
+    # candidates: one (sorted doc rows, scores) pair per query, see IVFIndex.search
+    emb_scores = {}
+    for query_id, (rows, scores) in zip(query_ids, candidates):
+        excluded = np.flatnonzero(np.isin(rows, excluded_rows[str(query_id)]))
+        topk_idx, topk_scores = get_topk(scores[None], k=k, excluded=[excluded])
+        emb_scores[str(query_id)] = topk_to_dict(doc_ids, rows[topk_idx[0]], topk_scores[0])
     return emb_scores
 
+def chunked_dense_search(query_emb, chunk_emb, chunk_doc, query_ids, doc_ids, excluded_ids, scale=1, normalize=True, **kwargs):
+    # cosine with every chunk, pooled per doc (chunk_pooling 'max' or 'mean') one block of queries at a
+    # time, so only query_block_size x num_chunks scores are held at once
+    excluded_rows = kwargs.get('excluded_rows')
+    if excluded_rows is None:
+        excluded_rows = get_excluded_index(doc_ids, {query_id: excluded_ids[query_id] for query_id in query_ids})
+    pooling = kwargs.get('chunk_pooling', 'max')
+    query_block_size = kwargs.get('query_block_size', 16)
+    emb_scores = {}
+    for start in range(0, len(query_ids), query_block_size):
+        chunk_scores = dense_scores(query_emb[start:start + query_block_size], chunk_emb, normalize=normalize, scale=scale)
+        scores = pool_chunk_scores(chunk_scores, chunk_doc, len(doc_ids), pooling)
+        emb_scores.update(get_scores(query_ids[start:start + query_block_size], doc_ids, scores, excluded_ids,
+                                     excluded_rows=excluded_rows))
+    return emb_scores
 
-@torch.no_grad()
+def encode_doc_chunks(store, documents, encode_fn, tokenize, detokenize, max_window, **kwargs):
+    # --chunk_tokens windows with --chunk_overlap shared tokens, never longer than max_window, the
+    # longest text the encoder takes whole; -> (chunk embeddings, chunk_doc), see doc_chunks.py
+    window = min(kwargs['chunk_tokens'], max_window)
+    if window < kwargs['chunk_tokens']:
+        print(f"chunk_tokens {kwargs['chunk_tokens']} is capped at {window} tokens for {store.spec['model_id']}")
+    return encode_chunks_with_store(store, documents, encode_fn, tokenize, detokenize, window,
+                                    overlap=kwargs.get('chunk_overlap', 0), ignore_cache=kwargs.get('ignore_cache', False),
+                                    chunk_size=kwargs.get('encode_chunk_size'))
+
+def dense_search(query_emb, doc_emb, store, documents, query_ids, doc_ids, excluded_ids, scale=1, chunk_doc=None,
+                 normalize=True, **kwargs):
+    # exact cosine search, or one of two approximate first stages persisted in the embedding store:
+    #   ann='ivf'             IVF index, ann_nlist lists of which a query visits ann_nprobe
+    #   quant='int8'/'binary' compact codes shortlist quant_shortlist docs, rescored at full precision
+    # with chunk_doc, doc_emb holds chunk embeddings and the search is exact with pooled chunk scores;
+    # normalize=False for stores that hold normalized embeddings (sbert/bge)
+    if chunk_doc is not None:
+        return chunked_dense_search(query_emb, doc_emb, chunk_doc, query_ids, doc_ids, excluded_ids, scale=scale,
+                                    normalize=normalize, **kwargs)
+    excluded_rows = kwargs.get('excluded_rows')
+    if kwargs.get('ann') == 'ivf' or kwargs.get('quant') is not None:
+        if excluded_rows is None:
+            excluded_rows = get_excluded_index(doc_ids, {query_id: excluded_ids[query_id] for query_id in query_ids})
+        if kwargs.get('ann') == 'ivf':
+            index = load_or_build_ivf(store, documents, doc_emb, nlist=kwargs.get('ann_nlist'),
+                                      ignore_cache=kwargs.get('ignore_cache', False))
+            candidates = index.search(query_emb, doc_emb, nprobe=kwargs.get('ann_nprobe', 32), scale=scale)
+        else:
+            codes = load_or_build_codes(store, documents, doc_emb, kwargs['quant'],
+                                        ignore_cache=kwargs.get('ignore_cache', False))
+            candidates = codes.search(query_emb, doc_emb, shortlist=kwargs.get('quant_shortlist', 4000), scale=scale)
+        return get_ann_scores(query_ids, doc_ids, candidates, excluded_rows)
+    if kwargs.get('num_workers', 1) > 1:
+        if excluded_rows is None:
+            excluded_rows = get_excluded_index(doc_ids, {query_id: excluded_ids[query_id] for query_id in query_ids})
+        return get_sharded_scores(query_ids, doc_ids, DenseShardScorer(query_emb, doc_emb, normalize=normalize, scale=scale),
+                                  excluded_rows, num_workers=kwargs['num_workers'])
+    scores = dense_scores(query_emb, doc_emb, normalize=normalize, scale=scale)
+    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids,excluded_rows=excluded_rows)
+
+def fuse_unit_scores(unit_scores, unit_offsets, fusion_method="sum"):
+    # (units x docs) -> (queries x docs), query i owns the rows unit_offsets[i]:unit_offsets[i+1]
+    if fusion_method == "sum":
+        return np.add.reduceat(unit_scores, unit_offsets[:-1], axis=0)
+    return np.maximum.reduceat(unit_scores, unit_offsets[:-1], axis=0)
+
+def get_topk(scores, k=1000, excluded=None):
+    # top-k of every row of a (queries x docs) score matrix with argpartition instead of a full sort,
+    # ordered by descending score; ties keep the lower column first, like sorted() on the docs did.
+    # `excluded` holds one array of columns per row, they are set to -inf on a copy of the block
+    if excluded is not None:
+        scores = np.array(scores, copy=True)
+        if not np.issubdtype(scores.dtype, np.floating):
+            scores = scores.astype(np.float64)
+        for r, cols in enumerate(excluded):
+            scores[r, cols] = -np.inf
+    scores = np.asarray(scores)
+    num_rows, num_cols = scores.shape
+    k = min(k, num_cols)
+    if k == 0:
+        return np.zeros((num_rows, 0), dtype=np.int64), np.zeros((num_rows, 0), dtype=scores.dtype)
+    if k < num_cols:
+        topk_idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        topk_idx = np.tile(np.arange(num_cols), (num_rows, 1))
+    topk_scores = np.take_along_axis(scores, topk_idx, axis=1)
+    if k < num_cols:
+        kth = topk_scores.min(axis=1)
+        tied_total = (scores == kth[:, None]).sum(axis=1)
+        tied_kept = (topk_scores == kth[:, None]).sum(axis=1)
+        for r in np.flatnonzero(tied_total > tied_kept):
+            keep = topk_idx[r][topk_scores[r] > kth[r]]
+            tied = np.flatnonzero(scores[r] == kth[r])[:k - len(keep)]
+            topk_idx[r] = np.concatenate((keep, tied))
+            topk_scores[r] = scores[r, topk_idx[r]]
+    order = np.lexsort((topk_idx, -topk_scores), axis=-1)
+    return np.take_along_axis(topk_idx, order, axis=1), np.take_along_axis(topk_scores, order, axis=1)
+
+
+def array_ref(arr):
+    # a memory-mapped .npy (or a row range of one) travels to spawned workers as (path, start, stop)
+    # and is mapped again there; other arrays are pickled
+    top = arr
+    while isinstance(top, np.ndarray) and not (isinstance(top, np.memmap) and not isinstance(top.base, np.ndarray)):
+        top = top.base
+    if not isinstance(top, np.memmap) or top.filename is None or not arr.flags.c_contiguous or arr.ndim == 0 \
+            or arr.shape[1:] != top.shape[1:] or arr.dtype != top.dtype:
+        return arr
+    start = (arr.__array_interface__['data'][0] - top.__array_interface__['data'][0]) // top.strides[0]
+    return (top.filename, int(start), int(start) + len(arr))
+
+def open_array_ref(ref):
+    if isinstance(ref, tuple):
+        path, start, stop = ref
+        return np.load(path, mmap_mode='r')[start:stop]
+    return ref
+
+class BM25ShardScorer:
+    # score_fn of sharded_topk over a CSR doc x term matrix, the memory-mapped arrays of a persisted
+    # index are opened again by path in each worker
+    def __init__(self, matrix, query_matrix):
+        self.refs = (array_ref(matrix.data), array_ref(matrix.indices), array_ref(matrix.indptr), matrix.shape)
+        self.query_matrix = query_matrix
+        self.matrix = matrix
+
+    def __getstate__(self):
+        return {'refs': self.refs, 'query_matrix': self.query_matrix, 'matrix': None}
+
+    def __call__(self, lo, hi):
+        if self.matrix is None:
+            import scipy.sparse as sp
+            data, indices, indptr, shape = self.refs
+            self.matrix = sp.csr_matrix((open_array_ref(data), open_array_ref(indices), open_array_ref(indptr)),
+                                        shape=shape, copy=False)
+        return (self.matrix[lo:hi] @ self.query_matrix.T).T.toarray()
+
+class DenseShardScorer:
+    # score_fn of sharded_topk for dense_scores; doc embeddings of the store are mapped again by path
+    def __init__(self, query_emb, doc_emb, normalize=True, scale=1):
+        self.query_emb = np.asarray(query_emb, dtype=np.float32)
+        self.doc_ref = array_ref(doc_emb)
+        self.normalize, self.scale = normalize, scale
+        self.doc_emb = doc_emb
+
+    def __getstate__(self):
+        return dict(self.__dict__, doc_emb=None)
+
+    def __call__(self, lo, hi):
+        if self.doc_emb is None:
+            self.doc_emb = open_array_ref(self.doc_ref)
+        return dense_scores(self.query_emb, self.doc_emb[lo:hi], normalize=self.normalize, scale=self.scale)
+
+# state of a sharded_topk call, set in every worker by init_shard_worker
+SHARD_STATE = {}
+
+def init_shard_worker(score_fn, excluded, k):
+    SHARD_STATE.update(score_fn=score_fn, excluded=excluded, k=k)
+
+def score_shard(bounds):
+    lo, hi = bounds
+    scores = SHARD_STATE['score_fn'](lo, hi)
+    excluded = SHARD_STATE['excluded']
+    if excluded is not None:
+        excluded = [rows[(rows >= lo) & (rows < hi)] - lo for rows in excluded]
+    topk_idx, topk_scores = get_topk(scores, k=SHARD_STATE['k'], excluded=excluded)
+    return topk_idx + lo, topk_scores
+
+def merge_topk(shard_results, k=1000):
+    # same order as get_topk: descending score, lower column first on ties
+    topk_idx = np.concatenate([idx for idx, _ in shard_results], axis=1)
+    topk_scores = np.concatenate([scores for _, scores in shard_results], axis=1)
+    order = np.lexsort((topk_idx, -topk_scores), axis=-1)[:, :k]
+    return np.take_along_axis(topk_idx, order, axis=1), np.take_along_axis(topk_scores, order, axis=1)
+
+def sharded_topk(score_fn, num_docs, k=1000, excluded=None, num_workers=1, num_shards=None):
+    # score_fn(lo, hi) -> (queries x (hi - lo)) scores of the docs lo:hi. Every shard keeps its own
+    # top-k and the merge keeps the best k of those, which is exactly get_topk over the full matrix.
+    # Workers are spawned rather than forked, the parent may run a JVM or torch threads that do not
+    # survive a fork, so score_fn must be picklable (BM25ShardScorer, DenseShardScorer); more
+    # workers than cores only add overhead and are capped
+    num_shards = num_shards or num_workers
+    num_workers = min(num_workers, os.cpu_count() or 1)
+    bounds = np.linspace(0, num_docs, num_shards + 1).astype(np.int64)
+    shards = [(int(lo), int(hi)) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+    if num_workers > 1:
+        import multiprocessing
+        with multiprocessing.get_context('spawn').Pool(min(num_workers, len(shards)), initializer=init_shard_worker,
+                                                       initargs=(score_fn, excluded, k)) as pool:
+            results = pool.map(score_shard, shards)
+    else:
+        init_shard_worker(score_fn, excluded, k)
+        try:
+            results = [score_shard(b) for b in shards]
+        finally:
+            SHARD_STATE.clear()
+    return merge_topk(results, k=k)
+
+def get_sharded_scores(query_ids, doc_ids, score_fn, excluded_rows, k=1000, num_workers=1):
+    excluded = [excluded_rows[str(query_id)] for query_id in query_ids]
+    topk_idx, topk_scores = sharded_topk(score_fn, len(doc_ids), k=k, excluded=excluded, num_workers=num_workers)
+    return {str(query_id): topk_to_dict(doc_ids, idx, vals) for query_id, idx, vals in zip(query_ids, topk_idx, topk_scores)}
+
+def token_budget_batches(lengths, max_tokens, max_batch_size=None):
+    # pack indices sorted by length (longest first, so OOM shows up on the first batch) into batches
+    # whose padded size, batch length x longest sequence, stays within max_tokens
+    order = np.argsort(-np.asarray(lengths), kind='stable')
+    batches, cur, cur_max = [], [], 0
+    for i in order:
+        new_max = max(cur_max, int(lengths[i]), 1)
+        if cur and (new_max * (len(cur) + 1) > max_tokens or (max_batch_size and len(cur) >= max_batch_size)):
+            batches.append(cur)
+            cur, new_max = [], max(int(lengths[i]), 1)
+        cur.append(int(i))
+        cur_max = new_max
+    if cur:
+        batches.append(cur)
+    return batches
+
+def encode_token_batches(lengths, encode_batch, max_tokens, max_batch_size=None, desc='encode'):
+    # encode_batch(list_of_indices) -> (len(indices), dim); rows come back in the original order
+    out = None
+    for batch in tqdm(token_budget_batches(lengths, max_tokens, max_batch_size), desc=desc):
+        embs = np.asarray(encode_batch(batch))
+        if out is None:
+            out = np.empty((len(lengths), embs.shape[1]), dtype=embs.dtype)
+        out[batch] = embs
+    return out if out is not None else np.zeros((0, 0), dtype=np.float32)
+
+def encode_texts_token_batches(texts, tokenizer, encode_texts, max_length, max_tokens, max_batch_size=None):
+    # for encoders that tokenize themselves (sentence-transformers, GritLM): lengths only drive the packing
+    lengths = [len(ids) for ids in tokenizer(texts, max_length=max_length, truncation=True)['input_ids']]
+    return encode_token_batches(lengths, lambda idx: encode_texts([texts[i] for i in idx]), max_tokens, max_batch_size)
+
+
+@no_grad
 def retrieval_sf_qwen_e5(queries,query_ids,documents,doc_ids,task,model_id,instructions,cache_dir,excluded_ids,long_context,**kwargs):
+    from transformers import AutoTokenizer, AutoModel
     if model_id=='sf':
-        tokenizer = AutoTokenizer.from_pretrained('salesforce/sfr-embedding-mistral')
-        model = AutoModel.from_pretrained('salesforce/sfr-embedding-mistral',device_map="auto").eval()
+        model_path = 'salesforce/sfr-embedding-mistral'
+        trust_remote_code = False
         max_length = kwargs.get('doc_max_length',4096)
     elif model_id=='qwen':
-        tokenizer = AutoTokenizer.from_pretrained('alibaba-nlp/gte-qwen1.5-7b-instruct', trust_remote_code=True)
-        model = AutoModel.from_pretrained('alibaba-nlp/gte-qwen1.5-7b-instruct', device_map="auto", trust_remote_code=True).eval()
+        model_path = 'alibaba-nlp/gte-qwen1.5-7b-instruct'
+        trust_remote_code = True
         max_length = kwargs.get('doc_max_length',8192)
     elif model_id=='qwen2':
-        tokenizer = AutoTokenizer.from_pretrained('alibaba-nlp/gte-qwen2-7b-instruct', trust_remote_code=True)
-        model = AutoModel.from_pretrained('alibaba-nlp/gte-qwen2-7b-instruct', device_map="auto", trust_remote_code=True).eval()
+        model_path = 'alibaba-nlp/gte-qwen2-7b-instruct'
+        trust_remote_code = True
         max_length = kwargs.get('doc_max_length',8192)
     elif model_id=='e5':
-        tokenizer = AutoTokenizer.from_pretrained('intfloat/e5-mistral-7b-instruct')
-        model = AutoModel.from_pretrained('intfloat/e5-mistral-7b-instruct', device_map="auto").eval()
+        model_path = 'intfloat/e5-mistral-7b-instruct'
+        trust_remote_code = False
         max_length = kwargs.get('doc_max_length',4096)
     else:
         raise ValueError(f"The model {model_id} is not supported")
-    model = model.eval()
+    tokenizer, model = get_model(model_path, lambda: (
+        AutoTokenizer.from_pretrained(model_path, trust_remote_code=trust_remote_code),
+        AutoModel.from_pretrained(model_path, device_map="auto", trust_remote_code=trust_remote_code).eval()))
     queries = add_instruct_concatenate(texts=queries,task=task,instruction=instructions['query'])
-    batch_size = kwargs.get('encode_batch_size',1)
-
-    doc_emb = None
-    cache_path = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}.npy")
-    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-    if os.path.isfile(cache_path):
-        # already exists so we can just load it
-        doc_emb = np.load(cache_path, allow_pickle=True)
-    
-    for start_idx in trange(0,len(documents),batch_size):
-        assert doc_emb is None or doc_emb.shape[0] % batch_size == 0, f"{doc_emb % batch_size} reminder in doc_emb"
-        if doc_emb is not None and doc_emb.shape[0] // batch_size > start_idx:
-            continue
-
-        batch_dict = tokenizer(documents[start_idx:start_idx+batch_size], max_length=max_length, padding=True, truncation=True, return_tensors='pt').to(model.device)
-        outputs = model(**batch_dict)
-        embeddings = last_token_pool(outputs.last_hidden_state, batch_dict['attention_mask']).cpu()
-        # doc_emb[start_idx] = embeddings
-        doc_emb = embeddings if doc_emb is None else np.concatenate((doc_emb, np.array(embeddings)), axis=0)
-
-        # save the embeddings every 1000 iters, you can adjust this as needed
-        if (start_idx + 1) % 1000 == 0:
-            np.save(cache_path, doc_emb)
-        
-    np.save(cache_path, doc_emb)
-
-    doc_emb = torch.tensor(doc_emb)
+    # batches are packed by token count instead of a fixed number of texts, see token_budget_batches
+    max_tokens = kwargs.get('max_tokens',16384)
+    # run.py passes --encode_batch_size as batch_size, it now only caps the number of texts per batch
+    max_batch_size = kwargs.get('batch_size',None)
+    legacy_batch_size = kwargs.get('encode_batch_size',1)
+
+    def encode(texts):
+        input_ids = tokenizer(texts, max_length=max_length, truncation=True)['input_ids']
+
+        def encode_batch(idx):
+            batch_dict = tokenizer.pad({'input_ids': [input_ids[i] for i in idx]}, padding=True,
+                                       return_tensors='pt').to(model.device)
+            outputs = model(**batch_dict)
+            return last_token_pool(outputs.last_hidden_state, batch_dict['attention_mask']).float().cpu().numpy()
+        return encode_token_batches([len(ids) for ids in input_ids], encode_batch, max_tokens, max_batch_size)
+
+    # every chunk of 4096 missing documents is length-sorted and packed, then written in place into
+    # the store, committed every 1000 rows or 5 minutes, you can adjust this as needed
+    store = EmbeddingStore(cache_dir, model_path, max_length=max_length, dtype=kwargs.get('emb_dtype','float32'))
+    legacy_path = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{legacy_batch_size}.npy")
+    chunk_doc = None
+    if kwargs.get('chunk_tokens',-1) > 0:
+        # windows leave room for the special tokens the encoder adds
+        doc_emb, chunk_doc = encode_doc_chunks(
+            store, documents, encode, lambda texts: tokenizer(texts, add_special_tokens=False)['input_ids'],
+            tokenizer.decode, max_length-2, **{**kwargs, 'encode_chunk_size': kwargs.get('encode_chunk_size',4096)})
+    else:
+        doc_emb = encode_with_store(store, documents, encode, chunk_size=kwargs.get('encode_chunk_size',4096),
+                                    legacy_path=legacy_path, commit_rows=1000, commit_seconds=300)
     print("doc_emb shape:",doc_emb.shape)
-    doc_emb = F.normalize(doc_emb, p=2, dim=1)
-    query_emb = []
-    for start_idx in trange(0, len(queries), batch_size):
-        batch_dict = tokenizer(queries[start_idx:start_idx + batch_size], max_length=max_length, padding=True,
-                               truncation=True, return_tensors='pt').to(model.device)
-        outputs = model(**batch_dict)
-        embeddings = last_token_pool(outputs.last_hidden_state, batch_dict['attention_mask']).cpu().tolist()
-        query_emb += embeddings
-    query_emb = torch.tensor(query_emb)
+    query_emb = encode(queries).astype(np.float32)
     print("query_emb shape:", query_emb.shape)
-    query_emb = F.normalize(query_emb, p=2, dim=1)
-    scores = (query_emb @ doc_emb.T) * 100
-    scores = scores.tolist()
-    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids)
+    return dense_search(query_emb, doc_emb, store, documents, query_ids, doc_ids, excluded_ids, scale=100,
+                        chunk_doc=chunk_doc, **kwargs)
 
-@torch.no_grad()
+@no_grad
 def retrieval_sbert_bge(queries,query_ids,documents,doc_ids,task,instructions,model_id,cache_dir,excluded_ids,long_context,**kwargs):
+    from sentence_transformers import SentenceTransformer
     if model_id == "bge":
         model_path = "BAAI/bge-large-en-v1.5"
     else:
         model_path = "sentence-transformers/all-mpnet-base-v2"
 
-    model = SentenceTransformer(model_path)
+    model = get_model(model_path, lambda: SentenceTransformer(model_path))
     batch_size = kwargs.get('batch_size',128)
-    if not os.path.isdir(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}")):
-        os.makedirs(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}"))
-    cur_cache_file = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}", f'0.npy')
-    if os.path.isfile(cur_cache_file):
-        doc_emb = np.load(cur_cache_file,allow_pickle=True)
+    store = EmbeddingStore(cache_dir, model_path, max_length=model.max_seq_length, dtype=kwargs.get('emb_dtype','float32'))
+    legacy_path = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}", f'0.npy')
+    encode = lambda texts: model.encode(texts, show_progress_bar=True, batch_size=batch_size, normalize_embeddings=True)
+    chunk_doc = None
+    if kwargs.get('chunk_tokens',-1) > 0:
+        doc_emb, chunk_doc = encode_doc_chunks(
+            store, documents, encode, lambda texts: model.tokenizer(texts, add_special_tokens=False)['input_ids'],
+            model.tokenizer.decode, model.max_seq_length-2, **kwargs)
     else:
-        doc_emb = model.encode(documents, show_progress_bar=True, batch_size=batch_size, normalize_embeddings=True)
-        np.save(cur_cache_file, doc_emb)
+        doc_emb = encode_with_store(store, documents, encode, legacy_path=legacy_path)
     query_emb = model.encode(queries,show_progress_bar=True,batch_size=batch_size, normalize_embeddings=True)
-    scores = cosine_similarity(query_emb, doc_emb)
-    scores = scores.tolist()
-    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids)
+    # both sides are encoded with normalize_embeddings=True
+    return dense_search(query_emb, doc_emb, store, documents, query_ids, doc_ids, excluded_ids, chunk_doc=chunk_doc,
+                        normalize=False, **kwargs)
+
+def fusion_model_path(model_id):
+    if model_id == "bge":
+        return "BAAI/bge-large-en-v1.5"
+    return "sentence-transformers/all-mpnet-base-v2"
+
+def load_fusion_encoder(model_id, cache_dir, task, documents, long_context, **kwargs):
+    from sentence_transformers import SentenceTransformer
 
-@torch.no_grad()
+    # -- 1. Load Embedding Model --
+    model_path = fusion_model_path(model_id)
+    model = get_model(model_path, lambda: SentenceTransformer(model_path))
+
+    # -- 2. Load Doc Embeddings (shared with retrieval_sbert_bge), stored normalized so callers score
+    #       them with dense_scores(..., normalize=False) --
+    batch_size   = kwargs.get("batch_size", 128)
+    store        = EmbeddingStore(cache_dir, model_path, max_length=model.max_seq_length,
+                                  dtype=kwargs.get("emb_dtype", "float32"))
+    # the pre-store cache of this path was always written under "sbert"
+    legacy_path  = os.path.join(cache_dir, "doc_emb", "sbert", task, f"long_{long_context}_{batch_size}", "docs.npy")
+    doc_emb = encode_with_store(
+        store,
+        documents,
+        lambda texts: model.encode(
+            texts,
+            show_progress_bar=True,
+            batch_size=batch_size,
+            normalize_embeddings=True
+        ),
+        legacy_path=legacy_path if model_id != "bge" else None
+    )
+    return model, doc_emb, batch_size
+
+def encode_fusion_units(model, q_texts, d_texts, embed_method="separate", desc_weight=0.5, batch_size=128):
+    # -> (unit embeddings, sub-query embeddings, desc embeddings), the last two are None for "joint"
+    if embed_method == "joint":
+        flat_units = [f"{qt} {dt}".strip() for qt, dt in zip(q_texts, d_texts)]
+        flat_unit_embs = model.encode(
+            flat_units,
+            show_progress_bar=True,
+            batch_size=batch_size,
+            normalize_embeddings=True
+        )
+        return flat_unit_embs, None, None
+    flat_embs = model.encode(
+        q_texts + d_texts,
+        show_progress_bar=True,
+        batch_size=batch_size,
+        normalize_embeddings=True
+    )
+    q_embs = flat_embs[:len(q_texts)]
+    d_embs = flat_embs[len(q_texts):]
+    return desc_weight * d_embs + (1 - desc_weight) * q_embs, q_embs, d_embs
+
+@no_grad
 def retrieval_sbert_bge_fusion_desc(
     queries,
     query_ids,
@@ -230,43 +533,19 @@ def retrieval_sbert_bge_fusion_desc(
     ground_truth=None,
     **kwargs
 ):
-
     # ========== Default Setting ==========
     embed_method  = kwargs.get("embed_method", "separate")   # "joint" or "separate"
     desc_weight   = kwargs.get("desc_weight", 0.5)           # 0~1 
     fusion_method = kwargs.get("fusion_method", "sum")       # "sum" or "max"
     # =============================
 
-    # -- 1. Load Embedding Model --
-    if model_id == "bge":
-        model_path = "BAAI/bge-large-en-v1.5"
-    else:
-        model_path = "sentence-transformers/all-mpnet-base-v2"
-
-    model = SentenceTransformer(model_path)
-
-    # -- 2. Load Doc Embedding Cache --
-    batch_size   = kwargs.get("batch_size", 128)
-    doc_emb_dir  = os.path.join(cache_dir, "doc_emb", "sbert", task, f"long_{long_context}_{batch_size}")
-    os.makedirs(doc_emb_dir, exist_ok=True)
-    doc_emb_file = os.path.join(doc_emb_dir, "docs.npy")
-    if os.path.isfile(doc_emb_file):
-        doc_emb = np.load(doc_emb_file, allow_pickle=True)
-    else:
-        doc_emb = model.encode(
-            documents,
-            show_progress_bar=True,
-            batch_size=batch_size,
-            normalize_embeddings=True
-        )
-        np.save(doc_emb_file, doc_emb)
+    # -- 1./2. Load Embedding Model and Doc Embeddings --
+    model, doc_emb, batch_size = load_fusion_encoder(model_id, cache_dir, task, documents, long_context, **kwargs)
 
-    # -- 3. Regex --
-    unit_pattern = re.compile(
-        r'Sub_Query_\d+:\s*"<begin_of_query>\s*(.*?)\s*<end_of_query>"\s*'
-        r'Desc\d+:\s*"<begin_of_desc>\s*(.*?)\s*<end_of_desc>"',
-        flags=re.DOTALL
-    )
+    # -- 3. Units (pre-parsed unit table of the reasoning file, or parsed here) --
+    unit_table = kwargs.get("unit_table")
+    if unit_table is None:
+        unit_table = UnitTable.from_queries(query_ids, queries)
 
     # -- 4. Unit Embedding Cache Dir --
     if embed_method == "joint":
@@ -279,146 +558,103 @@ def retrieval_sbert_bge_fusion_desc(
         os.makedirs(d_emb_dir, exist_ok=True)
 
     # -- 5. Results --
+    excluded_rows    = kwargs.get("excluded_rows")
+    if excluded_rows is None:
+        excluded_rows = get_excluded_index(doc_ids, excluded_ids)
     fused_scores     = {}
     per_subq_hits    = {}
     per_subq_docs    = {}
     fused_hit_counts = {}
 
-    for qid, big in tqdm(zip(query_ids, queries), total=len(queries), desc="Dense Fusion Desc"):
-        q_texts, d_texts = [], []
-        for m in unit_pattern.finditer(big):
-            q_texts.append(m.group(1).strip())
-            d_texts.append(m.group(2).strip())
-        if not q_texts:
-            q_texts, d_texts = [big], [""]
-        
-        unit_count = len(q_texts)
-        # print(f"[QID={qid}] 找到 {unit_count} 个子查询+描述 单元")
+    # -- 6. Encode the units of all queries together --
+    # a query only has 3~10 units, so units are pooled across queries and encoded in large
+    # batches (SentenceTransformer sorts them by length), then scattered back per query
+    unit_offsets, unit_columns = unit_table.select(query_ids, columns=("sub_query", "desc"))
+    flat_q_texts = unit_columns["sub_query"]
+    flat_d_texts = unit_columns["desc"]
 
+    flat_unit_embs, flat_q_embs, flat_d_embs = encode_fusion_units(
+        model, flat_q_texts, flat_d_texts, embed_method, desc_weight, batch_size)
+
+    for qi, qid in enumerate(query_ids):
+        unit_slice = slice(unit_offsets[qi], unit_offsets[qi + 1])
         safe_qid = str(qid).replace('/', '_')
         if embed_method == "joint":
-            units = [f"{qt} {dt}".strip() for qt, dt in zip(q_texts, d_texts)]
-            unit_embs = model.encode(
-                units,
-                show_progress_bar=False,
-                batch_size=batch_size,
-                normalize_embeddings=True
-            )
-            np.save(os.path.join(joint_emb_dir, f"{safe_qid}.npy"), unit_embs)
-
-        else:
-            q_embs = model.encode(
-                q_texts,
-                show_progress_bar=False,
-                batch_size=batch_size,
-                normalize_embeddings=True
-            )
-            d_embs = model.encode(
-                d_texts,
-                show_progress_bar=False,
-                batch_size=batch_size,
-                normalize_embeddings=True
-            )
-            np.save(os.path.join(q_emb_dir, f"{safe_qid}.npy"), q_embs)
-            np.save(os.path.join(d_emb_dir, f"{safe_qid}.npy"), d_embs)
-
-            unit_embs = desc_weight * d_embs + (1 - desc_weight) * q_embs
-
-        if fusion_method == "sum":
-            fusion_buf = np.zeros(len(doc_ids), dtype=float)
+            np.save(os.path.join(joint_emb_dir, f"{safe_qid}.npy"), flat_unit_embs[unit_slice])
         else:
-            fusion_buf = np.full(len(doc_ids), -np.inf, dtype=float)
-
-        per_subq_hits[qid] = {}
-        per_subq_docs[qid] = {}
-
-        for idx, uemb in enumerate(unit_embs, start=1):
-            sims = cosine_similarity(uemb.reshape(1, -1), doc_emb).flatten()
-            topk_idx = np.argsort(-sims)[:1000]
-            topk_ids = [doc_ids[i] for i in topk_idx]
-
-            per_subq_hits[qid][f"Unit{idx}"] = (
-                len(set(topk_ids) & ground_truth.get(str(qid), set()))
-                if ground_truth else 0
-            )
-            per_subq_docs[qid][f"Unit{idx}"] = topk_ids
-
-            if fusion_method == "sum":
-                fusion_buf += sims
+            np.save(os.path.join(q_emb_dir, f"{safe_qid}.npy"), flat_q_embs[unit_slice])
+            np.save(os.path.join(d_emb_dir, f"{safe_qid}.npy"), flat_d_embs[unit_slice])
+
+    # -- 7. Score --
+    # cosine similarity of all units of a block of queries with one float32 GEMM,
+    # query_block_size bounds the (units x docs) buffer
+    flat_unit_embs = normalize_rows(flat_unit_embs)
+    query_block_size = kwargs.get("query_block_size", 16)
+    for start in trange(0, len(query_ids), query_block_size, desc="Dense Fusion Desc"):
+        block_qids = query_ids[start:start + query_block_size]
+        block_offsets = unit_offsets[start:start + len(block_qids) + 1]
+        block_sims = dense_scores(flat_unit_embs[block_offsets[0]:block_offsets[-1]], doc_emb, normalize=False)
+        unit_topk_idx, _ = get_topk(block_sims, k=1000)
+        fusion_block = fuse_unit_scores(block_sims, block_offsets - block_offsets[0], fusion_method)
+        excluded = [excluded_rows.get(str(qid), np.zeros(0, dtype=np.int64)) for qid in block_qids]
+        final_idx, final_scores = get_topk(fusion_block, k=1000, excluded=excluded)
+
+        for bi, qid in enumerate(block_qids):
+            per_subq_hits[qid] = {}
+            per_subq_docs[qid] = {}
+            for idx, row in enumerate(range(block_offsets[bi], block_offsets[bi + 1]), start=1):
+                topk_ids = [doc_ids[i] for i in unit_topk_idx[row - block_offsets[0]]]
+                per_subq_hits[qid][f"Unit{idx}"] = (
+                    len(set(topk_ids) & ground_truth.get(str(qid), set()))
+                    if ground_truth else 0
+                )
+                per_subq_docs[qid][f"Unit{idx}"] = topk_ids
+
+            fused_scores[str(qid)] = topk_to_dict(doc_ids, final_idx[bi], final_scores[bi])
+            if ground_truth:
+                fused_hit_counts[str(qid)] = len(
+                    set(fused_scores[str(qid)].keys()) &
+                    ground_truth[str(qid)]
+                )
             else:
-                fusion_buf = np.maximum(fusion_buf, sims)
-
-        for did in excluded_ids.get(str(qid), []):
-            if did in doc_ids:
-                fusion_buf[doc_ids.index(did)] = -np.inf
-
-        final_idx = np.argsort(-fusion_buf)[:1000]
-        fused_scores[str(qid)] = {
-            doc_ids[i]: float(fusion_buf[i]) for i in final_idx
-        }
-        if ground_truth:
-            fused_hit_counts[str(qid)] = len(
-                set(fused_scores[str(qid)].keys()) &
-                ground_truth[str(qid)]
-            )
-        else:
-            fused_hit_counts[str(qid)] = 0
+                fused_hit_counts[str(qid)] = 0
 
     return fused_scores, per_subq_hits, per_subq_docs, fused_hit_counts
 
 
-@torch.no_grad()
 def retrieval_bm25(queries,query_ids,documents,doc_ids,excluded_ids,long_context,**kwargs):
-    from pyserini import analysis
-    from gensim.corpora import Dictionary
-    from gensim.models import LuceneBM25Model
-    from gensim.similarities import SparseMatrixSimilarity
-    analyzer = analysis.Analyzer(analysis.get_lucene_analyzer())
-    corpus = [analyzer.analyze(x) for x in documents]
-    dictionary = Dictionary(corpus)
-    model = LuceneBM25Model(dictionary=dictionary, k1=0.9, b=0.4)
-    bm25_corpus = model[list(map(dictionary.doc2bow, corpus))]
-    bm25_index = SparseMatrixSimilarity(bm25_corpus, num_docs=len(corpus), num_terms=len(dictionary),
-                                        normalize_queries=False, normalize_documents=False)
+    analyzer = get_analyzer()
+    bm25_index = load_or_build_bm25_index(documents, doc_ids, analyzer, cache_dir=kwargs.get('cache_dir'),
+                                          task=kwargs.get('task'), long_context=long_context, k1=0.9, b=0.4,
+                                          ignore_cache=kwargs.get('ignore_cache', False), num_workers=kwargs.get('num_workers',1))
+    excluded_rows = kwargs.get('excluded_rows')
+    if excluded_rows is None:
+        excluded_rows = get_excluded_index(doc_ids,excluded_ids)
+    if kwargs.get('num_workers',1) > 1:
+        query_matrix = bm25_index.query_matrix([analyzer.analyze(q) for q in queries])
+        return get_sharded_scores(query_ids, doc_ids, BM25ShardScorer(bm25_index.matrix, query_matrix),
+                                  excluded_rows, num_workers=kwargs['num_workers'])
     all_scores = {}
-    bar = tqdm(queries, desc="BM25 retrieval")
-    for query_id, query in zip(query_ids, queries):
-        bar.update(1)
-        query = analyzer.analyze(query)
-        bm25_query = model[dictionary.doc2bow(query)]
-        similarities = bm25_index[bm25_query].tolist()
-        all_scores[str(query_id)] = {}
-        for did, s in zip(doc_ids, similarities):
-            all_scores[str(query_id)][did] = s
-        for did in set(excluded_ids[str(query_id)]):
-            if did!="N/A":
-                all_scores[str(query_id)].pop(did)
-        cur_scores = sorted(all_scores[str(query_id)].items(),key=lambda x:x[1],reverse=True)[:1000]
-        all_scores[str(query_id)] = {}
-        for pair in cur_scores:
-            all_scores[str(query_id)][pair[0]] = pair[1]
+    query_block_size = kwargs.get('query_block_size',16)
+    for start in trange(0, len(queries), query_block_size, desc="BM25 retrieval"):
+        block_qids = query_ids[start:start+query_block_size]
+        query_matrix = bm25_index.query_matrix([analyzer.analyze(q) for q in queries[start:start+query_block_size]])
+        similarities = (bm25_index.matrix @ query_matrix.T).T.toarray()
+        all_scores.update(get_scores(query_ids=block_qids,doc_ids=doc_ids,scores=similarities,excluded_ids=excluded_ids,
+                                     excluded_rows=excluded_rows))
     return all_scores
 
-@torch.no_grad()
 # sub-query+desc-version
 def retrieval_bm25_fusion_desc(
     queries, query_ids, documents, doc_ids, excluded_ids, long_context,
     ground_truth=None,
     **kwargs
 ):
-    from pyserini import analysis
-    from gensim.corpora import Dictionary
-    from gensim.models import LuceneBM25Model
-    from gensim.similarities import SparseMatrixSimilarity
-
-    analyzer = analysis.Analyzer(analysis.get_lucene_analyzer())
-    corpus = [analyzer.analyze(x) for x in documents]
-    dictionary = Dictionary(corpus)
-    model = LuceneBM25Model(dictionary=dictionary, k1=0.9, b=0.4)
-    bm25_corpus = model[[dictionary.doc2bow(doc) for doc in corpus]]
-    bm25_index = SparseMatrixSimilarity(
-        bm25_corpus, num_docs=len(corpus), num_terms=len(dictionary),
-        normalize_queries=False, normalize_documents=False
+    analyzer = get_analyzer()
+    bm25_index = load_or_build_bm25_index(
+        documents, doc_ids, analyzer,
+        cache_dir=kwargs.get("cache_dir"), task=kwargs.get("task"), long_context=long_context,
+        k1=0.9, b=0.4, ignore_cache=kwargs.get("ignore_cache", False), num_workers=kwargs.get("num_workers", 1)
     )
 
     fused_scores     = {}
@@ -426,77 +662,190 @@ def retrieval_bm25_fusion_desc(
     per_subq_docs    = {}
     fused_hit_counts = {}
 
-    unit_pattern = re.compile(
-        r'(Sub_Query_\d+:\s*"<begin_of_query>.*?<end_of_query>")\s*'
-        r'(Desc\d+:\s*"<begin_of_desc>.*?<end_of_desc>")',
-        flags=re.DOTALL
-    )
-
-
-    for qid, expanded_query in tqdm(list(zip(query_ids, queries)), desc="BM25 fusion_desc", total=len(queries)):
-        units = []
-        for m in unit_pattern.finditer(expanded_query):
-            query_text = m.group(1).strip()
-            desc_text = m.group(2).strip()
-            units.append(f"{query_text} {desc_text}")
-
-        if not units:
-            units = [expanded_query.strip()]
-
-        per_subq_hits[qid] = {}
-        per_subq_docs[qid] = {}
-
-        # print(f"[DEBUG] qid={qid} has {len(units)} units")
-
-        for idx, unit in enumerate(units, start=1):
-            tokens = analyzer.analyze(unit)
-            bm25_query = model[dictionary.doc2bow(tokens)]
-            sims = bm25_index[bm25_query].tolist()
-
-            did_score_pairs = sorted(zip(doc_ids, sims), key=lambda x: x[1], reverse=True)[:1000]
-            topk_docs = [did for did, _ in did_score_pairs]
-
+    # a BM25 unit is the sub-query and its description with their markers
+    unit_table = kwargs.get("unit_table")
+    if unit_table is None:
+        unit_table = UnitTable.from_queries(query_ids, queries)
+    unit_offsets, unit_columns = unit_table.select(query_ids, columns=("text",))
+    all_units = [unit_columns["text"][unit_offsets[i]:unit_offsets[i + 1]] for i in range(len(query_ids))]
+
+    excluded_rows = kwargs.get("excluded_rows")
+    if excluded_rows is None:
+        excluded_rows = get_excluded_index(doc_ids, excluded_ids)
+    # every unit of a block of queries is analyzed once and scored with one sparse matmul,
+    # the (units x docs) block bounds the memory, so keep it small for large corpora
+    query_block_size = kwargs.get("query_block_size", 16)
+    for start in trange(0, len(query_ids), query_block_size, desc="BM25 fusion_desc"):
+        block_qids = query_ids[start:start + query_block_size]
+        block_units = all_units[start:start + query_block_size]
+        flat_units = [unit for units in block_units for unit in units]
+        unit_matrix = bm25_index.query_matrix([analyzer.analyze(unit) for unit in flat_units])
+        block_sims = (bm25_index.matrix @ unit_matrix.T).T.toarray()
+        unit_topk_idx, _ = get_topk(block_sims, k=1000)
+
+        row = 0
+        for qid, units in zip(block_qids, block_units):
+            per_subq_hits[qid] = {}
+            per_subq_docs[qid] = {}
             if ground_truth is not None and str(qid) in ground_truth:
                 gold_set = ground_truth[str(qid)]
-                hit_cnt = len(set(topk_docs) & gold_set)
             else:
-                hit_cnt = 0
-
-            per_subq_hits[qid][f"Unit{idx}"] = hit_cnt
-            per_subq_docs[qid][f"Unit{idx}"] = topk_docs
-
-        fusion_scores_this_q = {did: 0.0 for did in doc_ids}
-        for unit in units:
-            tokens = analyzer.analyze(unit)
-            bm25_query = model[dictionary.doc2bow(tokens)]
-            sims = bm25_index[bm25_query].tolist()
-            for did, score in zip(doc_ids, sims):
-                fusion_scores_this_q[did] += score
+                gold_set = None
+
+            fusion_scores_this_q = np.zeros(len(doc_ids), dtype=np.float64)
+            for idx in range(1, len(units) + 1):
+                topk_docs = [doc_ids[i] for i in unit_topk_idx[row]]
+                per_subq_hits[qid][f"Unit{idx}"] = len(set(topk_docs) & gold_set) if gold_set is not None else 0
+                per_subq_docs[qid][f"Unit{idx}"] = topk_docs
+                fusion_scores_this_q += block_sims[row]
+                row += 1
+
+            excluded = excluded_rows.get(str(qid), np.zeros(0, dtype=np.int64))
+            topk_idx, topk_scores = get_topk(fusion_scores_this_q[None, :], k=1000, excluded=[excluded])
+            fused_scores[str(qid)] = topk_to_dict(doc_ids, topk_idx[0], topk_scores[0])
+
+            if gold_set is not None:
+                fused_hit_counts[str(qid)] = len(set(fused_scores[str(qid)].keys()) & gold_set)
+            else:
+                fused_hit_counts[str(qid)] = 0
 
-        for did in set(excluded_ids.get(str(qid), [])):
-            fusion_scores_this_q.pop(did, None)
+    return fused_scores, per_subq_hits, per_subq_docs, fused_hit_counts
 
-        topk = sorted(fusion_scores_this_q.items(), key=lambda x: x[1], reverse=True)[:1000]
-        fused_scores[str(qid)] = {did: sc for did, sc in topk}
 
-        topk_docs_fused = set(fused_scores[str(qid)].keys())
-        if ground_truth is not None and str(qid) in ground_truth:
-            gold_set = ground_truth[str(qid)]
-            fused_hit_counts[str(qid)] = len(topk_docs_fused & gold_set)
-        else:
-            fused_hit_counts[str(qid)] = 0
+def fuse_candidate_lists(list_idx, list_scores, weights, method="rrf", rrf_k=60):
+    # list_idx/list_scores (lists x k) ranked candidates, -inf past the last one; a doc missing from
+    # a list scores as that list's last entry would (0 for rrf and minmax) -> (candidate rows, fused scores)
+    valid = list_scores > -np.inf
+    count = np.maximum(valid.sum(axis=1), 1)
+    scores = np.where(valid, list_scores, 0).astype(np.float64)
+    floor = np.zeros(len(list_idx))
+    if method == "rrf":
+        contrib = np.broadcast_to(1.0 / (rrf_k + np.arange(1, list_idx.shape[1] + 1)), list_idx.shape)
+    elif method == "minmax":
+        lo = np.where(valid, scores, np.inf).min(axis=1)
+        hi = np.where(valid, scores, -np.inf).max(axis=1)
+        spread = np.where(hi > lo, hi - lo, 0)
+        # a list of equal scores maps to 1
+        contrib = np.where(spread[:, None] > 0, (scores - lo[:, None]) / np.where(spread > 0, spread, 1)[:, None], 1)
+    else:
+        mean = scores.sum(axis=1) / count
+        std = np.sqrt((np.where(valid, scores - mean[:, None], 0) ** 2).sum(axis=1) / count)
+        contrib = (scores - mean[:, None]) / np.where(std > 0, std, 1)[:, None]
+        floor = np.where(valid, contrib, np.inf).min(axis=1)
+        floor = np.where(np.isfinite(floor), floor, 0)
+    weights = np.asarray(weights, dtype=np.float64)
+    rows, inverse = np.unique(list_idx[valid], return_inverse=True)
+    fused = np.full(len(rows), float((weights * floor).sum()))
+    np.add.at(fused, inverse, (weights[:, None] * (contrib - floor[:, None]))[valid])
+    return rows, fused
+
+def hybrid_fusion_topk(bm25_sims, dense_sims, offsets, excluded, hybrid_fusion="rrf", hybrid_weight=0.5, rrf_k=60,
+                       k=1000, candidate_k=1000):
+    # (units x docs) BM25 and dense scores of a block of queries, the units of query i are the rows
+    # offsets[i]:offsets[i + 1] and excluded[i] its excluded rows, which never take a candidate slot.
+    # -> (final_idx, final_scores) of every query, -1 / -inf past the last hit, and the candidate_k
+    # deep {'bm25': (idx, scores), 'dense': (idx, scores)} of every unit; shared by
+    # retrieval_hybrid_fusion_desc and serve.FusionSearcher
+    unit_excluded = [rows for rows, n in zip(excluded, np.diff(offsets)) for _ in range(n)]
+    bm25_topk = get_topk(bm25_sims, k=candidate_k, excluded=unit_excluded)
+    dense_topk = get_topk(dense_sims, k=candidate_k, excluded=unit_excluded)
+    final_idx = np.full((len(excluded), min(k, candidate_k)), -1, dtype=np.int64)
+    final_scores = np.full(final_idx.shape, -np.inf)
+    for qi in range(len(excluded)):
+        unit_rows = np.arange(offsets[qi], offsets[qi + 1])
+        weights = np.r_[np.full(len(unit_rows), 1 - hybrid_weight), np.full(len(unit_rows), hybrid_weight)]
+        candidates, fused = fuse_candidate_lists(
+            np.concatenate([bm25_topk[0][unit_rows], dense_topk[0][unit_rows]]),
+            np.concatenate([bm25_topk[1][unit_rows], dense_topk[1][unit_rows]]),
+            weights, hybrid_fusion, rrf_k)
+        top, top_scores = get_topk(fused[None, :], k=final_idx.shape[1])
+        final_idx[qi, :top.shape[1]] = candidates[top[0]]
+        final_scores[qi, :top.shape[1]] = top_scores[0]
+    return final_idx, final_scores, {'bm25': bm25_topk, 'dense': dense_topk}
+
+@no_grad
+def retrieval_hybrid_fusion_desc(
+    queries, query_ids, documents, doc_ids, task, instructions, model_id, cache_dir, excluded_ids, long_context,
+    ground_truth=None,
+    **kwargs
+):
+    # every ReDI unit is scored with BM25 (sub-query + desc text, as retrieval_bm25_fusion_desc) and the
+    # dense model (unit embedding, as retrieval_sbert_bge_fusion_desc) over the cached BM25 matrix and doc
+    # embeddings; only the top-k candidates of each unit x modality list are kept and fused per query:
+    #   rrf     sum of w / (rrf_k + rank)
+    #   minmax  sum of w * scores min-max scaled within the list
+    #   zscore  sum of w * standardized scores within the list
+    # w is hybrid_weight for the dense lists and 1 - hybrid_weight for the BM25 lists
+    hybrid_fusion = kwargs.get("hybrid_fusion", "rrf")
+    hybrid_weight = kwargs.get("hybrid_weight", 0.5)
+    rrf_k         = kwargs.get("rrf_k", 60)
+    k             = kwargs.get("k", 1000)
+
+    unit_table = kwargs.get("unit_table")
+    if unit_table is None:
+        unit_table = UnitTable.from_queries(query_ids, queries)
+    unit_offsets, unit_columns = unit_table.select(query_ids, columns=("sub_query", "desc", "text"))
+
+    analyzer = get_analyzer()
+    bm25_index = load_or_build_bm25_index(
+        documents, doc_ids, analyzer,
+        cache_dir=cache_dir, task=task, long_context=long_context,
+        k1=0.9, b=0.4, ignore_cache=kwargs.get("ignore_cache", False), num_workers=kwargs.get("num_workers", 1)
+    )
+    model, doc_emb, batch_size = load_fusion_encoder(model_id, cache_dir, task, documents, long_context,
+                                                     **kwargs)
+    unit_embs, _, _ = encode_fusion_units(model, unit_columns["sub_query"], unit_columns["desc"],
+                                          kwargs.get("embed_method", "separate"), kwargs.get("desc_weight", 0.5),
+                                          batch_size)
+    unit_embs = normalize_rows(unit_embs)
+
+    excluded_rows = kwargs.get("excluded_rows")
+    if excluded_rows is None:
+        excluded_rows = get_excluded_index(doc_ids, excluded_ids)
+    fused_scores     = {}
+    per_subq_hits    = {}
+    per_subq_docs    = {}
+    fused_hit_counts = {}
+    query_block_size = kwargs.get("query_block_size", 16)
+    for start in trange(0, len(query_ids), query_block_size, desc="Hybrid fusion_desc"):
+        block_qids = query_ids[start:start + query_block_size]
+        block_offsets = unit_offsets[start:start + len(block_qids) + 1]
+        rows = slice(block_offsets[0], block_offsets[-1])
+        excluded = [excluded_rows.get(str(qid), np.zeros(0, dtype=np.int64)) for qid in block_qids]
+        unit_matrix = bm25_index.query_matrix([analyzer.analyze(text) for text in unit_columns["text"][rows]])
+        final_idx, final_scores, unit_topk = hybrid_fusion_topk(
+            (bm25_index.matrix @ unit_matrix.T).T.toarray(), dense_scores(unit_embs[rows], doc_emb, normalize=False),
+            block_offsets - block_offsets[0], excluded, hybrid_fusion, hybrid_weight, rrf_k, k=k, candidate_k=k)
+        bm25_topk, dense_topk = unit_topk["bm25"], unit_topk["dense"]
+
+        for bi, qid in enumerate(block_qids):
+            unit_rows = np.arange(block_offsets[bi], block_offsets[bi + 1]) - block_offsets[0]
+            gold_set = ground_truth.get(str(qid)) if ground_truth is not None else None
+            per_subq_hits[qid] = {}
+            per_subq_docs[qid] = {}
+            for idx, row in enumerate(unit_rows, start=1):
+                for modality, (topk_idx, topk_scores) in (("bm25", bm25_topk), ("dense", dense_topk)):
+                    topk_docs = [doc_ids[i] for i, s in zip(topk_idx[row], topk_scores[row]) if s != -np.inf]
+                    per_subq_docs[qid][f"Unit{idx}_{modality}"] = topk_docs
+                    per_subq_hits[qid][f"Unit{idx}_{modality}"] = (
+                        len(set(topk_docs) & gold_set) if gold_set is not None else 0)
+            fused_scores[str(qid)] = topk_to_dict(doc_ids, final_idx[bi], final_scores[bi])
+            fused_hit_counts[str(qid)] = (
+                len(set(fused_scores[str(qid)]) & gold_set) if gold_set is not None else 0)
 
     return fused_scores, per_subq_hits, per_subq_docs, fused_hit_counts
 
 
-@torch.no_grad()
+@no_grad
 def retrieval_instructor(queries,query_ids,documents,doc_ids,task,instructions,model_id,cache_dir,excluded_ids,long_context,**kwargs):
+    from sentence_transformers import SentenceTransformer
     if model_id=='inst-l':
-        model = SentenceTransformer('hkunlp/instructor-large')
+        model_path = 'hkunlp/instructor-large'
     elif model_id=='inst-xl':
-        model = SentenceTransformer('hkunlp/instructor-xl')
+        model_path = 'hkunlp/instructor-xl'
     else:
         raise ValueError(f"The model {model_id} is not supported")
+    model = get_model(model_path, lambda: SentenceTransformer(model_path))
     model.set_pooling_include_prompt(False)
 
     batch_size = kwargs.get('batch_size',4)
@@ -504,28 +853,39 @@ def retrieval_instructor(queries,query_ids,documents,doc_ids,task,instructions,m
     # queries = add_instruct_list(texts=queries,task=task,instruction=instructions['query'])
     # documents = add_instruct_list(texts=documents,task=task,instruction=instructions['document'])
 
-    query_embs = model.encode(queries,batch_size=batch_size,show_progress_bar=True,prompt=instructions['query'].format(task=task),normalize_embeddings=True)
-    if not os.path.isdir(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}")):
-        os.makedirs(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}"))
-    cur_cache_file = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}", f'0.npy')
-    if os.path.isfile(cur_cache_file):
-        doc_embs = np.load(cur_cache_file,allow_pickle=True)
-    else:
-        doc_embs = model.encode(documents, show_progress_bar=True, batch_size=batch_size, normalize_embeddings=True,prompt=instructions['document'].format(task=task))
-        np.save(cur_cache_file, doc_embs)
-    scores = cosine_similarity(query_embs, doc_embs)
-    scores = scores.tolist()
-    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids)
-
-
-@torch.no_grad()
+    query_prompt = instructions['query'].format(task=task)
+    doc_prompt = instructions['document'].format(task=task)
+    max_tokens = kwargs.get('max_tokens',None)
+
+    def encode(texts, prompt):
+        if max_tokens is None:
+            return model.encode(texts,batch_size=batch_size,show_progress_bar=True,prompt=prompt,normalize_embeddings=True)
+        return encode_texts_token_batches(
+            texts, model.tokenizer,
+            lambda batch: model.encode(batch,batch_size=len(batch),show_progress_bar=False,prompt=prompt,normalize_embeddings=True),
+            model.max_seq_length, max_tokens)
+
+    query_embs = encode(queries, query_prompt)
+    store = EmbeddingStore(cache_dir, model_path, instruction=doc_prompt, max_length=model.max_seq_length,
+                           dtype=kwargs.get('emb_dtype','float32'))
+    legacy_path = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}", f'0.npy')
+    doc_embs = encode_with_store(
+        store, documents,
+        lambda texts: encode(texts, doc_prompt),
+        legacy_path=legacy_path)
+    scores = dense_scores(query_embs, doc_embs)
+    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids,excluded_rows=kwargs.get('excluded_rows'))
+
+
+@no_grad
 def retrieval_grit(queries,query_ids,documents,doc_ids,task,instructions,model_id,cache_dir,excluded_ids,long_context,**kwargs):
+    from gritlm import GritLM
     customized_checkpoint = kwargs.get('checkpoint',None)
     if customized_checkpoint is None:
         customized_checkpoint = 'GritLM/GritLM-7B'
     else:
         print('use',customized_checkpoint)
-    model = GritLM(customized_checkpoint, torch_dtype="auto", mode="embedding")
+    model = get_model(customized_checkpoint, lambda: GritLM(customized_checkpoint, torch_dtype="auto", mode="embedding"))
     query_instruction = instructions['query'].format(task=task)
     doc_instruction = instructions['document']
     query_max_length = kwargs.get('query_max_length',256)
@@ -533,236 +893,140 @@ def retrieval_grit(queries,query_ids,documents,doc_ids,task,instructions,model_i
     print("doc max length:",doc_max_length)
     print("query max length:", query_max_length)
     batch_size = kwargs.get('batch_size',1)
-    if not os.path.isdir(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}")):
-        os.makedirs(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}"))
-    cur_cache_file = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}", f'0.npy')
     ignore_cache = kwargs.pop('ignore_cache',False)
-    if os.path.isfile(cur_cache_file):
-        doc_emb = np.load(cur_cache_file, allow_pickle=True)
-    elif ignore_cache:
-        doc_emb = model.encode(documents, instruction=doc_instruction, batch_size=1, max_length=doc_max_length)
+    max_tokens = kwargs.get('max_tokens',None)
+
+    def encode(texts, instruction, max_length):
+        if max_tokens is None:
+            return model.encode(texts, instruction=instruction, batch_size=1, max_length=max_length)
+        return encode_texts_token_batches(
+            texts, model.tokenizer,
+            lambda batch: model.encode(batch, instruction=instruction, batch_size=len(batch), max_length=max_length),
+            max_length, max_tokens)
+    encode_documents = lambda texts: encode(texts, doc_instruction, doc_max_length)
+    if ignore_cache:
+        doc_emb = encode_documents(documents)
     else:
-        doc_emb = model.encode(documents, instruction=doc_instruction, batch_size=1, max_length=doc_max_length)
-        np.save(cur_cache_file, doc_emb)
-    query_emb = model.encode(queries, instruction=query_instruction, batch_size=1, max_length=query_max_length)
-    scores = pairwise_cosine_similarity(torch.from_numpy(query_emb), torch.from_numpy(doc_emb))
-    scores = scores.tolist()
+        store = EmbeddingStore(cache_dir, customized_checkpoint, instruction=doc_instruction, max_length=doc_max_length,
+                               dtype=kwargs.get('emb_dtype','float32'))
+        legacy_path = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}", f'0.npy')
+        # batch_size only names the legacy cache, the store hands encode_documents chunks the token batcher packs
+        doc_emb = encode_with_store(store, documents, encode_documents, chunk_size=kwargs.get('encode_chunk_size',4096),
+                                    legacy_path=legacy_path)
+    query_emb = encode(queries, query_instruction, query_max_length)
+    scores = dense_scores(query_emb, doc_emb)
     assert len(scores) == len(query_ids), f"{len(scores)}, {len(query_ids)}"
     assert len(scores[0]) == len(documents), f"{len(scores[0])}, {len(documents)}"
-    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids)
+    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids,excluded_rows=kwargs.get('excluded_rows'))
 
 
 def retrieval_openai(queries,query_ids,documents,doc_ids,task,model_id,cache_dir,excluded_ids,long_context,**kwargs):
+    import tiktoken
+    from openai import OpenAI
     tokenizer = tiktoken.get_encoding("cl100k_base")
-    new_queries = []
-    for q in queries:
-        new_queries.append(cut_text_openai(text=q,tokenizer=tokenizer))
-    queries = new_queries
-    new_documents = []
-    for d in documents:
-        new_documents.append(cut_text_openai(text=d,tokenizer=tokenizer))
-    documents = new_documents
-    doc_emb = []
     batch_size = kwargs.get('batch_size',1024)
     # openai_client = OpenAI(api_key=kwargs['key'])
     openai_client = OpenAI()
-    if not os.path.isdir(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}")):
-        os.makedirs(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}"))
-    for idx in trange(0,len(documents),batch_size):
-        cur_cache_file = os.path.join(cache_dir,'doc_emb',model_id,task,f"long_{long_context}_{batch_size}",f'{idx}.json')
-        if os.path.isfile(cur_cache_file):
-            with open(cur_cache_file) as f:
-                cur_emb = json.load(f)
-        else:
-            cur_emb = get_embedding_openai(texts=documents[idx:idx + batch_size],openai_client=openai_client,tokenizer=tokenizer)
-            with open(cur_cache_file,'w') as f:
-                json.dump(cur_emb,f,indent=2)
-        doc_emb += cur_emb
-    query_emb = []
-    for idx in trange(0, len(queries), batch_size):
-        cur_emb = get_embedding_openai(texts=queries[idx:idx + batch_size], openai_client=openai_client,
-                                       tokenizer=tokenizer)
-        query_emb += cur_emb
-    scores = pairwise_cosine_similarity(torch.tensor(query_emb), torch.tensor(doc_emb))
-    scores = scores.tolist()
-    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids)
+    prepare = lambda texts: [json.dumps(cut_text_openai(text=t,tokenizer=tokenizer).replace("\n", " ")) for t in texts]
+    embed = lambda texts: [e.embedding for e in openai_client.embeddings.create(input=texts, model="text-embedding-3-large").data]
+    client = get_api_client(
+        embed, 'openai',
+        truncate_fn=lambda texts, attempt: [cut_text_openai(text=t,tokenizer=tokenizer,threshold=6000-500*attempt) for t in texts],
+        **kwargs)
+    # documents are keyed by their full text, only the ones to encode are cut to 6000 tokens
+    store = EmbeddingStore(cache_dir, 'text-embedding-3-large', max_length=6000, dtype=kwargs.get('emb_dtype','float32'))
+    if kwargs.get('chunk_tokens',-1) > 0:
+        # chunks are within the limit already, a failed batch is retried as is
+        doc_client = get_api_client(embed, 'openai', **kwargs)
+        doc_emb, chunk_doc = encode_doc_chunks(
+            store, documents, lambda texts: doc_client.encode(prepare(texts), batch_size),
+            lambda texts: [tokenizer.encode(t) for t in texts], tokenizer.decode, 6000,
+            **{**kwargs, 'encode_chunk_size': batch_size*doc_client.concurrency*8})
+        query_emb = client.encode(prepare(queries), batch_size)
+        return chunked_dense_search(query_emb, doc_emb, chunk_doc, query_ids, doc_ids, excluded_ids, **kwargs)
+    # per-batch {idx}.json caches of earlier versions are imported into the store once
+    legacy_dir = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}")
+    doc_emb = encode_with_store(store, documents, lambda texts: client.encode(prepare(texts), batch_size),
+                                chunk_size=batch_size*client.concurrency*8, legacy_path=legacy_dir)
+    query_emb = client.encode(prepare(queries), batch_size)
+    scores = dense_scores(query_emb, doc_emb)
+    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids,excluded_rows=kwargs.get('excluded_rows'))
 
 
 def retrieval_cohere(queries,query_ids,documents,doc_ids,task,model_id,cache_dir,excluded_ids,long_context,**kwargs):
-    query_emb = []
-    doc_emb = []
+    import cohere
     batch_size = kwargs.get('batch_size',8192)
     # cohere_client = cohere.Client(kwargs['key'])
     cohere_client = cohere.Client()
-    if not os.path.isdir(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}")):
-        os.makedirs(os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}"))
-    for idx in trange(0,len(documents),batch_size):
-        cur_cache_file = os.path.join(cache_dir,'doc_emb',model_id,task,f"long_{long_context}_{batch_size}",f'{idx}.json')
-        if os.path.isfile(cur_cache_file):
-            with open(cur_cache_file) as f:
-                cur_emb = json.load(f)
-        else:
-            success = False
-            exec_count = 0
-            cur_emb = []
-            while not success:
-                exec_count += 1
-                if exec_count>5:
-                    print('cohere execute too many times')
-                    exit(0)
-                try:
-                    cur_emb = cohere_client.embed(texts=documents[idx:idx+batch_size], input_type="search_document",
-                                                  model="embed-english-v3.0").embeddings
-
-                    success = True
-                except Exception as e:
-                    print(e)
-                    time.sleep(60)
-            with open(cur_cache_file, 'w') as f:
-                json.dump(cur_emb, f, indent=2)
-        doc_emb += cur_emb
-    for idx in trange(0, len(queries), batch_size):
-        success = False
-        exec_count = 0
-        while not success:
-            exec_count += 1
-            if exec_count > 5:
-                print('cohere query execute too many times')
-                exit(0)
-            try:
-                cur_emb = cohere_client.embed(queries[idx:idx+batch_size], input_type="search_query",
-                                              model="embed-english-v3.0").embeddings
-                query_emb += cur_emb
-                success = True
-            except Exception as e:
-                print(e)
-                time.sleep(60)
-    scores = (torch.tensor(query_emb) @ torch.tensor(doc_emb).T) * 100
-    scores = scores.tolist()
-    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids)
+    doc_client = get_api_client(
+        lambda texts: cohere_client.embed(texts=texts, input_type="search_document", model="embed-english-v3.0").embeddings,
+        'cohere', **kwargs)
+    query_client = get_api_client(
+        lambda texts: cohere_client.embed(texts=texts, input_type="search_query", model="embed-english-v3.0").embeddings,
+        'cohere', **kwargs)
+    store = EmbeddingStore(cache_dir, 'embed-english-v3.0', instruction='search_document', dtype=kwargs.get('emb_dtype','float32'))
+    # per-batch {idx}.json caches of earlier versions are imported into the store once
+    legacy_dir = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}")
+    doc_emb = encode_with_store(store, documents, lambda texts: doc_client.encode(texts, batch_size),
+                                chunk_size=batch_size*doc_client.concurrency*8, legacy_path=legacy_dir)
+    query_emb = query_client.encode(queries, batch_size)
+    scores = dense_scores(query_emb, doc_emb, normalize=False, scale=100)
+    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids,excluded_rows=kwargs.get('excluded_rows'))
 
 
 def retrieval_voyage(queries,query_ids,documents,doc_ids,task,model_id,cache_dir,excluded_ids,long_context,**kwargs):
+    import voyageai
+    from transformers import AutoTokenizer
     tokenizer = AutoTokenizer.from_pretrained('voyageai/voyage')
-    new_queries = []
-    for q in queries:
-        new_queries.append(cut_text(text=q,tokenizer=tokenizer,threshold=16000))
-    queries = new_queries
-    new_documents = []
-    for d in tqdm(documents,desc='preprocess documents'):
-        new_documents.append(cut_text(text=d,tokenizer=tokenizer,threshold=16000))
-    documents = new_documents
-
-    query_emb = []
-    doc_emb = []
-
     batch_size = kwargs.get('batch_size',1)
 
-    doc_emb = None
-    doc_cache_path = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}.npy")
-    os.makedirs(os.path.dirname(doc_cache_path), exist_ok=True)
-    if os.path.isfile(doc_cache_path):
-        # already exists so we can just load it
-        doc_emb = np.load(doc_cache_path, allow_pickle=True)
-
     # voyage_client = voyageai.Client(api_key=kwargs['key'])
     voyage_client = voyageai.Client()
-    for i in trange(0,len(documents),batch_size):
-        assert doc_emb is None or doc_emb.shape[0] % batch_size == 0, f"{doc_emb % batch_size} reminder in doc_emb"
-        if doc_emb is not None and doc_emb.shape[0] // batch_size > i:
-            continue
-        
-        success = False
-        threshold = 16000
-        cur_texts = documents[i:i+batch_size]
-        count_over = 0
-        exec_count = 0
-        while not success:
-            exec_count += 1
-            if exec_count > 5:
-                print('voyage document too many times')
-                exit(0)
-            try:
-                cur_emb = voyage_client.embed(cur_texts, model="voyage-large-2-instruct", input_type="document").embeddings
-                doc_emb = cur_emb if doc_emb is None else np.concatenate((doc_emb, np.array(cur_emb)), axis=0)
-                if (i + 1) % 1000 == 0:
-                    np.save(doc_cache_path, doc_emb)
-                success = True
-            except Exception as e:
-                print(e)
-                count_over += 1
-                threshold = threshold-500
-                if count_over>4:
-                    print('voyage:',count_over)
-                new_texts = []
-                for t in cur_texts:
-                    new_texts.append(cut_text(text=t,tokenizer=tokenizer,threshold=threshold))
-                cur_texts = new_texts
-                time.sleep(5)
-
-    query_emb = []
-    for i in trange(0,len(queries),batch_size):
-        success = False
-        threshold = 16000
-        cur_texts = queries[i:i+batch_size]
-        count_over = 0
-        exec_count = 0
-        while not success:
-            exec_count += 1
-            if exec_count > 5:
-                print('voyage query execute too many times')
-                exit(0)
-            try:
-                cur_emb = voyage_client.embed(cur_texts, model="voyage-large-2-instruct", input_type="query").embeddings
-                query_emb += cur_emb
-                success = True
-            except Exception as e:
-                print(e)
-                count_over += 1
-                threshold = threshold-500
-                if count_over>4:
-                    print('voyage:',count_over)
-                new_texts = []
-                for t in cur_texts:
-                    new_texts.append(cut_text(text=t,tokenizer=tokenizer,threshold=threshold))
-                cur_texts = new_texts
-                time.sleep(60)
-    scores = pairwise_cosine_similarity(torch.tensor(query_emb), torch.tensor(doc_emb))
-    scores = scores.tolist()
-    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids)
+    cut = lambda texts, threshold=16000: [cut_text(text=t,tokenizer=tokenizer,threshold=threshold) for t in texts]
+    truncate = lambda texts, attempt: cut(texts, 16000-500*attempt)
+    chunking = kwargs.get('chunk_tokens',-1) > 0
+    # chunks are within the limit already, a failed batch is retried as is
+    doc_client = get_api_client(
+        lambda texts: voyage_client.embed(texts, model="voyage-large-2-instruct", input_type="document").embeddings,
+        'voyage', truncate_fn=None if chunking else truncate, **kwargs)
+    query_client = get_api_client(
+        lambda texts: voyage_client.embed(texts, model="voyage-large-2-instruct", input_type="query").embeddings,
+        'voyage', truncate_fn=truncate, **kwargs)
+
+    # documents are keyed by their full text, only the ones to encode are cut to 16000 tokens
+    store = EmbeddingStore(cache_dir, 'voyage-large-2-instruct', instruction='document', max_length=16000,
+                           dtype=kwargs.get('emb_dtype','float32'))
+    doc_cache_path = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}.npy")
+    if chunking:
+        doc_emb, chunk_doc = encode_doc_chunks(
+            store, documents, lambda texts: doc_client.encode(texts, batch_size),
+            lambda texts: tokenizer(texts, add_special_tokens=False)['input_ids'], tokenizer.decode, 16000,
+            **{**kwargs, 'encode_chunk_size': batch_size*doc_client.concurrency*8})
+        query_emb = query_client.encode(cut(queries), batch_size)
+        return chunked_dense_search(query_emb, doc_emb, chunk_doc, query_ids, doc_ids, excluded_ids, **kwargs)
+    doc_emb = encode_with_store(store, documents, lambda texts: doc_client.encode(cut(texts), batch_size),
+                                chunk_size=batch_size*doc_client.concurrency*8, legacy_path=doc_cache_path)
+    query_emb = query_client.encode(cut(queries), batch_size)
+    scores = dense_scores(query_emb, doc_emb)
+    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids,excluded_rows=kwargs.get('excluded_rows'))
 
 
 def retrieval_google(queries,query_ids,documents,doc_ids,task,model_id,cache_dir,excluded_ids,long_context,**kwargs):
+    from vertexai.language_models import TextEmbeddingModel
     model = TextEmbeddingModel.from_pretrained("text-embedding-preview-0409")
-    query_emb = []
-    # doc_emb = []
     batch_size = kwargs.get('batch_size',8)
-    doc_emb = None
+    doc_client = get_api_client(lambda texts: get_embedding_google(texts=texts, task='RETRIEVAL_DOCUMENT', model=model),
+                                'google', **kwargs)
+    query_client = get_api_client(lambda texts: get_embedding_google(texts=texts, task='RETRIEVAL_QUERY', model=model),
+                                  'google', **kwargs)
+    store = EmbeddingStore(cache_dir, 'text-embedding-preview-0409', instruction='RETRIEVAL_DOCUMENT',
+                           dtype=kwargs.get('emb_dtype','float32'))
     cache_path = os.path.join(cache_dir, 'doc_emb', model_id, task, f"long_{long_context}_{batch_size}.npy")
-    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-    if os.path.isfile(cache_path):
-        # already exists so we can just load it
-        doc_emb = np.load(cache_path, allow_pickle=True)
-
-    for start_idx in tqdm(range(0, len(documents), batch_size), desc='embedding'):
-        assert doc_emb is None or doc_emb.shape[0] % batch_size == 0, f"{doc_emb % batch_size} reminder in doc_emb"
-        if doc_emb is not None and doc_emb.shape[0] // batch_size > start_idx:
-            continue
-        
-        cur_emb = get_embedding_google(
-            texts=documents[start_idx:start_idx + batch_size], task='RETRIEVAL_DOCUMENT',
-            model=model
-        )
-        doc_emb = cur_emb if doc_emb is None else np.concatenate((doc_emb, np.array(cur_emb)), axis=0)
-        if (start_idx + 1) % 1000 == 0:
-            np.save(cache_path, doc_emb)
-    np.save(cache_path, doc_emb)
-        
-    for start_idx in tqdm(range(0,len(queries), batch_size),desc='embedding'):
-        query_emb += get_embedding_google(texts=queries[start_idx:start_idx+ batch_size],task='RETRIEVAL_QUERY',model=model)
-    scores = pairwise_cosine_similarity(torch.tensor(query_emb), torch.tensor(doc_emb))
-    scores = scores.tolist()
-    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids)
+    doc_emb = encode_with_store(store, documents, lambda texts: doc_client.encode(texts, batch_size),
+                                chunk_size=batch_size*doc_client.concurrency*8, legacy_path=cache_path)
+    query_emb = query_client.encode(queries, batch_size)
+    scores = dense_scores(query_emb, doc_emb)
+    return get_scores(query_ids=query_ids,doc_ids=doc_ids,scores=scores,excluded_ids=excluded_ids,excluded_rows=kwargs.get('excluded_rows'))
 
 
 RETRIEVAL_FUNCS = {
@@ -775,6 +1039,7 @@ RETRIEVAL_FUNCS = {
     'sbert': retrieval_sbert_bge,
     'bge': retrieval_sbert_bge,
     'sbert_fusion_desc': retrieval_sbert_bge_fusion_desc,
+    'hybrid_fusion_desc': retrieval_hybrid_fusion_desc,
     'bge_fusion_desc': retrieval_sbert_bge_fusion_desc,
     'inst-l': retrieval_instructor,
     'inst-xl': retrieval_instructor,
@@ -785,9 +1050,19 @@ RETRIEVAL_FUNCS = {
     'google': retrieval_google
 }
 
-def calculate_retrieval_metrics(results, qrels, k_values=[1, 5, 10, 25, 50, 100]):
+def calculate_retrieval_metrics(results, qrels, k_values=[1, 5, 10, 25, 50, 100], exact_results=None,
+                                evaluator="pytrec_eval", doc_ids=None):
     # https://github.com/beir-cellar/beir/blob/f062f038c4bfd19a8ca942a9910b1e0d218759d4/beir/retrieval/evaluation.py#L66
     # follow evaluation from BEIR, which is just using the trec eval
+    if evaluator == "numpy":
+        # same numbers without pytrec_eval, see fast_eval.py
+        from fast_eval import calculate_retrieval_metrics_np
+        output = calculate_retrieval_metrics_np(results, qrels, doc_ids, k_values=k_values)
+        if exact_results is not None:
+            output.update(ann_recall_loss(results, exact_results, qrels))
+        print(output)
+        return output
+    import pytrec_eval
     ndcg = {}
     _map = {}
     recall = {}
@@ -828,5 +1103,29 @@ def calculate_retrieval_metrics(results, qrels, k_values=[1, 5, 10, 25, 50, 100]
     mrr["MRR"] = round(mrr["MRR"] / len(scores), 5)
 
     output = {**ndcg, **_map, **recall, **precision, **mrr}
+    if exact_results is not None:
+        output.update(ann_recall_loss(results, exact_results, qrels))
     print(output)
     return output
+
+def ann_recall_loss(results, exact_results, qrels, k=1000):
+    # how much gold recall@k and NDCG@10 approximate search gives up, and how much of the exact top-k it finds
+    import pytrec_eval
+    evaluator = pytrec_eval.RelevanceEvaluator(qrels, {f"recall.{k}", "ndcg_cut.10"})
+    ann_eval = evaluator.evaluate(results)
+    exact_eval = evaluator.evaluate(exact_results)
+    ann_recall = [v[f"recall_{k}"] for v in ann_eval.values()]
+    exact_recall = [v[f"recall_{k}"] for v in exact_eval.values()]
+    ann_ndcg = round(float(np.mean([v["ndcg_cut_10"] for v in ann_eval.values()])), 5)
+    exact_ndcg = round(float(np.mean([v["ndcg_cut_10"] for v in exact_eval.values()])), 5)
+    overlap = []
+    for query_id, exact in exact_results.items():
+        exact_top = sorted(exact, key=exact.get, reverse=True)[:k]
+        ann_top = set(sorted(results.get(query_id, {}), key=results.get(query_id, {}).get, reverse=True)[:k])
+        overlap.append(len(ann_top.intersection(exact_top)) / max(len(exact_top), 1))
+    ann_recall = round(float(np.mean(ann_recall)), 5)
+    exact_recall = round(float(np.mean(exact_recall)), 5)
+    return {f"ANN_Recall@{k}": ann_recall, f"Exact_Recall@{k}": exact_recall,
+            f"ANN_Recall@{k}_loss": round(exact_recall - ann_recall, 5),
+            f"ANN_Overlap@{k}": round(float(np.mean(overlap)), 5),
+            "Exact_NDCG@10": exact_ndcg, "NDCG@10_delta": round(ann_ndcg - exact_ndcg, 5)}
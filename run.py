@@ -2,70 +2,170 @@ import os
 import argparse
 import json
 from tqdm import tqdm
-from retrievers import RETRIEVAL_FUNCS,calculate_retrieval_metrics
-from datasets import Dataset, load_dataset
+from retrievers import RETRIEVAL_FUNCS,calculate_retrieval_metrics,get_excluded_index
+from run_io import run_exists, save_run, load_run, save_per_subq_docs, hit_count, unit_hit_stats
+from unit_table import load_or_build_unit_table
 
-if __name__=='__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--task', type=str, required=True,
-                        choices=['biology','earth_science','economics','pony','psychology','robotics',
-                                 'stackoverflow','sustainable_living','aops','leetcode','theoremqa_theorems',
-                                 'theoremqa_questions'])
-    parser.add_argument('--model', type=str, required=True,
-                        choices=['bm25','bm25_fusion_desc','cohere','e5','google','grit','inst-l','inst-xl',
-                                 'openai','qwen','qwen2','sbert','sbert_fusion_desc','sf','voyage','bge'])
+TASKS = ['biology','earth_science','economics','pony','psychology','robotics','stackoverflow','sustainable_living',
+         'aops','leetcode','theoremqa_theorems','theoremqa_questions']
+MODELS = ['bm25','bm25_fusion_desc','cohere','e5','google','grit','inst-l','inst-xl','openai','qwen','qwen2','sbert',
+          'sbert_fusion_desc','hybrid_fusion_desc','sf','voyage','bge']
+# models whose search goes through retrievers.dense_search, the only one with an approximate first stage
+ANN_MODELS = ['sbert','bge','sf','qwen','qwen2','e5']
+# models that encode long documents as chunks with --chunk_tokens
+CHUNK_MODELS = ['sbert','bge','sf','qwen','qwen2','e5','openai','voyage']
+
+def add_common_args(parser):
+    # everything but --task/--model/--reasoning, shared with run_batch.py
     parser.add_argument('--long_context', action='store_true')
     parser.add_argument('--query_max_length', type=int, default=-1)
     parser.add_argument('--doc_max_length', type=int, default=-1)
     parser.add_argument('--encode_batch_size', type=int, default=-1)
+    parser.add_argument('--max_tokens', type=int, default=-1)
     parser.add_argument('--output_dir', type=str, default='outputs')
     parser.add_argument('--cache_dir', type=str, default='cache')
     parser.add_argument('--config_dir', type=str, default='configs')
     parser.add_argument('--checkpoint', type=str, default=None)
     parser.add_argument('--key', type=str, default=None)
     parser.add_argument('--input_file', type=str, default=None)
-    parser.add_argument('--reasoning', type=str, default=None)
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--ignore_cache', action='store_true')
-    args = parser.parse_args()
-    if args.model == "bm25_fusion_desc":
-        args.output_dir = os.path.join(args.output_dir,f"{args.task}_bm25_long_{args.long_context}")
-    elif args.model == "sbert_fusion_desc":
-        args.output_dir = os.path.join(args.output_dir,f"{args.task}_dense_long_{args.long_context}")
-    else:
-        args.output_dir = os.path.join(args.output_dir,f"{args.task}_{args.model}_long_{args.long_context}")
-    if not os.path.isdir(args.output_dir):
-        os.makedirs(args.output_dir)
-    score_file_path = os.path.join(args.output_dir,f'score.json')
+    parser.add_argument('--emb_dtype', type=str, default='float32', choices=['float32','float16'])
+    # binary: run.trec + run_idx.npy/run_scores.npy instead of score.json, per_subq_docs as index arrays
+    parser.add_argument('--output_format', type=str, default='json', choices=['json','binary'])
+    # approximate first-stage search for sbert/bge/sf/qwen/qwen2/e5, results.json then also reports the
+    # recall@1000 and NDCG@10 loss against the exact run of the same model if that run exists
+    parser.add_argument('--ann', type=str, default=None, choices=['ivf'])
+    parser.add_argument('--ann_nlist', type=int, default=-1)
+    parser.add_argument('--ann_nprobe', type=int, default=32)
+    parser.add_argument('--quant', type=str, default=None, choices=['int8','binary'])
+    parser.add_argument('--quant_shortlist', type=int, default=4000)
+    # sf/qwen/qwen2/e5/sbert/bge/openai/voyage: documents longer than chunk_tokens are encoded as windows
+    # sharing chunk_overlap tokens instead of being truncated, a doc scores the max or mean of its chunks
+    parser.add_argument('--chunk_tokens', type=int, default=-1)
+    parser.add_argument('--chunk_overlap', type=int, default=64)
+    parser.add_argument('--chunk_pooling', type=str, default='max', choices=['max','mean'])
+    # openai/cohere/voyage/google: batches in flight and optional requests/tokens per minute limits
+    parser.add_argument('--api_concurrency', type=int, default=4)
+    parser.add_argument('--api_rpm', type=int, default=-1)
+    parser.add_argument('--api_tpm', type=int, default=-1)
+    # exact bm25 and dense scoring split the corpus into this many shards scored by forked workers,
+    # and building a BM25 index analyzes new documents in this many processes
+    parser.add_argument('--num_workers', type=int, default=1)
+    # unit embedding and fusion of sbert_fusion_desc, see fusion_sweep.py for a grid over the last two
+    parser.add_argument('--embed_method', type=str, default='separate', choices=['separate','joint'])
+    parser.add_argument('--desc_weight', type=float, default=0.5)
+    parser.add_argument('--fusion_method', type=str, default='sum', choices=['sum','max'])
+    # hybrid_fusion_desc: fusion of the BM25 and dense lists of every unit, weight of the dense lists
+    parser.add_argument('--hybrid_fusion', type=str, default='rrf', choices=['rrf','minmax','zscore'])
+    parser.add_argument('--hybrid_weight', type=float, default=0.5)
+    parser.add_argument('--rrf_k', type=int, default=60)
+    # numpy: fast_eval.py, the same metrics as pytrec_eval computed on top-k arrays
+    parser.add_argument('--evaluator', type=str, default='pytrec_eval', choices=['pytrec_eval','numpy'])
 
-    if args.input_file is not None:
-        with open(args.input_file) as f:
-            examples = json.load(f)
-    elif args.reasoning is not None:
-        # examples = load_dataset('xlangai/bright', f"{args.reasoning}_reason", cache_dir=args.cache_dir)[args.task]
-        # Load from local path, replace with your path
-        examples = Dataset.from_file(
-            f"/.../{args.reasoning}_reason/bright-{args.task}.arrow"
-        )
-    else:
-        examples = load_dataset('xlangai/bright', 'examples',cache_dir=args.cache_dir)[args.task]
-    if args.long_context:
-        doc_pairs = load_dataset('xlangai/bright', 'long_documents',cache_dir=args.cache_dir)[args.task]
+def check_common_args(parser, args, models):
+    # the IVF index and the quantized codes are alternative first stages
+    if args.ann is not None and args.quant is not None:
+        parser.error("--ann and --quant cannot be combined, choose one first-stage search")
+    if args.ann is not None or args.quant is not None:
+        unsupported = [model for model in models if model not in ANN_MODELS]
+        if unsupported:
+            parser.error(f"--ann/--quant only apply to {'/'.join(ANN_MODELS)}, not {', '.join(unsupported)}")
+    if args.chunk_tokens > 0:
+        # chunked search is always exact
+        if args.ann is not None or args.quant is not None:
+            parser.error("--chunk_tokens cannot be combined with --ann/--quant")
+        unsupported = [model for model in models if model not in CHUNK_MODELS]
+        if unsupported:
+            parser.error(f"--chunk_tokens only applies to {'/'.join(CHUNK_MODELS)}, not {', '.join(unsupported)}")
+
+def get_search_suffix(args):
+    # approximate and chunked searches write next to the exact run of the same model, see get_output_dir;
+    # chunked search is always exact
+    if args.chunk_tokens > 0:
+        return f"chunk_{args.chunk_tokens}_{args.chunk_overlap}_{args.chunk_pooling}"
+    if args.ann is not None:
+        return f"{args.ann}_nprobe_{args.ann_nprobe}"
+    if args.quant is not None:
+        return f"{args.quant}_shortlist_{args.quant_shortlist}"
+    return None
+
+def get_fusion_suffix(args):
+    # hybrid_fusion_desc runs are named after their fusion settings, sbert_fusion_desc runs with other
+    # than the default unit settings get their own directory
+    if args.model == 'hybrid_fusion_desc':
+        hybrid = args.hybrid_fusion
+        if args.hybrid_fusion == 'rrf' and args.rrf_k != 60:
+            hybrid += f"_k_{args.rrf_k}"
+        if args.hybrid_weight != 0.5:
+            hybrid += f"_hw_{args.hybrid_weight}"
+        # the unit embedding settings apply, fusion_method is replaced by the hybrid fusion
+        if args.embed_method == 'joint':
+            hybrid += "_joint"
+        elif args.desc_weight != 0.5:
+            hybrid += f"_w_{args.desc_weight}"
+        return hybrid
+    if (args.embed_method, args.desc_weight, args.fusion_method) == ('separate', 0.5, 'sum'):
+        return None
+    if args.embed_method == 'joint':
+        return f"joint_{args.fusion_method}"
+    return f"w_{args.desc_weight}_{args.fusion_method}"
+
+def get_output_dir(output_dir, task, model, long_context, search=None, fusion=None):
+    if model == "bm25_fusion_desc":
+        return os.path.join(output_dir,f"{task}_bm25_long_{long_context}")
+    elif model == "sbert_fusion_desc" and fusion is not None:
+        return os.path.join(output_dir,f"{task}_dense_long_{long_context}_{fusion}")
+    elif model == "sbert_fusion_desc":
+        return os.path.join(output_dir,f"{task}_dense_long_{long_context}")
+    elif model == "hybrid_fusion_desc":
+        return os.path.join(output_dir,f"{task}_hybrid_long_{long_context}_{fusion}")
+    elif search is not None:
+        return os.path.join(output_dir,f"{task}_{model}_long_{long_context}_{search}")
+    return os.path.join(output_dir,f"{task}_{model}_long_{long_context}")
+
+def get_reasoning_path(task, reasoning):
+    # Load from local path, replace with your path
+    return f"/.../{reasoning}_reason/bright-{task}.arrow"
+
+# datasets is imported by the loaders, so `run.py --help` and importing run stay fast
+def load_examples(task, cache_dir, input_file=None, reasoning=None):
+    from datasets import Dataset, load_dataset
+    if input_file is not None:
+        with open(input_file) as f:
+            return json.load(f)
+    elif reasoning is not None:
+        # examples = load_dataset('xlangai/bright', f"{reasoning}_reason", cache_dir=cache_dir)[task]
+        return Dataset.from_file(get_reasoning_path(task, reasoning))
+    return load_dataset('xlangai/bright', 'examples',cache_dir=cache_dir)[task]
+
+def load_corpus(task, long_context, cache_dir):
+    from datasets import load_dataset
+    if long_context:
+        doc_pairs = load_dataset('xlangai/bright', 'long_documents',cache_dir=cache_dir)[task]
     else:
-        doc_pairs = load_dataset('xlangai/bright', 'documents',cache_dir=args.cache_dir)[args.task]
+        doc_pairs = load_dataset('xlangai/bright', 'documents',cache_dir=cache_dir)[task]
     doc_ids = []
     documents = []
     for dp in doc_pairs:
         doc_ids.append(dp['id'])
         documents.append(dp['content'])
+    doc_index = {did:i for i,did in enumerate(doc_ids)}
+    return doc_ids, documents, doc_index
 
-    if not os.path.isfile(score_file_path):
+def run_retrieval(args, examples, doc_ids, documents, doc_index):
+    # args.output_dir is the directory of this task/model, see get_output_dir
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    score_file_path = os.path.join(args.output_dir,f'score.json')
+
+    if not run_exists(args.output_dir):
         if args.model in ("bm25_fusion_desc"):
             with open(os.path.join(args.config_dir,"bm25",f"{args.task}.json")) as f:
                 config = json.load(f)
             if not os.path.isdir(args.output_dir):
                 os.makedirs(args.output_dir)
-        elif args.model in ("sbert_fusion_desc"):
+        elif args.model in ("sbert_fusion_desc","hybrid_fusion_desc"):
             with open(os.path.join(args.config_dir,"dense",f"{args.task}.json")) as f:
                 config = json.load(f)
             if not os.path.isdir(args.output_dir):
@@ -97,6 +197,7 @@ if __name__=='__main__':
             with open(os.path.join(args.cache_dir,'doc_ids',f"{args.task}_{args.long_context}.json"),'w') as f:
                 json.dump(doc_ids,f,indent=2)
         assert len(doc_ids)==len(documents), f"{len(doc_ids)}, {len(documents)}"
+        excluded_rows = get_excluded_index(doc_ids,excluded_ids,doc_index=doc_index)
 
         print(f"{len(queries)} queries")
         print(f"{len(documents)} documents")
@@ -110,71 +211,86 @@ if __name__=='__main__':
             kwargs.update({'doc_max_length': args.doc_max_length})
         if args.encode_batch_size>0:
             kwargs.update({'batch_size': args.encode_batch_size})
+        if args.max_tokens>0:
+            kwargs.update({'max_tokens': args.max_tokens})
         if args.key is not None:
             kwargs.update({'key': args.key})
         if args.ignore_cache:
             kwargs.update({'ignore_cache': args.ignore_cache})
+        kwargs.update({'emb_dtype': args.emb_dtype, 'api_concurrency': args.api_concurrency, 'num_workers': args.num_workers})
+        if args.api_rpm>0:
+            kwargs.update({'api_rpm': args.api_rpm})
+        if args.api_tpm>0:
+            kwargs.update({'api_tpm': args.api_tpm})
+        if args.ann is not None:
+            kwargs.update({'ann': args.ann, 'ann_nprobe': args.ann_nprobe})
+            if args.ann_nlist>0:
+                kwargs.update({'ann_nlist': args.ann_nlist})
+        elif args.quant is not None:
+            kwargs.update({'quant': args.quant, 'quant_shortlist': args.quant_shortlist})
+        if args.chunk_tokens>0:
+            kwargs.update({'chunk_tokens': args.chunk_tokens, 'chunk_overlap': args.chunk_overlap,
+                           'chunk_pooling': args.chunk_pooling})
             
-        if args.model in ("bm25_fusion_desc","sbert_fusion_desc"):
+        if args.model in ("bm25_fusion_desc","sbert_fusion_desc","hybrid_fusion_desc"):
             ground_truth = { str(e["id"]): set(e["gold_ids"]) for e in examples }
+            # units of a reasoning file are parsed once into bright-{task}.units.arrow next to it
+            unit_table = None
+            if args.reasoning is not None and args.input_file is None:
+                unit_table = load_or_build_unit_table(get_reasoning_path(args.task, args.reasoning),
+                                                      ignore_cache=args.ignore_cache)
             fused_scores, per_subq_hits, per_subq_docs, fused_hit_counts = RETRIEVAL_FUNCS[args.model](
                 queries=queries, query_ids=query_ids,
                 documents=documents, doc_ids=doc_ids,
-                excluded_ids=excluded_ids, long_context=args.long_context,
+                excluded_ids=excluded_ids, excluded_rows=excluded_rows, long_context=args.long_context,
+                task=args.task, cache_dir=args.cache_dir,
                 instructions=config["instructions_long"] if args.long_context else config["instructions"],
                 model_id=args.model,
                 ground_truth=ground_truth,  
                 checkpoint=args.checkpoint,
                 key=args.key,
-                ignore_cache=args.ignore_cache
+                ignore_cache=args.ignore_cache,
+                emb_dtype=args.emb_dtype,
+                num_workers=args.num_workers,
+                unit_table=unit_table,
+                embed_method=args.embed_method,
+                desc_weight=args.desc_weight,
+                fusion_method=args.fusion_method,
+                hybrid_fusion=args.hybrid_fusion,
+                hybrid_weight=args.hybrid_weight,
+                rrf_k=args.rrf_k
             )
             scores = fused_scores
             
-            for qid, hits in per_subq_hits.items():
-                total = len(ground_truth[str(qid)])
-                for unit, cnt in hits.items():
-                    per_subq_hits[qid][unit] = f"{cnt}/{total}"
+            # per_subq_hits and oracle_stats follow from the unit docs, as in stream_run.py
+            per_subq_hits, oracle_stats = {}, {}
+            for qid, docs_dict in per_subq_docs.items():
+                per_subq_hits[qid], oracle_stats[qid] = unit_hit_stats(docs_dict, ground_truth[str(qid)])
             with open(os.path.join(args.output_dir, "per_subq_hits.json"), "w") as f:
                 json.dump(per_subq_hits, f, indent=2)
-            with open(os.path.join(args.output_dir, "per_subq_docs.json"), "w") as f:
-                json.dump(per_subq_docs, f, indent=2)
-            oracle_stats = {}
-            for qid, docs_dict in per_subq_docs.items():
-                units = list(docs_dict.keys())
-                total_docs = len(units) * 1000
-                all_docs = []
-                for lst in docs_dict.values():
-                    all_docs.extend(lst)
-                unique_docs = set(all_docs)
-                total_docs_unique = len(unique_docs)
-                gold_set = ground_truth[str(qid)]
-                hit_gold = len(unique_docs & gold_set)
-                total_gold = len(gold_set)
-                unit_hits = {}
-                for unit, lst in docs_dict.items():
-                    unit_hits[unit] = len(set(lst) & gold_set)
-                oracle_stats[qid] = {
-                    "total_docs": total_docs,
-                    "total_docs_unique": total_docs_unique,
-                    "hit_gold_ids": hit_gold,
-                    "total_gold_ids": total_gold,
-                    "unit_hits": unit_hits
-                }
+            if args.output_format == 'json':
+                with open(os.path.join(args.output_dir, "per_subq_docs.json"), "w") as f:
+                    json.dump(per_subq_docs, f, indent=2)
+            else:
+                save_per_subq_docs(args.output_dir, per_subq_docs, doc_index)
             with open(os.path.join(args.output_dir, "oracle_stats.json"), "w") as f:
                 json.dump(oracle_stats, f, indent=2)
         else:
             scores = RETRIEVAL_FUNCS[args.model](
                 queries=queries, query_ids=query_ids, documents=documents, excluded_ids=excluded_ids,
+                excluded_rows=excluded_rows,
                 instructions=config['instructions_long'] if args.long_context else config['instructions'],
                 doc_ids=doc_ids, task=args.task, cache_dir=args.cache_dir, long_context=args.long_context,
                 model_id=args.model, checkpoint= args.checkpoint, **kwargs
             )
-        with open(score_file_path,'w') as f:
-            json.dump(scores,f,indent=2)
+        if args.output_format == 'json':
+            with open(score_file_path,'w') as f:
+                json.dump(scores,f,indent=2)
+        else:
+            save_run(args.output_dir, scores, doc_ids, doc_index=doc_index, tag=args.model)
     else:
-        with open(score_file_path) as f:
-            scores = json.load(f)
-        print(score_file_path,'exists')
+        scores = load_run(args.output_dir, doc_ids)
+        print(args.output_dir,'has a run')
     if args.long_context:
         key = 'gold_ids_long'
     else:
@@ -188,14 +304,7 @@ if __name__=='__main__':
             assert not did in scores[e['id']]
             assert not did in ground_truth[e['id']]
     
-    hit_counts = {}
-    for qid, retrieved_dict in scores.items():
-        retrieved_set = set(retrieved_dict.keys())
-        gold_set      = set(ground_truth[qid].keys())
-
-        hit = len(retrieved_set & gold_set)
-        total = len(gold_set)
-        hit_counts[qid] = f"{hit}/{total}"
+    hit_counts = {qid: hit_count(retrieved_dict, ground_truth[qid]) for qid, retrieved_dict in scores.items()}
     
     if args.model == "bm25_fusion_desc":
         with open(os.path.join(args.output_dir, f"hit_counts_bm25.json"), "w") as hf:
@@ -208,6 +317,40 @@ if __name__=='__main__':
             json.dump(hit_counts, hf, indent=2)
 
     print(args.output_dir)
-    results = calculate_retrieval_metrics(results=scores, qrels=ground_truth)
+    exact_scores = None
+    if args.chunk_tokens <= 0 and (args.ann is not None or args.quant is not None):
+        exact_dir = get_output_dir(os.path.dirname(args.output_dir), args.task, args.model, args.long_context)
+        if run_exists(exact_dir):
+            exact_scores = load_run(exact_dir, doc_ids)
+        else:
+            print('no exact run in', exact_dir, 'to compare the approximate run with')
+    results = calculate_retrieval_metrics(results=scores, qrels=ground_truth, exact_results=exact_scores,
+                                          evaluator=args.evaluator, doc_ids=doc_ids)
     with open(os.path.join(args.output_dir, 'results.json'), 'w') as f:
         json.dump(results, f, indent=2)
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, required=True, choices=TASKS)
+    parser.add_argument('--model', type=str, required=True, choices=MODELS)
+    parser.add_argument('--reasoning', type=str, default=None)
+    # fusion models over a reasoning file: examples are read, encoded, scored and written batch by
+    # batch (binary output format) with flat memory, see stream_run.py
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--stream_batch_size', type=int, default=64)
+    parser.add_argument('--stream_queue_size', type=int, default=2)
+    add_common_args(parser)
+    args = parser.parse_args()
+    check_common_args(parser, args, [args.model])
+    args.output_dir = get_output_dir(args.output_dir, args.task, args.model, args.long_context, get_search_suffix(args),
+                                     get_fusion_suffix(args))
+    if args.stream:
+        from stream_run import STREAM_RETRIEVERS, run_stream_retrieval
+        if args.model not in STREAM_RETRIEVERS or args.reasoning is None or args.input_file is not None:
+            parser.error(f"--stream needs --reasoning and one of {sorted(STREAM_RETRIEVERS)}")
+        doc_ids, documents, _ = load_corpus(args.task, args.long_context, args.cache_dir)
+        run_stream_retrieval(args, doc_ids, documents, get_reasoning_path(args.task, args.reasoning))
+    else:
+        examples = load_examples(args.task, args.cache_dir, input_file=args.input_file, reasoning=args.reasoning)
+        doc_ids, documents, doc_index = load_corpus(args.task, args.long_context, args.cache_dir)
+        run_retrieval(args, examples, doc_ids, documents, doc_index)
@@ -0,0 +1,43 @@
+import os
+import copy
+import argparse
+from run import (TASKS, MODELS, add_common_args, check_common_args, get_output_dir, get_search_suffix, get_fusion_suffix,
+                 load_examples, load_corpus, run_retrieval)
+
+# Runs several tasks x models x reasoning variants in one process. Runs are ordered model-major,
+# so each model is loaded once (retrievers.get_model keeps the last one resident) and every task
+# corpus is read once and kept for the following models. Output directories are the ones run.py
+# writes; with more than one reasoning variant each variant gets its own subdirectory of
+# --output_dir. Finished runs are reused, as in run.py.
+
+def plan_runs(tasks, models, reasonings):
+    return [(model, reasoning, task) for model in models for reasoning in reasonings for task in tasks]
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=str, nargs='+', default=TASKS, choices=TASKS)
+    parser.add_argument('--models', type=str, nargs='+', required=True, choices=MODELS)
+    parser.add_argument('--reasoning', type=str, nargs='+', default=['none'],
+                        help="reasoning variants, 'none' for the original queries")
+    add_common_args(parser)
+    args = parser.parse_args()
+    check_common_args(parser, args, args.models)
+
+    runs = plan_runs(args.tasks, args.models, args.reasoning)
+    print(f"{len(runs)} runs:", ', '.join(f"{m}/{r}/{t}" for m, r, t in runs))
+    corpora = {}
+    for run_no, (model, reasoning, task) in enumerate(runs):
+        print(f"===== [{run_no + 1}/{len(runs)}] model {model}, reasoning {reasoning}, task {task} =====")
+        run_args = copy.copy(args)
+        run_args.task = task
+        run_args.model = model
+        run_args.reasoning = None if reasoning == 'none' else reasoning
+        output_dir = os.path.join(args.output_dir, reasoning) if len(args.reasoning) > 1 else args.output_dir
+        run_args.output_dir = get_output_dir(output_dir, task, model, args.long_context, get_search_suffix(args),
+                                             get_fusion_suffix(run_args))
+        if task not in corpora:
+            corpora[task] = load_corpus(task, args.long_context, args.cache_dir)
+        doc_ids, documents, doc_index = corpora[task]
+        examples = load_examples(task, args.cache_dir, input_file=args.input_file, reasoning=run_args.reasoning)
+        run_retrieval(run_args, examples, doc_ids, documents, doc_index)
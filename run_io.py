@@ -0,0 +1,202 @@
+import os
+import json
+import shutil
+import numpy as np
+from numpy.lib.format import open_memmap
+from emb_store import write_json_atomic
+from bm25_index import doc_ids_fingerprint
+
+# Binary run format, written next to (or instead of) score.json:
+#   run.trec        qid Q0 doc_id rank score tag, for trec_eval and other tools
+#   run_idx.npy     (num_queries, k) int32 row of each hit in the corpus doc_ids, -1 past the last hit
+#   run_scores.npy  (num_queries, k) float64 scores, -inf past the last hit
+#   run_meta.json   query ids and the corpus fingerprint, written last so it marks a complete run
+# RunWriter writes the same files for a stream of query batches.
+RUN_FORMAT_VERSION = 1
+
+
+def rank_lists_to_arrays(rank_lists, doc_index, dtype=np.float64):
+    # rank_lists: list of {doc_id: score} already in rank order, as returned by the retrievers
+    k = max([len(r) for r in rank_lists], default=0)
+    idx = np.full((len(rank_lists), k), -1, dtype=np.int32)
+    scores = np.full((len(rank_lists), k), -np.inf, dtype=dtype)
+    for row, ranked in enumerate(rank_lists):
+        idx[row, :len(ranked)] = [doc_index[did] for did in ranked]
+        scores[row, :len(ranked)] = list(ranked.values())
+    return idx, scores
+
+
+def arrays_to_rank_lists(idx, scores, doc_ids):
+    out = []
+    for row_idx, row_scores in zip(idx, scores):
+        n = int((row_idx >= 0).sum())
+        out.append({doc_ids[i]: float(s) for i, s in zip(row_idx[:n].tolist(), row_scores[:n].tolist())})
+    return out
+
+
+def run_exists(output_dir):
+    return os.path.isfile(os.path.join(output_dir, 'score.json')) or \
+        os.path.isfile(os.path.join(output_dir, 'run_meta.json'))
+
+
+def save_run(output_dir, scores, doc_ids, doc_index=None, tag='ReDI'):
+    doc_index = doc_index if doc_index is not None else {did: i for i, did in enumerate(doc_ids)}
+    qids = list(scores)
+    rank_lists = [dict(sorted(scores[qid].items(), key=lambda x: x[1], reverse=True)) for qid in qids]
+    idx, run_scores = rank_lists_to_arrays(rank_lists, doc_index)
+    np.save(os.path.join(output_dir, 'run_idx.npy'), idx)
+    np.save(os.path.join(output_dir, 'run_scores.npy'), run_scores)
+    lines = []
+    for qid, ranked in zip(qids, rank_lists):
+        lines.extend(f"{qid} Q0 {did} {rank} {score!r} {tag}" for rank, (did, score) in enumerate(ranked.items(), 1))
+    with open(os.path.join(output_dir, 'run.trec'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    write_json_atomic(os.path.join(output_dir, 'run_meta.json'), {
+        'version': RUN_FORMAT_VERSION,
+        'qids': qids,
+        'num_docs': len(doc_ids),
+        'doc_ids_sha1': doc_ids_fingerprint(doc_ids),
+    }, indent=None)
+
+
+def load_run_arrays(output_dir, doc_ids=None, mmap_mode='r'):
+    with open(os.path.join(output_dir, 'run_meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != RUN_FORMAT_VERSION:
+        raise ValueError(f"run format version {meta['version']} != {RUN_FORMAT_VERSION}")
+    if doc_ids is not None and meta['doc_ids_sha1'] != doc_ids_fingerprint(doc_ids):
+        raise ValueError(f"run in {output_dir} was written for a different corpus")
+    idx = np.load(os.path.join(output_dir, 'run_idx.npy'), mmap_mode=mmap_mode)
+    scores = np.load(os.path.join(output_dir, 'run_scores.npy'), mmap_mode=mmap_mode)
+    return meta['qids'], idx, scores
+
+
+def load_run(output_dir, doc_ids):
+    # {qid: {doc_id: score}} from either format, score.json wins when both exist
+    score_path = os.path.join(output_dir, 'score.json')
+    if os.path.isfile(score_path):
+        with open(score_path) as f:
+            return json.load(f)
+    qids, idx, scores = load_run_arrays(output_dir, doc_ids)
+    return dict(zip(qids, arrays_to_rank_lists(idx, scores, doc_ids)))
+
+
+def save_per_subq_docs(output_dir, per_subq_docs, doc_index):
+    # per_subq_docs: {qid: {unit: [doc ids]}} -> per_subq_docs_idx.npy, one row per unit, and
+    # per_subq_units.json with the qid/unit of each row
+    units = [[qid, unit] for qid, docs in per_subq_docs.items() for unit in docs]
+    idx, _ = rank_lists_to_arrays([dict.fromkeys(docs, 0.0) for docs_dict in per_subq_docs.values()
+                                   for docs in docs_dict.values()], doc_index)
+    np.save(os.path.join(output_dir, 'per_subq_docs_idx.npy'), idx)
+    write_json_atomic(os.path.join(output_dir, 'per_subq_units.json'), units, indent=None)
+
+
+def load_per_subq_docs(output_dir, doc_ids, mmap_mode='r'):
+    with open(os.path.join(output_dir, 'per_subq_units.json')) as f:
+        units = json.load(f)
+    idx = np.load(os.path.join(output_dir, 'per_subq_docs_idx.npy'), mmap_mode=mmap_mode)
+    out = {}
+    for (qid, unit), row in zip(units, idx):
+        out.setdefault(qid, {})[unit] = [doc_ids[i] for i in row[row >= 0].tolist()]
+    return out
+
+
+def hit_count(retrieved, gold):
+    # "hits/gold" of one query, as written to hit_counts_*.json
+    gold = set(gold)
+    return f"{len(set(retrieved) & gold)}/{len(gold)}"
+
+
+def unit_hit_stats(unit_docs, gold, k=1000):
+    # unit_docs: {unit: [doc ids]} of one query -> its per_subq_hits.json and oracle_stats.json
+    # entries; shared by run.py and stream_run.py so both write the same outputs
+    gold = set(gold)
+    unit_hits = {unit: len(set(docs) & gold) for unit, docs in unit_docs.items()}
+    unique_docs = set(doc for docs in unit_docs.values() for doc in docs)
+    oracle_stats = {"total_docs": len(unit_docs) * k, "total_docs_unique": len(unique_docs),
+                    "hit_gold_ids": len(unique_docs & gold), "total_gold_ids": len(gold), "unit_hits": unit_hits}
+    return {unit: f"{hits}/{len(gold)}" for unit, hits in unit_hits.items()}, oracle_stats
+
+
+class RunWriter:
+    # save_run and save_per_subq_docs for query batches as they are scored: run.trec is appended and
+    # flushed per batch, the top-k rows go to part files in run_parts/ that close() joins one at a time
+    # into the run arrays, then run_meta.json is written. Memory does not grow with the number of queries.
+    def __init__(self, output_dir, doc_ids, k=1000, tag='ReDI'):
+        self.output_dir = output_dir
+        self.doc_ids = doc_ids
+        self.k = k
+        self.tag = tag
+        self.parts_dir = os.path.join(output_dir, 'run_parts')
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+        os.makedirs(self.parts_dir)
+        self.parts = {}
+        self.qids = []
+        self.units = []
+        self.trec = open(os.path.join(output_dir, 'run.trec.tmp'), 'w')
+
+    def _save_part(self, name, array):
+        paths = self.parts.setdefault(name, [])
+        paths.append(os.path.join(self.parts_dir, f"{name}_{len(paths):06d}.npy"))
+        np.save(paths[-1], array)
+
+    def _join_parts(self, name, dtype):
+        paths = self.parts.get(name, [])
+        num_rows = sum(np.load(path, mmap_mode='r').shape[0] for path in paths)
+        path = os.path.join(self.output_dir, f"{name}.npy")
+        if num_rows == 0:
+            np.save(path, np.zeros((0, self.k), dtype=dtype))
+            return
+        out = open_memmap(path, mode='w+', dtype=dtype, shape=(num_rows, self.k))
+        row = 0
+        for part_path in paths:
+            part = np.load(part_path)
+            out[row:row + len(part)] = part
+            row += len(part)
+        out.flush()
+        del out
+
+    def pad(self, topk_idx, topk_scores):
+        # get_topk rows -> k wide int32 rows / float64 scores, -1 / -inf for excluded hits and padding
+        idx = np.full((len(topk_idx), self.k), -1, dtype=np.int32)
+        scores = np.full((len(topk_idx), self.k), -np.inf, dtype=np.float64)
+        width = min(np.shape(topk_idx)[1], self.k)
+        valid = np.asarray(topk_scores)[:, :width] > -np.inf
+        idx[:, :width] = np.where(valid, np.asarray(topk_idx)[:, :width], -1)
+        scores[:, :width] = np.where(valid, np.asarray(topk_scores)[:, :width], -np.inf)
+        return idx, scores
+
+    def append(self, qids, topk_idx, topk_scores):
+        idx, scores = self.pad(topk_idx, topk_scores)
+        lines = []
+        for qid, row_idx, row_scores in zip(qids, idx.tolist(), scores.tolist()):
+            lines.extend(f"{qid} Q0 {self.doc_ids[i]} {rank} {score!r} {self.tag}"
+                         for rank, (i, score) in enumerate(zip(row_idx, row_scores), 1) if i >= 0)
+        if lines:
+            self.trec.write('\n'.join(lines) + '\n')
+        self.trec.flush()
+        self._save_part('run_idx', idx)
+        self._save_part('run_scores', scores)
+        self.qids.extend(str(qid) for qid in qids)
+
+    def append_units(self, units, topk_idx, topk_scores):
+        # units: [qid, unit] of every row, as in per_subq_units.json
+        idx, _ = self.pad(topk_idx, topk_scores)
+        self._save_part('per_subq_docs_idx', idx)
+        self.units.extend([str(qid), unit] for qid, unit in units)
+
+    def close(self):
+        self.trec.close()
+        os.replace(os.path.join(self.output_dir, 'run.trec.tmp'), os.path.join(self.output_dir, 'run.trec'))
+        self._join_parts('run_idx', np.int32)
+        self._join_parts('run_scores', np.float64)
+        if self.units:
+            self._join_parts('per_subq_docs_idx', np.int32)
+            write_json_atomic(os.path.join(self.output_dir, 'per_subq_units.json'), self.units, indent=None)
+        shutil.rmtree(self.parts_dir)
+        write_json_atomic(os.path.join(self.output_dir, 'run_meta.json'), {
+            'version': RUN_FORMAT_VERSION,
+            'qids': self.qids,
+            'num_docs': len(self.doc_ids),
+            'doc_ids_sha1': doc_ids_fingerprint(self.doc_ids),
+        }, indent=None)
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import argparse
+import threading
+import collections
+import socketserver
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unit_table import UnitTable, format_units
+from ann_index import normalize_rows
+from retrievers import (get_analyzer, load_or_build_bm25_index, load_fusion_encoder, encode_fusion_units,
+                        dense_scores, fuse_unit_scores, hybrid_fusion_topk, get_topk, get_excluded_rows)
+
+# Long-lived retrieval over the ReDI units of decomposed queries: the BM25 index and/or the doc
+# embeddings of one task are loaded once, then batches of queries are answered over local HTTP
+# (--port) or a Unix socket (--unix_socket).
+#   POST /search  {"queries": [{"id": "q1", "query": "Sub_Query_1: ... Desc1: ..."},
+#                              {"id": "q2", "units": [{"sub_query": "...", "desc": "..."}], "excluded_ids": [...]}],
+#                  "retriever": "bm25"|"dense"|"hybrid", "k": 100, "unit_k": 0, ...}
+#              -> {"results": [{"id": "q1", "docs": [[doc_id, score], ...], "units": [{"bm25": [doc_id, ...]}, ...]}],
+#                  "latency_ms": ...}
+#   GET /stats   request count and p50/p99 latency per retriever, also printed every --report_every requests
+#   GET /health  loaded retrievers and corpus size
+# A raw query is parsed like a reasoning file (the whole text is one unit when it has no
+# Sub_Query/Desc pair). Scores are those of bm25_fusion_desc (sum of the unit BM25 scores),
+# sbert_fusion_desc (embed_method, desc_weight, fusion_method) and hybrid_fusion_desc (hybrid_fusion,
+# hybrid_weight, rrf_k over 1000-deep unit lists); the server flags are the defaults, a request may
+# override them; the default retriever is hybrid when both are loaded. "units" (with unit_k > 0) holds
+# the top unit_k docs of every unit by modality. Queries without excluded_ids use those of the task's
+# examples with the same id.
+SEARCH_OPTIONS = ('embed_method', 'desc_weight', 'fusion_method', 'hybrid_fusion', 'hybrid_weight', 'rrf_k')
+
+
+class FusionSearcher:
+    def __init__(self, task, documents, doc_ids, cache_dir, long_context, retrievers=('bm25', 'dense'),
+                 model_id='sbert', excluded_ids=None, candidate_k=1000, **kwargs):
+        self.doc_ids = doc_ids
+        self.doc_index = {did: i for i, did in enumerate(doc_ids)}
+        self.excluded_ids = excluded_ids or {}
+        self.candidate_k = candidate_k
+        self.retrievers = list(retrievers)
+        self.defaults = {'embed_method': 'separate', 'desc_weight': 0.5, 'fusion_method': 'sum',
+                         'hybrid_fusion': 'rrf', 'hybrid_weight': 0.5, 'rrf_k': 60}
+        self.defaults.update({name: kwargs[name] for name in SEARCH_OPTIONS if name in kwargs})
+        if 'bm25' in self.retrievers:
+            self.analyzer = get_analyzer()
+            self.bm25_index = load_or_build_bm25_index(
+                documents, doc_ids, self.analyzer, cache_dir=cache_dir, task=task, long_context=long_context,
+                k1=0.9, b=0.4, ignore_cache=kwargs.get('ignore_cache', False), num_workers=kwargs.get('num_workers', 1))
+        if 'dense' in self.retrievers:
+            self.model, self.doc_emb, self.batch_size = load_fusion_encoder(
+                model_id, cache_dir, task, documents, long_context, **kwargs)
+        if 'bm25' in self.retrievers and 'dense' in self.retrievers:
+            self.retrievers.append('hybrid')
+
+    def unit_table(self, queries):
+        # raw reasoning text or explicit (sub_query, desc) units, both go through the unit parser
+        texts = [q['query'] if 'query' in q else format_units([(u['sub_query'], u.get('desc', '')) for u in q['units']])
+                 for q in queries]
+        return UnitTable.from_queries([str(q['id']) for q in queries], texts)
+
+    def excluded_rows(self, query):
+        excluded = query.get('excluded_ids', self.excluded_ids.get(str(query['id']), []))
+        return get_excluded_rows(self.doc_index, excluded)
+
+    def check_options(self, retriever, options):
+        retriever = retriever or self.retrievers[-1]
+        if retriever not in self.retrievers:
+            raise ValueError(f"retriever {retriever!r} is not loaded, choose from {self.retrievers}")
+        unknown = set(options) - set(SEARCH_OPTIONS)
+        if unknown:
+            raise ValueError(f"unknown options {sorted(unknown)}")
+        return retriever, {**self.defaults, **options}
+
+    def prepare(self, queries, retriever=None, **options):
+        # the query side of a search, units parsed, analyzed and encoded; stream_run.py runs it in a
+        # producer thread while score() works on the previous batch
+        retriever, options = self.check_options(retriever, options)
+        query_ids = [str(q['id']) for q in queries]
+        offsets, columns = self.unit_table(queries).select(query_ids)
+        batch = {'query_ids': query_ids, 'offsets': offsets, 'excluded': [self.excluded_rows(q) for q in queries]}
+        if retriever in ('bm25', 'hybrid'):
+            batch['unit_matrix'] = self.bm25_index.query_matrix([self.analyzer.analyze(text) for text in columns['text']])
+        if retriever in ('dense', 'hybrid'):
+            # torch only for the encoder, a BM25-only searcher never imports it
+            import torch
+            with torch.no_grad():
+                unit_embs, _, _ = encode_fusion_units(self.model, columns['sub_query'], columns['desc'],
+                                                      options['embed_method'], options['desc_weight'], self.batch_size)
+            batch['unit_embs'] = normalize_rows(unit_embs)
+        return batch
+
+    def score(self, batch, retriever=None, k=100, unit_k=0, **options):
+        # -> (final_idx, final_scores) of every query, -1 / -inf past the last hit, and
+        # {modality: (idx, scores)} of every unit (unit_k deep, candidate_k for hybrid)
+        retriever, options = self.check_options(retriever, options)
+        offsets, excluded = batch['offsets'], batch['excluded']
+        if 'unit_matrix' in batch:
+            bm25_sims = (self.bm25_index.matrix @ batch['unit_matrix'].T).T.toarray()
+        if 'unit_embs' in batch:
+            dense_sims = dense_scores(batch['unit_embs'], self.doc_emb, normalize=False)
+        if retriever == 'hybrid':
+            return hybrid_fusion_topk(bm25_sims, dense_sims, offsets, excluded, options['hybrid_fusion'],
+                                      options['hybrid_weight'], options['rrf_k'], k=k, candidate_k=self.candidate_k)
+        if retriever == 'bm25':
+            # bm25_fusion_desc always sums, in float64
+            unit_sims, fusion_method = bm25_sims.astype(np.float64), 'sum'
+        else:
+            unit_sims, fusion_method = dense_sims, options['fusion_method']
+        unit_topk = {retriever: get_topk(unit_sims, k=unit_k)} if unit_k > 0 else {}
+        final_idx, final_scores = get_topk(fuse_unit_scores(unit_sims, offsets, fusion_method), k=k, excluded=excluded)
+        return final_idx, final_scores, unit_topk
+
+    def search(self, queries, retriever=None, k=100, unit_k=0, **options):
+        # -> [{'id', 'docs': [[doc_id, score]], 'units': [{modality: [doc_id]}] when unit_k > 0}] in request order
+        batch = self.prepare(queries, retriever, **options)
+        final_idx, final_scores, unit_topk = self.score(batch, retriever, k, unit_k, **options)
+        query_ids, offsets, final = batch['query_ids'], batch['offsets'], zip(final_idx, final_scores)
+        results = []
+        for qi, (qid, (idx, scores)) in enumerate(zip(query_ids, final)):
+            result = {'id': qid, 'docs': [[self.doc_ids[i], float(s)] for i, s in zip(idx.tolist(), scores.tolist())
+                                          if s != -np.inf]}
+            if unit_k > 0:
+                result['units'] = [{name: [self.doc_ids[i] for i, s in zip(unit_idx[row][:unit_k].tolist(),
+                                                                           unit_scores[row][:unit_k].tolist())
+                                           if s != -np.inf]
+                                    for name, (unit_idx, unit_scores) in unit_topk.items()}
+                                   for row in range(offsets[qi], offsets[qi + 1])]
+            results.append(result)
+        return results
+
+
+class LatencyStats:
+    # server-side latency of the last `window` requests of every retriever
+    def __init__(self, window=10000):
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.requests = collections.Counter()
+        self.queries = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, retriever, seconds, num_queries):
+        with self.lock:
+            self.latencies[retriever].append(seconds)
+            self.requests[retriever] += 1
+            self.queries[retriever] += num_queries
+
+    def summary(self):
+        with self.lock:
+            out = {}
+            for retriever, latencies in self.latencies.items():
+                ms = np.array(latencies) * 1000
+                out[retriever] = {'requests': self.requests[retriever], 'queries': self.queries[retriever],
+                                  'p50_ms': round(float(np.percentile(ms, 50)), 2),
+                                  'p99_ms': round(float(np.percentile(ms, 99)), 2),
+                                  'mean_ms': round(float(ms.mean()), 2)}
+            return out
+
+
+def make_handler(searcher, stats, report_every=100):
+    # one search at a time: the encoder and the scoring GEMMs already use every core
+    search_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, obj):
+            out = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, stats.summary())
+            elif self.path == '/health':
+                self.send_json(200, {'retrievers': searcher.retrievers, 'num_docs': len(searcher.doc_ids)})
+            else:
+                self.send_json(404, {'error': f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != '/search':
+                self.send_json(404, {'error': f"unknown path {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                queries = body.pop('queries')
+                retriever = body.setdefault('retriever', searcher.retrievers[-1])
+                with search_lock:
+                    start = time.perf_counter()
+                    results = searcher.search(queries, **body)
+                    seconds = time.perf_counter() - start
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': repr(e)})
+                return
+            stats.record(retriever, seconds, len(queries))
+            self.send_json(200, {'results': results, 'latency_ms': round(seconds * 1000, 2)})
+            if report_every > 0 and sum(stats.requests.values()) % report_every == 0:
+                print(json.dumps(stats.summary()))
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(searcher, host='127.0.0.1', port=8000, unix_socket=None, report_every=100):
+    stats = LatencyStats()
+    handler = make_handler(searcher, stats, report_every)
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler), stats
+    return ThreadingHTTPServer((host, port), handler), stats
+
+
+if __name__ == '__main__':
+    from run import TASKS, add_common_args, load_examples, load_corpus
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, required=True, choices=TASKS)
+    parser.add_argument('--retrievers', type=str, nargs='+', default=['bm25', 'dense'], choices=['bm25', 'dense'])
+    parser.add_argument('--dense_model', type=str, default='sbert', choices=['sbert', 'bge'])
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', type=str, default=None)
+    parser.add_argument('--report_every', type=int, default=100)
+    add_common_args(parser)
+    args = parser.parse_args()
+
+    doc_ids, documents, _ = load_corpus(args.task, args.long_context, args.cache_dir)
+    examples = load_examples(args.task, args.cache_dir, input_file=args.input_file)
+    kwargs = {name: getattr(args, name) for name in SEARCH_OPTIONS}
+    kwargs.update({'emb_dtype': args.emb_dtype, 'ignore_cache': args.ignore_cache, 'num_workers': args.num_workers})
+    if args.encode_batch_size > 0:
+        kwargs['batch_size'] = args.encode_batch_size
+    searcher = FusionSearcher(args.task, documents, doc_ids, args.cache_dir, args.long_context,
+                              retrievers=args.retrievers, model_id=args.dense_model,
+                              excluded_ids={str(e['id']): e['excluded_ids'] for e in examples}, **kwargs)
+    server, stats = make_server(searcher, args.host, args.port, args.unix_socket, args.report_every)
+    print(f"serving {searcher.retrievers} for {args.task} ({len(doc_ids)} docs) on "
+          f"{args.unix_socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(stats.summary()))
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import queue
+import resource
+import threading
+import numpy as np
+from unit_table import iter_example_batches
+from run_io import RunWriter, run_exists, hit_count, unit_hit_stats
+from fast_eval import QrelsIndex, evaluate_topk, doc_id_ranks
+from serve import FusionSearcher
+
+# run.py --stream for the fusion retrievers: the examples of a reasoning file are read in record
+# batches, a producer thread parses, analyzes and encodes the units of the next batches while the
+# main thread scores the current one (at most queue_size batches wait in between), and every scored
+# batch is flushed to the binary run files (run_io.RunWriter) and evaluated (fast_eval) right away.
+# Nothing is kept per query but the small hit counts, so peak memory does not grow with the number
+# of queries. The run, per_subq_docs, hit counts, oracle_stats and metrics are those of the
+# in-memory path (see serve.FusionSearcher for the scoring); the per-query unit embedding .npy files
+# of sbert_fusion_desc are not written.
+STREAM_RETRIEVERS = {'bm25_fusion_desc': ('bm25', ['bm25']), 'sbert_fusion_desc': ('dense', ['dense']),
+                     'hybrid_fusion_desc': ('hybrid', ['bm25', 'dense'])}
+HIT_COUNTS_NAMES = {'bm25_fusion_desc': 'bm25', 'sbert_fusion_desc': 'dense'}
+
+
+def produce(searcher, batches, retriever, options, out_queue):
+    # producer thread; an exception is handed to the consumer, None marks the end
+    try:
+        for examples in batches:
+            queries = [{'id': qid, 'query': query, 'excluded_ids': excluded} for qid, query, excluded in
+                       zip(examples['id'], examples['query'], examples['excluded_ids'])]
+            out_queue.put((examples, searcher.prepare(queries, retriever, **options)))
+    except Exception as e:
+        out_queue.put(e)
+        return
+    out_queue.put(None)
+
+
+def stream_retrieval(searcher, batches, retriever, writer, gold_key='gold_ids', k=1000, queue_size=2,
+                     k_values=[1, 5, 10, 25, 50, 100], **options):
+    # -> (metrics, per_subq_hits, hit_counts, oracle_stats); the run goes to writer
+    doc_ids = searcher.doc_ids
+    doc_ranks = doc_id_ranks(doc_ids)
+    single = retriever != 'hybrid'
+    per_subq_hits, hit_counts, oracle_stats = {}, {}, {}
+    metric_sums, num_evaluated = {}, 0
+    batch_queue = queue.Queue(maxsize=queue_size)
+    producer = threading.Thread(target=produce, args=(searcher, batches, retriever, options, batch_queue), daemon=True)
+    start_time, wait_seconds = time.time(), 0.0
+    producer.start()
+    while True:
+        wait_start = time.time()
+        item = batch_queue.get()
+        wait_seconds += time.time() - wait_start
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        examples, batch = item
+        query_ids, offsets = batch['query_ids'], batch['offsets']
+        final_idx, final_scores, unit_topk = searcher.score(batch, retriever, k=k, unit_k=k, **options)
+        writer.append(query_ids, final_idx, final_scores)
+        run_idx, run_scores = writer.pad(final_idx, final_scores)
+
+        units, unit_rows = [], []
+        for qi, qid in enumerate(query_ids):
+            unit_docs = {}
+            for n, row in enumerate(range(offsets[qi], offsets[qi + 1]), start=1):
+                for name, (unit_idx, unit_scores) in unit_topk.items():
+                    unit = f"Unit{n}" if single else f"Unit{n}_{name}"
+                    unit_docs[unit] = [doc_ids[i] for i, s in zip(unit_idx[row].tolist(), unit_scores[row].tolist())
+                                       if s != -np.inf]
+                    units.append([qid, unit])
+                    unit_rows.append((name, row))
+            per_subq_hits[qid], oracle_stats[qid] = unit_hit_stats(unit_docs, examples['gold_ids'][qi], k=k)
+            hit_counts[qid] = hit_count((doc_ids[i] for i in run_idx[qi].tolist() if i >= 0), examples[gold_key][qi])
+        if units:
+            writer.append_units(units, np.stack([unit_topk[name][0][row] for name, row in unit_rows]),
+                                np.stack([unit_topk[name][1][row] for name, row in unit_rows]))
+
+        qrels = {qid: {gid: 1 for gid in gold} for qid, gold in zip(query_ids, examples[gold_key])}
+        values, evaluated = evaluate_topk(run_idx, run_scores, QrelsIndex(qrels, query_ids, doc_ids,
+                                                                          doc_index=searcher.doc_index,
+                                                                          doc_ranks=doc_ranks),
+                                          k_values, per_query=True)
+        for name, per_query in values.items():
+            metric_sums[name] = metric_sums.get(name, 0.0) + float((per_query * evaluated).sum())
+        num_evaluated += int(evaluated.sum())
+    producer.join()
+    writer.close()
+    seconds = time.time() - start_time
+    print(f"{len(hit_counts)} queries in {seconds:.1f}s, {wait_seconds:.1f}s waiting for unit encoding, "
+          f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+    metrics = {name: round(total / max(num_evaluated, 1), 5) for name, total in metric_sums.items()}
+    return metrics, per_subq_hits, hit_counts, oracle_stats
+
+
+def run_stream_retrieval(args, doc_ids, documents, reasoning_path):
+    # args.output_dir is the directory of this task/model, see run.get_output_dir
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_path = os.path.join(args.output_dir, 'results.json')
+    if run_exists(args.output_dir) and os.path.isfile(results_path):
+        print(args.output_dir, 'has a run')
+        with open(results_path) as f:
+            return json.load(f)
+    retriever, loaded = STREAM_RETRIEVERS[args.model]
+    kwargs = {'embed_method': args.embed_method, 'desc_weight': args.desc_weight, 'fusion_method': args.fusion_method,
+              'hybrid_fusion': args.hybrid_fusion, 'hybrid_weight': args.hybrid_weight, 'rrf_k': args.rrf_k}
+    searcher = FusionSearcher(args.task, documents, doc_ids, args.cache_dir, args.long_context, retrievers=loaded,
+                              model_id=args.model, emb_dtype=args.emb_dtype, ignore_cache=args.ignore_cache,
+                              num_workers=args.num_workers,
+                              **({'batch_size': args.encode_batch_size} if args.encode_batch_size > 0 else {}),
+                              **kwargs)
+    writer = RunWriter(args.output_dir, doc_ids, tag=args.model)
+    metrics, per_subq_hits, hit_counts, oracle_stats = stream_retrieval(
+        searcher, iter_example_batches(reasoning_path, args.stream_batch_size), retriever, writer,
+        gold_key='gold_ids_long' if args.long_context else 'gold_ids', queue_size=args.stream_queue_size)
+    for name, obj in (("per_subq_hits.json", per_subq_hits), ("oracle_stats.json", oracle_stats),
+                      (f"hit_counts_{HIT_COUNTS_NAMES.get(args.model, args.model)}.json", hit_counts)):
+        with open(os.path.join(args.output_dir, name), "w") as f:
+            json.dump(obj, f, indent=2)
+    print(args.output_dir)
+    print(metrics)
+    with open(results_path, 'w') as f:
+        json.dump(metrics, f, indent=2)
+    return metrics
@@ -0,0 +1,169 @@
+import os
+import re
+import sys
+import numpy as np
+import pyarrow as pa
+
+# Pre-parsed ReDI units of a reasoning arrow file (ReDI_dense_reason / ReDI_sparse_reason
+# bright-{task}.arrow), one row per unit:
+#   qid        query id
+#   unit       1-based unit number within the query (Unit1, Unit2, ... of per_subq_docs)
+#   sub_query  text inside <begin_of_query>...<end_of_query>
+#   desc       text inside <begin_of_desc>...<end_of_desc>
+#   text       'Sub_Query_n: "..." Descn: "..."' with the markers, the BM25 unit
+#   parsed     False for the single fallback unit of a query without any Sub_Query/Desc pair
+# The table is written once next to the source as bright-{task}.units.arrow (arrow IPC file)
+# and memory-mapped by both fusion retrievers. Bump the version when parsing changes.
+UNIT_TABLE_VERSION = 1
+
+UNIT_PATTERN = re.compile(
+    r'(Sub_Query_\d+:\s*"<begin_of_query>(.*?)<end_of_query>")\s*'
+    r'(Desc\d+:\s*"<begin_of_desc>(.*?)<end_of_desc>")',
+    flags=re.DOTALL
+)
+SUB_QUERY_MARKER = re.compile(r'Sub_Query_\d+:')
+
+UNIT_SCHEMA = pa.schema([
+    ('qid', pa.string()),
+    ('unit', pa.int32()),
+    ('sub_query', pa.string()),
+    ('desc', pa.string()),
+    ('text', pa.string()),
+    ('parsed', pa.bool_()),
+], metadata={'unit_table_version': str(UNIT_TABLE_VERSION)})
+
+
+def parse_units(query):
+    # [(sub_query, desc, text)] of every Sub_Query/Desc pair, see build_unit_table for the fallback
+    return [(m.group(2).strip(), m.group(4).strip(), f"{m.group(1).strip()} {m.group(3).strip()}")
+            for m in UNIT_PATTERN.finditer(query)]
+
+
+def format_units(units):
+    # (sub_query, desc) pairs in the layout of the reasoning files, parse_units gives them back
+    return "\n".join(f'Sub_Query_{n}: "<begin_of_query>{sub_query}<end_of_query>"\n'
+                     f'Desc{n}: "<begin_of_desc>{desc}<end_of_desc>"'
+                     for n, (sub_query, desc) in enumerate(units, start=1))
+
+
+def read_queries(arrow_path):
+    # the reasoning files are datasets arrow files (IPC stream), ids and queries are all we need
+    with pa.memory_map(arrow_path) as source:
+        try:
+            table = pa.ipc.open_stream(source).read_all()
+        except pa.ArrowInvalid:
+            table = pa.ipc.open_file(source).read_all()
+    return [str(qid) for qid in table.column('id').to_pylist()], table.column('query').to_pylist()
+
+
+def iter_example_batches(arrow_path, batch_size=64, columns=('id', 'query', 'excluded_ids', 'gold_ids', 'gold_ids_long')):
+    # {column: list} of at most batch_size examples at a time, read record batch by record batch from
+    # the memory-mapped file; columns the file does not have are left out
+    with pa.memory_map(arrow_path) as source:
+        try:
+            reader = pa.ipc.open_stream(source)
+            record_batches = iter(reader)
+        except pa.ArrowInvalid:
+            reader = pa.ipc.open_file(source)
+            record_batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        names = [name for name in columns if name in reader.schema.names]
+        for record_batch in record_batches:
+            for start in range(0, record_batch.num_rows, batch_size):
+                part = record_batch.slice(start, batch_size)
+                yield {name: part.column(name).to_pylist() for name in names}
+
+
+def build_unit_table(query_ids, queries, name='queries'):
+    columns = {field: [] for field in UNIT_SCHEMA.names}
+    fallback, unpaired = 0, 0
+    for qid, query in zip(query_ids, queries):
+        units = parse_units(query)
+        parsed = len(units) > 0
+        if not parsed:
+            # one unit: the whole query as sub-query with an empty description (dense), stripped (BM25)
+            units = [(query, "", query.strip())]
+            fallback += 1
+        elif len(SUB_QUERY_MARKER.findall(query)) > len(units):
+            unpaired += 1
+        for unit, (sub_query, desc, text) in enumerate(units, start=1):
+            columns['qid'].append(str(qid))
+            columns['unit'].append(unit)
+            columns['sub_query'].append(sub_query)
+            columns['desc'].append(desc)
+            columns['text'].append(text)
+            columns['parsed'].append(parsed)
+    if fallback or unpaired:
+        print(f"{name}: {fallback} of {len(queries)} queries have no Sub_Query/Desc pair and are used whole, "
+              f"{unpaired} have sub-queries without a description that are skipped")
+    return pa.table(columns, schema=UNIT_SCHEMA)
+
+
+def unit_table_path(arrow_path):
+    return re.sub(r'\.arrow$', '', arrow_path) + '.units.arrow'
+
+
+def write_unit_table(table, path):
+    tmp_path = path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def read_unit_table(path):
+    # zero-copy: the columns stay backed by the memory-mapped file
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    version = (table.schema.metadata or {}).get(b'unit_table_version', b'0').decode()
+    if version != str(UNIT_TABLE_VERSION):
+        raise ValueError(f"unit table {path} version {version} != {UNIT_TABLE_VERSION}")
+    return table
+
+
+def load_or_build_unit_table(arrow_path, ignore_cache=False):
+    path = unit_table_path(arrow_path)
+    if not ignore_cache and os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(arrow_path):
+        try:
+            return UnitTable(read_unit_table(path))
+        except ValueError as e:
+            print(e)
+    query_ids, queries = read_queries(arrow_path)
+    table = build_unit_table(query_ids, queries, name=arrow_path)
+    try:
+        write_unit_table(table, path)
+        print('write unit table', path)
+        return UnitTable(read_unit_table(path))
+    except OSError as e:
+        print(f"cannot write unit table {path} ({e}), using it in memory")
+        return UnitTable(table)
+
+
+class UnitTable:
+    # row offsets of every qid in a unit table; select() gathers the units of a list of queries
+    # into flat columns plus per-query offsets, the layout both fusion retrievers score in
+    def __init__(self, table):
+        self.table = table
+        qids = table.column('qid').to_numpy(zero_copy_only=False)
+        starts = np.flatnonzero(np.r_[True, qids[1:] != qids[:-1]]) if len(qids) else np.zeros(0, dtype=np.int64)
+        ends = np.r_[starts[1:], len(qids)].astype(np.int64)
+        self.rows = {qid: (start, end) for qid, start, end in zip(qids[starts], starts, ends)}
+
+    @classmethod
+    def from_queries(cls, query_ids, queries):
+        return cls(build_unit_table(query_ids, queries))
+
+    def select(self, query_ids, columns=('sub_query', 'desc', 'text')):
+        missing = [qid for qid in query_ids if str(qid) not in self.rows]
+        if missing:
+            raise KeyError(f"{len(missing)} queries are not in the unit table, e.g. {missing[:3]}")
+        spans = [self.rows[str(qid)] for qid in query_ids]
+        offsets = np.cumsum([0] + [end - start for start, end in spans])
+        rows = np.concatenate([np.arange(start, end) for start, end in spans]) if spans else np.zeros(0, dtype=np.int64)
+        picked = self.table.select(list(columns)).take(pa.array(rows, type=pa.int64()))
+        return offsets, {name: picked.column(name).to_pylist() for name in columns}
+
+
+if __name__ == '__main__':
+    # python unit_table.py ReDI_dense_reason/*.arrow ReDI_sparse_reason/*.arrow
+    for arrow_path in sys.argv[1:]:
+        unit_table = load_or_build_unit_table(arrow_path, ignore_cache=True)
+        print(f"{arrow_path}: {len(unit_table.rows)} queries, {unit_table.table.num_rows} units")